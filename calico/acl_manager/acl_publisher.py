@@ -98,11 +98,23 @@ class ACLPublisher:
                 self.acl_store.query_endpoint_rules(endpoint)
                 query["rc"] = "SUCCESS"
                 query["message"] = ""
+            elif query["type"] == "GETACLSTATES":
+                # Bulk query for many endpoints, answered with a single piece
+                # of work for the ACL Store. The response does not repeat the
+                # list of endpoints.
+                endpoints = query.pop("endpoint_ids")
+                log.info("Received query for %d endpoints from Felix" %
+                         len(endpoints))
+                self.acl_store.query_endpoints_rules(endpoints)
+                query["endpoint_count"] = len(endpoints)
+                query["rc"] = "SUCCESS"
+                query["message"] = ""
             else:
                 # Received unexpected message.  Log and return it.
                 log.warning("Received query %s of unknown type" % query)
                 query["rc"] = "FAILURE"
-                query["message"] = "Unknown message type: expected GETACLSTATE"
+                query["message"] = ("Unknown message type: expected "
+                                    "GETACLSTATE or GETACLSTATES")
             
             log.debug("Sending response message: %s, %s" %
                                      (peer, json.dumps(query).encode("utf-8")))
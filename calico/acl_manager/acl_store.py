@@ -53,6 +53,17 @@ class ACLStore(object):
         """
         log.debug("Query received for endpoint UUID %s" % endpoint_uuid)
         self.queue.put(("query_endpoint", endpoint_uuid))
+
+    def query_endpoints_rules(self, endpoint_uuids):
+        """
+        Notify the ACL Store that a query has been received for a list of
+        endpoints.
+
+        The ACL Store will respond asynchronously by publishing an update for
+        each endpoint, one after another.  This method is thread-safe.
+        """
+        log.debug("Query received for %d endpoints" % len(endpoint_uuids))
+        self.queue.put(("query_endpoints", endpoint_uuids))
         
     def update_endpoint_rules(self, endpoint_uuid, rules):
         """
@@ -75,6 +86,9 @@ class ACLStore(object):
                 continue_working = False
             elif work_type == "query_endpoint":
                 self.worker_publish_update(work_params[1])
+            elif work_type == "query_endpoints":
+                for endpoint_uuid in work_params[1]:
+                    self.worker_publish_update(endpoint_uuid)
             elif work_type == "update_endpoint":
                 self.worker_update_endpoint(work_params[1], work_params[2])
             else:
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+acl_manager.test.test_acl_publisher
+~~~~~~~~~~~
+
+Tests for the ACL manager's handling of ACL state queries from Felix.
+"""
+import json
+import sys
+import unittest
+
+# Replace zmq with a stub, so that no real sockets are bound.
+import calico.felix.test.stub_zmq as stub_zmq
+sys.modules['zmq'] = stub_zmq
+
+from calico.acl_manager import acl_publisher
+from calico.acl_manager.acl_store import ACLStore
+
+class FakeStore(object):
+    def __init__(self):
+        self.queries = []
+
+    def query_endpoint_rules(self, endpoint_uuid):
+        self.queries.append(endpoint_uuid)
+
+    def query_endpoints_rules(self, endpoint_uuids):
+        self.queries.append(list(endpoint_uuids))
+
+
+class IdleThread(object):
+    """
+    Stands in for the publisher's threads, which are never started.
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def start(self):
+        pass
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.published = []
+
+    def publish_endpoint_acls(self, endpoint_uuid, acls):
+        self.published.append((endpoint_uuid, acls))
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        # Build the publisher without starting its threads; the tests run
+        # the query loop directly, which ends when there are no more queries.
+        self.real_thread = acl_publisher.Thread
+        acl_publisher.Thread = IdleThread
+        self.store = FakeStore()
+        self.publisher = acl_publisher.ACLPublisher(stub_zmq.Context(),
+                                                    self.store)
+
+    def tearDown(self):
+        acl_publisher.Thread = self.real_thread
+
+    def query(self, fields):
+        """
+        Send a query from Felix, and return the response to it.
+        """
+        sock = self.publisher.router_socket
+        sock.queue("felix1", "", json.dumps(fields))
+        self.assertRaises(stub_zmq.Again, self.publisher.query_thread_func)
+
+        peer, empty, data = sock.sent.pop(0)
+        self.assertEqual(peer, "felix1")
+        self.assertEqual(empty, "")
+        return json.loads(data)
+
+    def test_getaclstate(self):
+        response = self.query({"type": "GETACLSTATE",
+                               "endpoint_id": "ep1",
+                               "request_id": 3})
+        self.assertEqual(self.store.queries, ["ep1"])
+        self.assertEqual(response["rc"], "SUCCESS")
+        self.assertEqual(response["request_id"], 3)
+
+    def test_getaclstates(self):
+        # A bulk query is passed to the store as a single piece of work, and
+        # the response gives the number of endpoints rather than the list.
+        response = self.query({"type": "GETACLSTATES",
+                               "endpoint_ids": ["ep1", "ep2", "ep3"],
+                               "request_id": 4})
+        self.assertEqual(self.store.queries, [["ep1", "ep2", "ep3"]])
+        self.assertEqual(response, {"type": "GETACLSTATES",
+                                    "endpoint_count": 3,
+                                    "request_id": 4,
+                                    "rc": "SUCCESS",
+                                    "message": ""})
+
+    def test_unknown(self):
+        response = self.query({"type": "GETSOMETHING"})
+        self.assertEqual(self.store.queries, [])
+        self.assertEqual(response["rc"], "FAILURE")
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.publisher = FakePublisher()
+        self.store = ACLStore()
+        self.store.start(self.publisher)
+
+    def tearDown(self):
+        self.store.stop()
+
+    def test_query_endpoints(self):
+        self.store.update_endpoint_rules("ep1", {"v4": 1})
+        self.store.update_endpoint_rules("ep2", {"v4": 2})
+        self.store.queue.join()
+        del self.publisher.published[:]
+
+        # The ACLs for each known endpoint are published in turn; unknown
+        # endpoints are skipped.
+        self.store.query_endpoints_rules(["ep2", "ep3", "ep1"])
+        self.store.queue.join()
+        self.assertEqual(self.publisher.published, [("ep2", {"v4": 2}),
+                                                    ("ep1", {"v4": 1})])
@@ -39,6 +39,15 @@ log = logging.getLogger(__name__)
 #*****************************************************************************#
 INT_REGEX  = re.compile("^[0-9]+$")
 
+# Valid values for IptablesBackend; must match those in felix.frules.
+IPTABLES_BACKENDS = ("python-iptables", "restore")
+
+# Valid values for InterfaceDispatch; must match those in felix.frules.
+DISPATCH_MODES = ("flat", "tree")
+
+# Valid values for RouteBackend; must match those in felix.finterface.
+ROUTE_BACKENDS = ("ip", "netlink")
+
 
 class ConfigException(Exception):
     def __init__(self, message, path):
@@ -61,10 +70,26 @@ class Config(object):
             self.get_cfg_entry("global",
                                "EndpointRetryTimeMillis",
                                500))
+        self.EP_RETRY_MAX_INT_MS = int(
+            self.get_cfg_entry("global",
+                               "EndpointRetryMaxTimeMillis",
+                               30000))
         self.RESYNC_INT_SEC  = int(
             self.get_cfg_entry("global",
                                "ResyncIntervalSecs",
                                1800))
+        self.ACL_FLUSH_MS    = int(
+            self.get_cfg_entry("global",
+                               "ACLFlushTimeMillis",
+                               50))
+        self.ACL_REQ_WINDOW  = int(
+            self.get_cfg_entry("global",
+                               "ACLRequestWindow",
+                               50))
+        self.MAX_MSGS_PER_POLL = int(
+            self.get_cfg_entry("global",
+                               "MaxMessagesPerPoll",
+                               100))
         self.PLUGIN_ADDR     = self.get_cfg_entry("global",
                                                   "PluginAddress")
         self.ACL_ADDR        = self.get_cfg_entry("global",
@@ -75,6 +100,21 @@ class Config(object):
         self.METADATA_PORT   = self.get_cfg_entry("global",
                                                   "MetadataPort",
                                                   "9697")
+        self.IPTABLES_BACKEND = self.get_cfg_entry("global",
+                                                   "IptablesBackend",
+                                                   "python-iptables")
+        self.DISPATCH_MODE   = self.get_cfg_entry("global",
+                                                  "InterfaceDispatch",
+                                                  "flat")
+        self.SHARED_IPSETS   = self.get_cfg_entry("global",
+                                                  "SharedIpsets",
+                                                  "false")
+        self.COMMAND_SESSIONS = self.get_cfg_entry("global",
+                                                   "CommandSessions",
+                                                   "false")
+        self.ROUTE_BACKEND   = self.get_cfg_entry("global",
+                                                  "RouteBackend",
+                                                  "ip")
         self.LOGFILE         = self.get_cfg_entry("log",
                                                   "LogFilePath",
                                                   "felix.log")
@@ -87,6 +127,10 @@ class Config(object):
         self.LOGLEVSCR       = self.get_cfg_entry("log",
                                                   "LogSeverityScreen",
                                                   "ERROR")
+        self.STATS_INT_SEC   = int(
+            self.get_cfg_entry("log",
+                               "StatsIntervalSecs",
+                               300))
 
         self.CONN_TIMEOUT_MS   = int(
             self.get_cfg_entry("connection",
@@ -169,6 +213,45 @@ class Config(object):
         self.validate_addr("PluginAddress", self.PLUGIN_ADDR)
         self.validate_addr("ACLAddress", self.ACL_ADDR)
 
+        if self.EP_RETRY_MAX_INT_MS < self.EP_RETRY_INT_MS:
+            raise ConfigException("Invalid EndpointRetryMaxTimeMillis value "
+                                  ": %d" % self.EP_RETRY_MAX_INT_MS,
+                                  self._config_path)
+
+        if self.ACL_FLUSH_MS < 0:
+            raise ConfigException("Invalid ACLFlushTimeMillis value : %d" %
+                                  self.ACL_FLUSH_MS, self._config_path)
+
+        if self.ACL_REQ_WINDOW < 1:
+            raise ConfigException("Invalid ACLRequestWindow value : %d" %
+                                  self.ACL_REQ_WINDOW, self._config_path)
+
+        if self.MAX_MSGS_PER_POLL < 1:
+            raise ConfigException("Invalid MaxMessagesPerPoll value : %d" %
+                                  self.MAX_MSGS_PER_POLL, self._config_path)
+
+        if self.IPTABLES_BACKEND not in IPTABLES_BACKENDS:
+            raise ConfigException("Invalid IptablesBackend value : %s" %
+                                  self.IPTABLES_BACKEND, self._config_path)
+
+        if self.DISPATCH_MODE not in DISPATCH_MODES:
+            raise ConfigException("Invalid InterfaceDispatch value : %s" %
+                                  self.DISPATCH_MODE, self._config_path)
+
+        if self.SHARED_IPSETS.lower() not in ("true", "false"):
+            raise ConfigException("Invalid SharedIpsets value : %s" %
+                                  self.SHARED_IPSETS, self._config_path)
+        self.SHARED_IPSETS = (self.SHARED_IPSETS.lower() == "true")
+
+        if self.COMMAND_SESSIONS.lower() not in ("true", "false"):
+            raise ConfigException("Invalid CommandSessions value : %s" %
+                                  self.COMMAND_SESSIONS, self._config_path)
+        self.COMMAND_SESSIONS = (self.COMMAND_SESSIONS.lower() == "true")
+
+        if self.ROUTE_BACKEND not in ROUTE_BACKENDS:
+            raise ConfigException("Invalid RouteBackend value : %s" %
+                                  self.ROUTE_BACKEND, self._config_path)
+
     def warn_unused_cfg(self):
         #*********************************************************************#
         #* Firewall that no unexpected items in the config file - i.e. ones  *#
@@ -24,6 +24,9 @@ Contains Felix logic to manage endpoints and their configuration.
 from calico.felix import finterface
 from calico.felix import frules
 from calico.felix import futils
+import functools
+import hashlib
+import json
 import logging
 
 log = logging.getLogger(__name__)
@@ -66,6 +69,14 @@ class Endpoint(object):
         # Addresses is a set of Address objects.
         self.addresses      = set()
 
+        # The revision of the endpoint's data, as sent by the plugin, which is
+        # sent back to it on incremental resyncs. None if there is none, or
+        # if the endpoint has not been programmed successfully. Only set on
+        # the main thread, once the worker has programmed the data with
+        # revision data_revision (which only the worker uses).
+        self.revision       = None
+        self.data_revision  = None
+
         #*********************************************************************#
         #* pending_resync is set True when we have triggered a resync and    *#
         #* this particular endpoint has NOT received an update for that      *#
@@ -88,16 +99,28 @@ class Endpoint(object):
         #*********************************************************************#
         self.acl_data       = None   # ACL data structure
 
+        #*********************************************************************#
+        #* Fingerprint of the ACLs last successfully programmed, so that we  *#
+        #* can skip reprogramming them when they have not changed. None if   *#
+        #* no ACLs have been programmed (or the last attempt failed).        *#
+        #*********************************************************************#
+        self.acl_fingerprint = None
+
         # Assume disabled until we know different
         self.state          = Endpoint.STATE_DISABLED
 
-    def remove(self):
+    def remove(self, rule_batch=None):
         # Delete a programmed endpoint. Remove the rules only, since the routes
-        # will vanish in due course when the tap interface goes.
+        # will vanish in due course when the tap interface goes. Drop it from
+        # the batch of rules still to be programmed, if there is one, or it
+        # would get its chains back when the batch is applied.
+        if rule_batch is not None:
+            rule_batch.discard(self.suffix)
         frules.del_rules(self.suffix, futils.IPV4)
         frules.del_rules(self.suffix, futils.IPV6)
+        finterface.forget_tap(self.tap)
 
-    def program_endpoint(self):
+    def program_endpoint(self, route_batch=None, rule_batch=None):
         """
         Given an endpoint, make the programmed state match the desired state,
         setting up rules and creating chains and ipsets, but not putting
@@ -116,6 +139,13 @@ class Endpoint(object):
         must have a default rule of "deny", so when issue39 is fully resolved
         this method should only be called when the ACLs are available too.
        
+        If *route_batch* (a finterface.RouteBatch) is passed in, the tap
+        configuration and route changes are added to it, on behalf of this
+        endpoint, rather than being made immediately; the caller applies the
+        batch. Similarly, if *rule_batch* (a frules.RuleBatch) is passed in,
+        the endpoint's rules are added to it rather than being programmed
+        immediately; its ipsets are created (and its ACLs programmed) now.
+
         Returns True if the endpoint needs to be retried (because the tap
         interface does not exist yet).
         """
@@ -133,7 +163,10 @@ class Endpoint(object):
 
         # Configure the tap interface.
         if self.state == Endpoint.STATE_ENABLED:
-            finterface.configure_tap(self.tap)
+            if route_batch is None:
+                finterface.configure_tap(self.tap)
+            else:
+                route_batch.configure_tap(self.uuid, self.tap)
 
             # Build up list of addresses that should be present
             ipv4_intended = set([addr.ip.encode('ascii')
@@ -147,14 +180,24 @@ class Endpoint(object):
             ipv4_intended = set()
             ipv6_intended = set()
 
-        ipv4_existing   = finterface.list_tap_ips(futils.IPV4, self.tap)
-        ipv6_existing   = finterface.list_tap_ips(futils.IPV6, self.tap)
+        if route_batch is None:
+            list_tap_ips = finterface.list_tap_ips
+            add_route    = finterface.add_route
+            del_route    = finterface.del_route
+        else:
+            # Include any changes already in the batch for this tap.
+            list_tap_ips = route_batch.list_tap_ips
+            add_route    = functools.partial(route_batch.add_route, self.uuid)
+            del_route    = functools.partial(route_batch.del_route, self.uuid)
+
+        ipv4_existing   = list_tap_ips(futils.IPV4, self.tap)
+        ipv6_existing   = list_tap_ips(futils.IPV6, self.tap)
 
         for ipv4 in ipv4_intended:
             if ipv4 not in ipv4_existing:
                 log.info("Add route to IPv4 address %s for tap %s" %
                          (ipv4, self.tap))
-                finterface.add_route(futils.IPV4, ipv4, self.tap, self.mac)
+                add_route(futils.IPV4, ipv4, self.tap, self.mac)
             else:
                 log.debug("Already got route to address %s for tap %s" %
                           (ipv4, self.tap))
@@ -163,7 +206,7 @@ class Endpoint(object):
             if ipv6 not in ipv6_existing:
                 log.info("Add route to IPv6 address %s for tap %s" %
                          (ipv6, self.tap))
-                finterface.add_route(futils.IPV6, ipv6, self.tap, self.mac)
+                add_route(futils.IPV6, ipv6, self.tap, self.mac)
             else:
                 log.debug("Already got route to address %s for tap %s" %
                           (ipv4, self.tap))
@@ -172,23 +215,38 @@ class Endpoint(object):
             if ipv4 not in ipv4_intended:
                 log.info("Remove extra IPv4 route to address %s for tap %s" %
                          (ipv4, self.tap))
-                finterface.del_route(futils.IPV4, ipv4, self.tap)
+                del_route(futils.IPV4, ipv4, self.tap)
 
         for ipv6 in ipv6_existing:
             if ipv6 not in ipv6_intended:
                 log.info("Remove extra IPv6 route to address %s for tap %s" %
                          (ipv6, self.tap))
-                finterface.del_route(futils.IPV6, ipv6, self.tap)
+                del_route(futils.IPV6, ipv6, self.tap)
+
+        #*********************************************************************#
+        #* If the endpoint's ipsets do not all exist, they are created (or   *#
+        #* recreated) empty below, so its ACLs must be programmed even if    *#
+        #* they have not changed.                                            *#
+        #*********************************************************************#
+        if not (frules.ep_ipsets_exist(self.suffix, futils.IPV4) and
+                frules.ep_ipsets_exist(self.suffix, futils.IPV6)):
+            self.acl_fingerprint = None
 
         #*********************************************************************#
         #* Set up the rules for this endpoint, not including ACLs. Note that *#
         #* if the endpoint is disabled, then it has no permitted addresses,  *#
         #* so it cannot send any data.                                       *#
         #*********************************************************************#
-        frules.set_ep_specific_rules(self.suffix, self.tap, futils.IPV4,
-                                     ipv4_intended, self.mac)
-        frules.set_ep_specific_rules(self.suffix, self.tap, futils.IPV6,
-                                     ipv6_intended, self.mac)
+        if rule_batch is None:
+            set_ep_specific_rules = frules.set_ep_specific_rules
+        else:
+            set_ep_specific_rules = functools.partial(
+                rule_batch.set_ep_specific_rules, self.uuid)
+
+        set_ep_specific_rules(self.suffix, self.tap, futils.IPV4,
+                              ipv4_intended, self.mac)
+        set_ep_specific_rules(self.suffix, self.tap, futils.IPV6,
+                              ipv6_intended, self.mac)
 
         #*********************************************************************#
         #* If we have just disabled / enabled an endpoint, we may need to    *#
@@ -199,11 +257,23 @@ class Endpoint(object):
 
         return False
 
-    def update_acls(self):
+    def update_acls(self, force=False):
         """
         Updates the ACL state for an endpoint, setting all the rules and IP
         sets appropriately.
+
+        Nothing is done if the endpoint's ipsets do not exist, since it has
+        not been programmed (or programming it failed); its ACLs are set when
+        it is. Nothing is done either if the ACLs are the same as those last
+        programmed and the ipsets holding them all still exist (see
+        frules.ep_acl_ipsets_exist), unless *force* is set.
         """
+        if not (frules.ep_ipsets_exist(self.suffix, futils.IPV4) and
+                frules.ep_ipsets_exist(self.suffix, futils.IPV6)):
+            log.debug("Endpoint %s not programmed; hold its ACLs" %
+                      self.suffix)
+            return
+
         if self.state == Endpoint.STATE_DISABLED:
             # Disabled endpoint - bar all traffic.
             log.debug("Set up empty ACLs for %s" % (self.suffix))
@@ -220,6 +290,17 @@ class Endpoint(object):
             log.debug("ACLs for %s are %s" % (self.suffix, self.acl_data))
             acls = self.acl_data
 
+        fingerprint = hashlib.sha1(json.dumps(acls,
+                                              sort_keys=True)).hexdigest()
+        if (not force and fingerprint == self.acl_fingerprint and
+                frules.ep_acl_ipsets_exist(self.suffix, futils.IPV4) and
+                frules.ep_acl_ipsets_exist(self.suffix, futils.IPV6)):
+            log.debug("ACLs for %s are unchanged" % self.suffix)
+            return
+
+        # Forget the old fingerprint, in case programming fails part way.
+        self.acl_fingerprint = None
+
         inbound     = acls['v4']['inbound']
         in_default  = acls['v4']['inbound_default']
         outbound    = acls['v4']['outbound']
@@ -237,3 +318,5 @@ class Endpoint(object):
         frules.set_acls(self.suffix, futils.IPV6,
                         inbound, in_default,
                         outbound, out_default)
+
+        self.acl_fingerprint = fingerprint
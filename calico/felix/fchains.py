@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fchains
+~~~~~~~~~~~~
+
+In-memory model of the iptables chains that Felix owns.
+
+Rules are held as text specs, in the format that iptables-save uses without
+the leading "-A <chain>" (for example "-i tap1234 -j felix-from-1234"). This
+module has no dependency on python-iptables, so that it can be tested
+without it.
+"""
+import difflib
+import logging
+
+# Logger
+log = logging.getLogger(__name__)
+
+# All chains whose names start with this prefix are owned by Felix.
+FELIX_CHAIN_PREFIX = "felix-"
+
+# Operations returned by diff_rules, named after the iptables commands.
+OP_INSERT  = "-I"
+OP_REPLACE = "-R"
+OP_DELETE  = "-D"
+
+
+def is_felix_chain(name):
+    """
+    Returns True if the named chain is owned by Felix.
+    """
+    return name.startswith(FELIX_CHAIN_PREFIX)
+
+
+def rule_target(spec):
+    """
+    Returns the target (the value of "-j") of a rule spec, or None if the
+    rule has no target.
+    """
+    words = spec.split()
+    try:
+        return words[words.index("-j") + 1]
+    except (ValueError, IndexError):
+        return None
+
+
+class TableState(object):
+    """
+    The state of the Felix-owned chains in a single iptables table.
+
+    The state is changed by applying iptables-restore lines to it (see
+    apply), so that exactly the lines written to the kernel can be used to
+    keep the model up to date.
+
+    An index is kept of the rules that jump to each Felix chain, so that the
+    rules jumping to an endpoint's chains can be found without scanning the
+    chains that contain them. Rules in chains not owned by Felix (such as
+    INPUT) are not modelled, but appending, inserting or deleting (by spec)
+    one of them that jumps to a Felix chain does update the index.
+
+    If a line cannot be applied because it refers to a rule that is not in
+    the model, the model no longer matches the kernel; it is marked stale, so
+    that it is loaded from the kernel again (see fiptables.get_state).
+    """
+    def __init__(self):
+        # Dictionary mapping chain name to list of rule specs.
+        self.chains = {}
+
+        # Dictionary mapping a Felix chain name to the list of (chain name,
+        # rule spec) pairs for the rules that jump to it.
+        self.jumps = {}
+
+        # Whether the model has been found not to match the kernel.
+        self.stale = False
+
+    def has_chain(self, name):
+        return name in self.chains
+
+    def jumps_to(self, target):
+        """
+        Returns the list of (chain name, rule spec) pairs for the rules that
+        jump to the named chain.
+        """
+        return list(self.jumps.get(target, []))
+
+    def rules(self, name):
+        """
+        Returns the list of rule specs in a chain, which is empty if the chain
+        does not exist. The caller must not modify the list.
+        """
+        return self.chains.get(name, [])
+
+    def apply(self, line):
+        """
+        Update the state with a single iptables-restore line, such as
+        ":felix-to-1234 - [0:0]" or "-D felix-INPUT 3".
+        """
+        words = line.split()
+
+        if not words:
+            return
+
+        if words[0].startswith(":"):
+            # A chain declaration, which creates the chain or empties it.
+            name = words[0][1:]
+            if is_felix_chain(name):
+                self._unindex_chain(name)
+                self.chains[name] = []
+            return
+
+        op   = words[0]
+        name = words[1]
+        if not is_felix_chain(name):
+            self._apply_unowned(op, name, words[2:])
+            return
+
+        # Rule numbers in iptables are 1-based.
+        if len(words) > 2 and words[2].isdigit():
+            index = int(words[2]) - 1
+            spec  = " ".join(words[3:])
+        else:
+            index = None
+            spec  = " ".join(words[2:])
+
+        rules = self.chains.setdefault(name, [])
+
+        if op in ("-R", "-D"):
+            # The rule being replaced or deleted must be in the model.
+            if ((index is not None and index >= len(rules)) or
+                    (index is None and spec not in rules)):
+                log.warning("Rule not in model of chain %s for "
+                            "iptables-restore line : %s" % (name, line))
+                self.stale = True
+                return
+
+        if op == "-A":
+            rules.append(spec)
+            self._index(name, spec)
+        elif op == "-I":
+            rules.insert(index or 0, spec)
+            self._index(name, spec)
+        elif op == "-R":
+            self._unindex(name, rules[index])
+            rules[index] = spec
+            self._index(name, spec)
+        elif op == "-D":
+            if index is not None:
+                spec = rules.pop(index)
+            else:
+                rules.remove(spec)
+            self._unindex(name, spec)
+        elif op == "-F":
+            self._unindex_chain(name)
+            del rules[:]
+        elif op == "-X":
+            self._unindex_chain(name)
+            del self.chains[name]
+        else:
+            log.warning("Ignoring unexpected iptables-restore line : %s" %
+                        line)
+
+    def _apply_unowned(self, op, name, words):
+        """
+        Update the index of jump rules for a line that refers to a chain not
+        owned by Felix.
+        """
+        if words and words[0].isdigit():
+            if op == "-I":
+                words = words[1:]
+            else:
+                # Changes by position cannot be tracked, since the rules in
+                # the chain are not modelled.
+                return
+        spec = " ".join(words)
+
+        if op in ("-A", "-I"):
+            self._index(name, spec)
+        elif op == "-D":
+            self._unindex(name, spec)
+        elif op in ("-F", "-X"):
+            for target in list(self.jumps):
+                for chain_name, spec in self.jumps_to(target):
+                    if chain_name == name:
+                        self._unindex(chain_name, spec)
+
+    def _index(self, name, spec):
+        target = rule_target(spec)
+        if target is not None and is_felix_chain(target):
+            self.jumps.setdefault(target, []).append((name, spec))
+
+    def _unindex(self, name, spec):
+        target = rule_target(spec)
+        if (name, spec) in self.jumps.get(target, []):
+            self.jumps[target].remove((name, spec))
+            if not self.jumps[target]:
+                del self.jumps[target]
+
+    def _unindex_chain(self, name):
+        for spec in self.chains.get(name, []):
+            self._unindex(name, spec)
+
+
+def parse_save(data):
+    """
+    Parse the output of iptables-save (for a single table) into a TableState,
+    keeping only the chains that Felix owns.
+    """
+    state = TableState()
+
+    for line in data.split("\n"):
+        line = line.strip()
+        if line.startswith(":") or line.startswith("-A "):
+            state.apply(line)
+
+    return state
+
+
+def diff_rules(current, desired):
+    """
+    Works out the changes needed to turn one list of rule specs into another,
+    changing as few rules as possible. If the lists are the same, there are no
+    changes.
+
+    Returns a list of (op, position, index) tuples, to be applied in order.
+    *op* is one of OP_INSERT, OP_REPLACE or OP_DELETE; *position* is the
+    (1-based) rule number to insert at, replace or delete; *index* is the
+    index in *desired* of the new rule, or None for a delete.
+    """
+    ops = []
+    matcher = difflib.SequenceMatcher(None, current, desired, autojunk=False)
+
+    #*************************************************************************#
+    #* Work backwards through the differences, so that making each change    *#
+    #* does not alter the positions of the rules that the earlier changes    *#
+    #* refer to.                                                             *#
+    #*************************************************************************#
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+
+        # Replace as many rules as we can in place.
+        common = min(i2 - i1, j2 - j1)
+        for offset in range(common):
+            ops.append((OP_REPLACE, i1 + offset + 1, j1 + offset))
+
+        # Delete any surplus current rules, last first.
+        for posn in range(i2, i1 + common, -1):
+            ops.append((OP_DELETE, posn, None))
+
+        # Insert any extra desired rules.
+        for offset in range(common, j2 - j1):
+            ops.append((OP_INSERT, i1 + offset + 1, j1 + offset))
+
+    return ops
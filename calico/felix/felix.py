@@ -24,6 +24,7 @@ The main logic for Felix.
 import argparse
 import collections
 import logging
+import math
 import socket
 import time
 import uuid
@@ -32,7 +33,12 @@ import zmq
 from calico.felix.config import Config
 from calico.felix.endpoint import Address, Endpoint
 from calico.felix.fsocket import Socket, Message
+from calico.felix import finterface
+from calico.felix import fnetlink
 from calico.felix import frules
+from calico.felix import fstats
+from calico.felix import ftimers
+from calico.felix import fworker
 from calico.felix import futils
 from calico import common
 
@@ -44,6 +50,19 @@ RC_SUCCESS  = "SUCCESS"
 RC_INVALID  = "INVALID"
 RC_NOTEXIST = "NOTEXIST"
 
+# Names of the timers for periodic work. Each socket also has a timer for
+# checking whether it has timed out, named (TIMER_SOCKET, socket type), and
+# each endpoint waiting to be retried a timer named (TIMER_RETRY, UUID).
+TIMER_RESYNC = "resync"
+TIMER_RETRY  = "retry"
+TIMER_STATS  = "stats"
+TIMER_ACLS   = "acls"
+TIMER_SOCKET = "socket"
+
+# The worker makes the route changes for the endpoints it has programmed
+# whenever it runs out of jobs, and at least this often when it does not.
+ROUTE_BATCH_MAX_JOBS = 50
+
 
 class FelixAgent(object):
     """
@@ -69,9 +88,24 @@ class FelixAgent(object):
         # We have restarted and set up logs - tell the world.
         log.error("Felix starting")
 
+        # Select how endpoint rules are programmed.
+        frules.set_iptables_backend(self.config.IPTABLES_BACKEND)
+        frules.set_dispatch_mode(self.config.DISPATCH_MODE)
+        frules.set_shared_ipsets(self.config.SHARED_IPSETS)
+        futils.set_use_sessions(self.config.COMMAND_SESSIONS)
+        finterface.set_route_backend(self.config.ROUTE_BACKEND)
+
         # The ZeroMQ context for this Felix.
         self.zmq_context = zmq.Context()
 
+        # The poller for the sockets owned by this Felix. Each socket is
+        # registered when it is created (or recreated).
+        self.poller = zmq.Poller()
+
+        # Timers for the work done periodically by the main loop, which waits
+        # for socket activity only until the next timer is due.
+        self.timers = ftimers.TimerHeap()
+
         # The hostname of the machine on which this Felix is running.
         self.hostname = socket.gethostname()
 
@@ -81,9 +115,77 @@ class FelixAgent(object):
         # The endpoints managed by this Felix, keyed off their UUID.
         self.endpoints = {}
 
-        # Set of UUIDs of endpoints that need to be retried (the tap interface
-        # did not exist when the ENDPOINTCREATED was received).
-        self.ep_retry = set()
+        # Endpoints that need to be retried (the tap interface did not exist
+        # when the ENDPOINTCREATED was received, or programming failed), as a
+        # dictionary mapping UUID to the number of failed attempts. Each is
+        # retried when its retry timer is due; the delay doubles with each
+        # failed attempt, up to a maximum, so that an endpoint that keeps
+        # failing does not use up CPU and fill the log.
+        self.ep_retry = {}
+
+        # Watcher for interfaces being created, so that endpoints are retried
+        # as soon as their tap interface appears. Without it, all the
+        # endpoints that need to be retried are retried only when their retry
+        # timers are due.
+        try:
+            self.link_watcher = fnetlink.LinkWatcher()
+            self.poller.register(self.link_watcher, zmq.POLLIN)
+        except socket.error:
+            log.exception("Unable to watch for interfaces being created")
+            self.link_watcher = None
+
+        # Dictionary mapping the UUID of each endpoint whose ACLs have
+        # changed, but not yet been passed to the worker, to its latest ACLs.
+        # ACLUPDATEs just record the latest ACLs here; they are passed to the
+        # worker together once the ACL timer is due, so that several updates
+        # for an endpoint in quick succession are programmed only once.
+        # acl_collapsed counts the updates that have been superseded in this
+        # way.
+        self.acl_dirty     = {}
+        self.acl_collapsed = 0
+
+        #*********************************************************************#
+        #* All programming of the dataplane (iptables, ipsets, interfaces    *#
+        #* and routes) is done by jobs on a worker thread, so that requests  *#
+        #* are answered without waiting for it. Jobs run in the order in     *#
+        #* which they are queued, so the changes for each endpoint are made  *#
+        #* in order. The worker passes back which endpoints it programmed    *#
+        #* and which failed and need to be retried.                          *#
+        #*                                                                   *#
+        #* Endpoint objects are changed by the worker, so that they are not  *#
+        #* changed under it while it programs them; new endpoint data and    *#
+        #* ACLs are passed to it with the jobs that program them. The        *#
+        #* exceptions are pending_resync and revision, which the main thread *#
+        #* sets (when resyncing, and when the worker reports the revision it *#
+        #* programmed). That is safe because those fields are only used on   *#
+        #* the main thread; the worker never reads them.                     *#
+        #*********************************************************************#
+        self.worker = fworker.Worker(self.apply_routes,
+                                     idle_every=ROUTE_BATCH_MAX_JOBS)
+        self.poller.register(self.worker, zmq.POLLIN)
+
+        # Route changes for the endpoints programmed by the worker, which are
+        # made together whenever it runs out of jobs (or has run
+        # ROUTE_BATCH_MAX_JOBS jobs), the endpoints programmed successfully
+        # since then (as a dictionary mapping UUID to the revision of the
+        # data programmed) and the UUIDs of those programmed unsuccessfully.
+        # These are only used on the worker thread.
+        self.route_batch = finterface.RouteBatch()
+        self.ep_programmed = {}
+        self.ep_failed     = set()
+
+        # With the restore iptables backend, the rules for those endpoints
+        # are programmed together at the same time, in a single
+        # iptables-restore per table; otherwise they are programmed one
+        # endpoint at a time. Again only used on the worker thread.
+        if self.config.IPTABLES_BACKEND == frules.IPTABLES_BACKEND_RESTORE:
+            self.rule_batch = frules.RuleBatch()
+        else:
+            self.rule_batch = None
+
+        # Counts of endpoints programmed and failures, for statistics.
+        self.ep_program_count = 0
+        self.ep_failure_count = 0
 
         # Properties for handling resynchronization.
         #
@@ -102,14 +204,18 @@ class FelixAgent(object):
         # response. This is None if that response has not yet been received.
         self.resync_expected = None
 
-        # resync_time is always defined once the first resync has been sent. It
-        # is the time, in integer milliseconds since the epoch, of the sending
-        # of the last resync. This is used to detect when it is time for
-        # another resync.  Note that integers in python automatically convert
-        # from 32 to 64 bits when they are too large, and so we do not have to
-        # worry about overflowing for many thousands of years yet.
+        # resync_time is always defined once the first resync has completed.
+        # It is the time, in integer milliseconds since the epoch, at which
+        # the last resync completed. The next resync is started by the resync
+        # timer.  Note that integers in python automatically convert from 32
+        # to 64 bits when they are too large, and so we do not have to worry
+        # about overflowing for many thousands of years yet.
         self.resync_time = None
 
+        # Write statistics for external calls to the log now and then.
+        if self.config.STATS_INT_SEC:
+            self.timers.schedule(TIMER_STATS, self.config.STATS_INT_SEC)
+
         # Build a dispatch table for handling various messages.
         self.handlers = {
             Message.TYPE_HEARTBEAT: self.handle_heartbeat,
@@ -118,14 +224,24 @@ class FelixAgent(object):
             Message.TYPE_EP_RM: self.handle_endpointdestroyed,
             Message.TYPE_RESYNC: self.handle_resyncstate,
             Message.TYPE_GET_ACL: self.handle_getaclstate,
+            Message.TYPE_GET_ACLS: self.handle_getaclstates,
             Message.TYPE_ACL_UPD: self.handle_aclupdate,
         }
 
         # Message queues for our request sockets. These exist because we can
-        # only ever have one request outstanding.
+        # only ever have one request outstanding (or, for ACL requests, a
+        # window of requests).
         self.endpoint_queue = collections.deque()
         self.acl_queue = collections.deque()
 
+        # IDs of endpoints whose ACL state is to be requested in a single bulk
+        # request (at the end of this time round the main loop), rather than
+        # one request each, which is done for ACL resyncs and for the
+        # endpoints created by endpoint resyncs. bulk_acls is cleared if the
+        # ACL manager turns out not to support bulk requests.
+        self.acl_requests = []
+        self.bulk_acls    = True
+
         # Initiate our connections.
         self.connect_to_plugin()
         self.connect_to_acl_manager()
@@ -143,7 +259,9 @@ class FelixAgent(object):
         for type in Socket.EP_TYPES:
             sock = Socket(type, self.config)
             sock.communicate(self.hostname, self.zmq_context)
+            self.poller.register(sock._zmq, zmq.POLLIN)
             self.sockets[type] = sock
+            self.schedule_timeout(sock)
 
     def connect_to_acl_manager(self):
         """
@@ -153,15 +271,28 @@ class FelixAgent(object):
         for type in Socket.ACL_TYPES:
             sock = Socket(type, self.config)
             sock.communicate(self.hostname, self.zmq_context)
+            self.poller.register(sock._zmq, zmq.POLLIN)
             self.sockets[type] = sock
+            self.schedule_timeout(sock)
+
+    def schedule_timeout(self, sock):
+        """
+        Schedule the check for a socket having timed out, which is when it
+        will have been inactive for the connection timeout unless there is
+        further activity on it first.
+        """
+        self.timers.schedule_at(
+            (TIMER_SOCKET, sock.type),
+            (sock.last_activity + self.config.CONN_TIMEOUT_MS + 1) / 1000.0)
 
     def send_request(self, message, socket_type):
         """
         Sends a request on a given socket type.
 
         This is used to handle the fact that we cannot have multiple
-        outstanding requests on a given socket. It attempts to send the message
-        immediately, and if it cannot it queues it.
+        outstanding requests on a given socket (beyond the window, for ACL
+        requests). It attempts to send the message immediately, and if it
+        cannot it queues it.
         """
         assert socket_type in Socket.REQUEST_TYPES
 
@@ -180,6 +311,11 @@ class FelixAgent(object):
         """
         This function is called to resync all endpoint state, both periodically
         and during initialisation.
+
+        The revision of each endpoint we hold is sent with the request, so that
+        the plugin only sends the endpoints that are new or have changed (and
+        lists those that have been deleted). A plugin that does not support
+        this just sends all the endpoints.
         """
         self.resync_id       = str(uuid.uuid4())
         self.resync_recd     = 0
@@ -187,6 +323,14 @@ class FelixAgent(object):
 
         log.info("Do total resync - ID : %s" % self.resync_id)
 
+        # Reload our snapshot of the iptables and ipset state, in case it has
+        # drifted from what is really programmed.
+        self.worker.queue(frules.load_inventory)
+
+        # Take a snapshot of the routes, so that programming each endpoint
+        # during the resync does not have to read the routes to its tap.
+        self.worker.queue(finterface.load_routes)
+
         # Mark all the endpoints as expecting to be resynchronized.
         for ep in self.endpoints.values():
             ep.pending_resync = True
@@ -202,6 +346,8 @@ class FelixAgent(object):
             'resync_id': self.resync_id,
             'issued': time.time() * 1000,
             'hostname': self.hostname,
+            'endpoints': {uuid: ep.revision
+                          for uuid, ep in self.endpoints.iteritems()},
         }
         self.send_request(
             Message(Message.TYPE_RESYNC, fields),
@@ -215,16 +361,44 @@ class FelixAgent(object):
         # ACL resynchronization involves requesting ACLs for all endpoints
         # for which we have an ID.
         self.acl_queue.clear()
+        self.acl_requests = self.endpoints.keys()
+        self.request_acls()
+
+    def request_acl(self, endpoint_id):
+        """
+        Requests the ACL state for a single endpoint.
+        """
+        fields = {
+            'endpoint_id': endpoint_id,
+            'issued': time.time() * 1000,
+        }
+        self.send_request(
+            Message(Message.TYPE_GET_ACL, fields),
+            Socket.TYPE_ACL_REQ
+        )
 
-        for endpoint_id, endpoint in self.endpoints.iteritems():
+    def request_acls(self):
+        """
+        Requests the ACL state for the endpoints in acl_requests, in a single
+        request if the ACL manager supports that.
+        """
+        if not self.acl_requests:
+            return
+
+        if self.bulk_acls:
             fields = {
-                'endpoint_id': endpoint_id,
+                'endpoint_ids': self.acl_requests,
                 'issued': time.time() * 1000,
             }
             self.send_request(
-                Message(Message.TYPE_GET_ACL, fields),
+                Message(Message.TYPE_GET_ACLS, fields),
                 Socket.TYPE_ACL_REQ
             )
+        else:
+            for endpoint_id in self.acl_requests:
+                self.request_acl(endpoint_id)
+
+        self.acl_requests = []
 
     def complete_endpoint_resync(self, successful):
         """
@@ -236,6 +410,11 @@ class FelixAgent(object):
         self.resync_expected = None
         self.resync_time     = int(time.time() * 1000)
 
+        # Outside a resync, routes are read for each endpoint as needed.
+        self.worker.queue(finterface.clear_routes)
+
+        self.timers.schedule(TIMER_RESYNC, self.config.RESYNC_INT_SEC)
+
         if successful:
             for uuid in self.endpoints.keys():
                 ep = self.endpoints[uuid]
@@ -243,17 +422,48 @@ class FelixAgent(object):
                     log.info(
                         "Remove endpoint %s that is no longer being managed" %
                         ep.uuid)
-                    ep.remove()
-                    del self.endpoints[ep]
+                    self.worker.queue(ep.remove, self.rule_batch)
+                    del self.endpoints[uuid]
+                    self.cancel_retry(uuid)
 
-        #*********************************************************************#
-        #* Now remove rules for any endpoints that should no longer          *#
-        #* exist. This method returns a set of endpoint suffices.            *#
-        #*********************************************************************#
+        # Now remove rules for any endpoints that should no longer exist.
         known_ids = {ep.suffix for ep in self.endpoints.values()}
+        self.worker.queue(self.remove_stale_rules, known_ids)
+
+        # Repair any endpoints whose ipsets have gone missing. Those waiting
+        # to be retried are programmed in full when they are.
+        self.worker.queue(self.repair_endpoints,
+                          [ep for uuid, ep in self.endpoints.iteritems()
+                           if uuid not in self.ep_retry])
+
+    def repair_endpoints(self, endpoints):
+        """
+        Reprogram those of a list of endpoints whose ipsets are missing from
+        the inventory reloaded by the resync, for example because they were
+        destroyed from outside Felix. Runs on the worker thread.
+
+        An endpoint whose own ipsets are missing is programmed again in full.
+        Otherwise its ACLs are programmed again only if the ipsets holding
+        them are missing (see Endpoint.update_acls); the ACLs of all the other
+        endpoints are as they were last programmed, so are left alone.
+        """
+        for endpoint in endpoints:
+            if (frules.ep_ipsets_exist(endpoint.suffix, futils.IPV4) and
+                    frules.ep_ipsets_exist(endpoint.suffix, futils.IPV6)):
+                self.update_acls(endpoint)
+            else:
+                log.info("Reprogram endpoint %s with missing ipsets" %
+                         endpoint.suffix)
+                self.program_endpoint(endpoint)
 
+    def remove_stale_rules(self, known_ids):
+        """
+        Remove the rules for any endpoint whose suffix is not in the set of
+        known endpoint suffixes. Runs on the worker thread.
+        """
         for type in [futils.IPV4, futils.IPV6]:
             rule_ids  = frules.list_eps_with_rules(type)
+            stale_ids = []
 
             for id in rule_ids:
                 if id not in known_ids:
@@ -261,7 +471,10 @@ class FelixAgent(object):
                     # exist.  Remove those rules.
                     log.warning("Removing %s rules for removed object %s" %
                                 (type, id))
-                    frules.del_rules(id, type)
+                    stale_ids.append(id)
+
+            if stale_ids:
+                frules.del_rules_batch(stale_ids, type)
 
     def handle_endpointcreated(self, message):
         """
@@ -406,7 +619,9 @@ class FelixAgent(object):
         sock = self.sockets[Socket.TYPE_ACL_SUB]
         sock._zmq.setsockopt(zmq.UNSUBSCRIBE, delete_id.encode('utf-8'))
 
-        endpoint.remove()
+        self.cancel_retry(delete_id)
+        self.acl_dirty.pop(delete_id, None)
+        self.worker.queue(endpoint.remove, self.rule_batch)
 
         # Send a message indicating our success.
         sock = self.sockets[Socket.TYPE_EP_REP]
@@ -436,6 +651,10 @@ class FelixAgent(object):
         If the response is an error, abandon the resync. Otherwise, if we
         expect no endpoints we're done. Otherwise, set the expected number of
         endpoints.
+
+        An incremental response counts only the endpoints that are new or have
+        changed, which are all that the plugin sends, and lists the endpoints
+        that have been deleted; all our other endpoints are unchanged.
         """
         log.debug("Received resync response: %s", message.fields)
 
@@ -450,6 +669,16 @@ class FelixAgent(object):
             self.complete_endpoint_resync(False)
             return
 
+        if message.fields.get('incremental'):
+            # Only the deleted endpoints are left to be removed when the
+            # resync completes.
+            deleted = set(message.fields.get('deleted', []))
+            log.info("Incremental resync : %s changed, %d deleted" %
+                     (endpoint_count, len(deleted)))
+            for uuid, ep in self.endpoints.iteritems():
+                if uuid not in deleted:
+                    ep.pending_resync = False
+
         # If there are no endpoints to expect, or we got this after all the
         # resyncs, then we're done.
         if not endpoint_count or endpoint_count == self.resync_recd:
@@ -483,6 +712,33 @@ class FelixAgent(object):
 
         return
 
+    def handle_getaclstates(self, message):
+        """
+        Handles a GETACLSTATES (bulk GETACLSTATE) response.
+
+        An ACL manager that does not support bulk requests refuses them,
+        echoing the request; in that case, request the ACL state for each
+        endpoint separately, and do so from now on.
+        """
+        log.debug("Received GETACLSTATES response: %s", message.fields)
+
+        return_code = message.fields['rc']
+        return_str = message.fields['message']
+
+        if return_code != RC_SUCCESS:
+            log.error("Bulk ACL state request refused with rc : %s, %s",
+                      return_code,
+                      return_str)
+
+            if 'endpoint_ids' in message.fields:
+                log.warning("Requesting ACL state one endpoint at a time")
+                self.bulk_acls = False
+                for endpoint_id in message.fields['endpoint_ids']:
+                    if endpoint_id in self.endpoints:
+                        self.request_acl(endpoint_id)
+
+        return
+
     def handle_aclupdate(self, message):
         """
         Handles ACLUPDATE publications.
@@ -501,13 +757,15 @@ class FelixAgent(object):
                       endpoint_id)
             return
 
-        endpoint.acl_data  = message.fields['acls']
-
-        if endpoint.uuid in self.ep_retry:
-            log.debug("Holding ACLs for endpoint %s that is pending retry" %
+        if endpoint.uuid in self.acl_dirty:
+            log.debug("ACLs for endpoint %s replace ACLs not yet programmed" %
                       endpoint.suffix)
-        else:
-            endpoint.update_acls()
+            self.acl_collapsed += 1
+        elif not self.timers.is_scheduled(TIMER_ACLS):
+            self.timers.schedule(TIMER_ACLS,
+                                 self.config.ACL_FLUSH_MS / 1000.0)
+
+        self.acl_dirty[endpoint.uuid] = message.fields['acls']
 
         return
 
@@ -532,15 +790,12 @@ class FelixAgent(object):
         sock = self.sockets[Socket.TYPE_ACL_SUB]
         sock._zmq.setsockopt(zmq.SUBSCRIBE, endpoint_id.encode('utf-8'))
 
-        # Having subscribed, we can now request ACL state for this endpoint.
-        fields = {
-            'endpoint_id': endpoint_id,
-            'issued': time.time() * 1000,
-        }
-        self.send_request(
-            Message(Message.TYPE_GET_ACL, fields),
-            Socket.TYPE_ACL_REQ
-        )
+        # Having subscribed, we can now request ACL state for this endpoint;
+        # during a resync, this is done in bulk.
+        if self.resync_id is not None:
+            self.acl_requests.append(endpoint_id)
+        else:
+            self.request_acl(endpoint_id)
 
         return endpoint
 
@@ -573,37 +828,174 @@ class FelixAgent(object):
             raise InvalidRequest("Invalid state %s for endpoint %s" %
                                  (state, endpoint.uuid))
 
-        endpoint.addresses = addresses
-
-        endpoint.mac   = mac.encode('ascii')
-        endpoint.state = state.encode('ascii')
-
-        # Program the endpoint - i.e. set things up for it.
+        # Program the endpoint - i.e. set things up for it. The worker makes
+        # the change to the endpoint's data, and passes back whether
+        # programming it succeeded; if it did, the endpoint takes the
+        # plugin's revision of the data (if it sends one), and if it failed,
+        # the endpoint is put on the retry list.
         log.debug("Program %s" % endpoint.suffix)
-        if endpoint.program_endpoint():
-            # Failed to program this endpoint - put on the retry list.
-            self.ep_retry.add(endpoint.uuid)
+        data = (frozenset(addresses),
+                mac.encode('ascii'),
+                state.encode('ascii'),
+                fields.get('revision'))
+        self.worker.queue(self.program_endpoint, endpoint, data)
 
         return
 
+    def program_endpoint(self, endpoint, data=None):
+        """
+        Program an endpoint, noting whether it succeeded. Runs on the worker
+        thread.
+
+        *data*, if given, is the endpoint's new (addresses, mac, state,
+        revision), which is set before programming it. Retries pass no data,
+        and program the endpoint as it was last set.
+        """
+        if data is not None:
+            (endpoint.addresses, endpoint.mac, endpoint.state,
+             endpoint.data_revision) = data
+
+        try:
+            failed = endpoint.program_endpoint(self.route_batch,
+                                              self.rule_batch)
+        except (futils.FailedSystemCall, fnetlink.NetlinkError):
+            # Put the endpoint on the retry list rather than stopping the
+            # worker, which would stop Felix.
+            log.exception("Failed to program endpoint %s" % endpoint.suffix)
+            failed = True
+
+        if failed:
+            self.ep_programmed.pop(endpoint.uuid, None)
+            self.ep_failed.add(endpoint.uuid)
+        else:
+            self.ep_failed.discard(endpoint.uuid)
+            self.ep_programmed[endpoint.uuid] = endpoint.data_revision
+
+    def update_acls(self, endpoint, acls=None, force=False):
+        """
+        Set an endpoint's ACLs, if *acls* is given, and program them (see
+        Endpoint.update_acls). Runs on the worker thread.
+
+        If programming the ACLs fails, the endpoint is retried; programming
+        it programs its ACLs again.
+        """
+        if acls is not None:
+            endpoint.acl_data = acls
+
+        try:
+            endpoint.update_acls(force)
+        except (futils.FailedSystemCall, fnetlink.NetlinkError):
+            log.exception("Failed to program ACLs for endpoint %s" %
+                          endpoint.suffix)
+            self.ep_programmed.pop(endpoint.uuid, None)
+            self.ep_failed.add(endpoint.uuid)
+
+    def apply_routes(self):
+        """
+        Make the rule (with the restore iptables backend) and route changes
+        for the endpoints programmed since this was last called. Runs on the worker thread whenever it runs out of jobs,
+        and after every ROUTE_BATCH_MAX_JOBS jobs.
+
+        Returns a (programmed, failed) pair, or None if no endpoints have been
+        programmed. programmed is a dictionary mapping the UUID of each
+        endpoint whose programming (including routes) succeeded to the
+        revision of the data programmed, and failed is the set of UUIDs of
+        those whose programming failed.
+        """
+        if not (self.ep_programmed or self.ep_failed):
+            return None
+
+        failed = set(self.ep_failed)
+        if self.rule_batch is not None:
+            failed |= self.rule_batch.apply()
+        failed |= self.route_batch.apply()
+
+        programmed = dict((uuid, revision)
+                          for uuid, revision in self.ep_programmed.iteritems()
+                          if uuid not in failed)
+
+        self.ep_programmed = {}
+        self.ep_failed     = set()
+
+        return (programmed, failed)
+
+    def retry_later(self, uuid):
+        """
+        Record a failed attempt to program an endpoint, and schedule the next
+        attempt.
+        """
+        attempts = self.ep_retry.get(uuid, 0) + 1
+        self.ep_retry[uuid] = attempts
+
+        delay = min(self.config.EP_RETRY_INT_MS << min(attempts - 1, 32),
+                    self.config.EP_RETRY_MAX_INT_MS)
+        self.timers.schedule((TIMER_RETRY, uuid), delay / 1000.0)
+
+        if attempts > 1:
+            log.debug("Retry %s after %d failed attempts in %dms" %
+                      (uuid, attempts, delay))
+
+    def retry_soon(self, uuid):
+        """
+        Reset the backoff of an endpoint on the retry list, and retry it the
+        next time round the main loop. Done when its ACLs change, since they
+        are only programmed once it is.
+        """
+        if uuid in self.ep_retry:
+            self.ep_retry[uuid] = 0
+            self.timers.schedule((TIMER_RETRY, uuid), 0)
+
+    def cancel_retry(self, uuid):
+        """
+        Take an endpoint off the retry list, resetting its backoff.
+        """
+        if self.ep_retry.pop(uuid, None) is not None:
+            self.timers.cancel((TIMER_RETRY, uuid))
+
     def run(self):
         """
         Executes the main agent loop.
         """
         # Set up the global rules.
-        frules.set_global_rules(self.config)
+        self.worker.queue(frules.set_global_rules, self.config)
 
         while True:
-            # Issue a poll request on all active sockets.
+            # Issue a poll request on all active sockets, waiting no longer
+            # than until the next timer is due.
             endpoint_resync_needed = False
             acl_resync_needed = False
 
-            lPoller = zmq.Poller()
-            for sock in self.sockets.values():
-                # Easier just to poll all sockets, even if we expect nothing.
-                lPoller.register(sock._zmq, zmq.POLLIN)
+            timeout = self.timers.timeout()
+            if timeout is not None:
+                timeout = int(math.ceil(timeout * 1000))
+
+            polled_sockets = dict(self.poller.poll(timeout))
+            due = self.timers.pop_due()
+
+            # Find out which interfaces have been created or changed; None
+            # means that we do not know, and must assume any might have been.
+            if (self.link_watcher is not None and
+                    self.link_watcher in polled_sockets):
+                new_taps = self.link_watcher.read_links()
+            else:
+                new_taps = set()
+
+            # Put the endpoints that the worker failed to program on the retry
+            # list, and take those it programmed off it, noting the revision
+            # of the data programmed.
+            if self.worker in polled_sockets:
+                for programmed, failed in self.worker.results():
+                    self.ep_program_count += len(programmed)
+                    self.ep_failure_count += len(failed)
 
-            polled_sockets = dict(lPoller.poll(self.config.EP_RETRY_INT_MS))
+                    for uuid in failed:
+                        if uuid in self.endpoints:
+                            self.retry_later(uuid)
+
+                    for uuid, revision in programmed.iteritems():
+                        if uuid in self.endpoints:
+                            self.endpoints[uuid].revision = revision
+                        self.cancel_retry(uuid)
 
             # Get all the sockets with activity.
             active_sockets = (
@@ -612,20 +1004,37 @@ class FelixAgent(object):
                 and polled_sockets[s._zmq] == zmq.POLLIN
             )
 
-            # For each active socket, pull the message off and handle it.
+            #*****************************************************************#
+            #* For each active socket, pull the messages off and handle      *#
+            #* them. Only so many are handled from each socket, so that the  *#
+            #* rest of the work in the loop is not held up for too long by a *#
+            #* flood of messages.                                            *#
+            #*****************************************************************#
             for sock in active_sockets:
-                message = sock.receive()
+                for count in xrange(self.config.MAX_MSGS_PER_POLL):
+                    if count > 0 and not sock.readable():
+                        break
+
+                    message = sock.receive()
 
-                if message is not None:
-                    self.handlers[message.type](message)
+                    if message is not None:
+                        self.handlers[message.type](message)
+
+            # Request in one go the ACL state for any endpoints created by an
+            # endpoint resync in the messages just handled.
+            self.request_acls()
 
             for sock in self.sockets.values():
                 # See if anything else is required on this socket. First, check
-                # whether any have timed out.
+                # whether any have timed out, for those whose timer is due.
                 # A timed out socket needs to be reconnected. Also, whatever
                 # API it belongs to needs to be resynchronised.
+                if (TIMER_SOCKET, sock.type) not in due:
+                    continue
+
                 if sock.timed_out():
                     log.warning("Socket %s timed out", sock.type)
+                    self.poller.unregister(sock._zmq)
                     sock.close()
 
                     #*********************************************************#
@@ -648,6 +1057,9 @@ class FelixAgent(object):
 
                     # Finally, recreate the socket.
                     sock.communicate(self.hostname, self.zmq_context)
+                    self.poller.register(sock._zmq, zmq.POLLIN)
+
+                self.schedule_timeout(sock)
 
             # If we have any queued messages to send, we should do so.
             endpoint_socket = self.sockets[Socket.TYPE_EP_REQ]
@@ -658,13 +1070,15 @@ class FelixAgent(object):
                 message = self.endpoint_queue.pop()
                 endpoint_socket.send(message)
 
-            if len(self.acl_queue) and not acl_socket.request_outstanding:
+            # Several ACL requests can be outstanding at once.
+            while len(self.acl_queue) and not acl_socket.request_outstanding:
                 message = self.acl_queue.pop()
                 acl_socket.send(message)
 
             # Now, check if we need to resynchronize and do it.
-            if (self.resync_id is None and
-                    (time.time() - self.resync_time > self.config.RESYNC_INT_SEC)):
+            # If a resync is still in progress, the timer is set again when it
+            # completes.
+            if self.resync_id is None and TIMER_RESYNC in due:
                 # Time for a total resync of all endpoints
                 endpoint_resync_needed = True
 
@@ -681,26 +1095,55 @@ class FelixAgent(object):
                 self.resync_acls()
 
             #*****************************************************************#
-            #* Finally, retry any endpoints which need retrying. We remove   *#
-            #* them from ep_retry if they no longer exist or if the retry    *#
-            #* succeeds; the simplest way to do this is to copy the list,    *#
-            #* clear ep_retry then add them back if necessary.               *#
+            #* Finally, retry any endpoints which need retrying, which are   *#
+            #* those whose retry timer is due and those waiting for a tap    *#
+            #* interface that has now appeared (or all of them, if we cannot *#
+            #* tell which have). We remove them from ep_retry if they no     *#
+            #* longer exist, or once the worker has programmed them          *#
+            #* successfully (including their routes), which resets their     *#
+            #* backoff. Programming the endpoint also applies its ACLs.      *#
             #*****************************************************************#
-            retry_list = list(self.ep_retry)
-            self.ep_retry.clear()
+            retry_list = [uuid for uuid in self.ep_retry
+                          if (TIMER_RETRY, uuid) in due or
+                          new_taps is None or
+                          uuid not in self.endpoints or
+                          self.endpoints[uuid].tap in new_taps]
             for uuid in retry_list:
                 if uuid in self.endpoints:
                     endpoint = self.endpoints[uuid]
                     log.debug("Retry program of %s" % endpoint.suffix)
-                    if endpoint.program_endpoint():
-                        # Failed again - put back on list
-                        self.ep_retry.add(uuid)
-                    else:
-                        # Programmed OK, so apply any ACLs we might have.
-                        endpoint.update_acls()
+                    self.worker.queue(self.program_endpoint, endpoint)
                 else:
                     log.debug("No retry programming %s - no longer exists" %
                               uuid)
+                    self.cancel_retry(uuid)
+
+            # Program the ACLs for the endpoints whose ACLs have changed. The
+            # ACLs of an endpoint awaiting retry are held by the worker until
+            # it is programmed, so retry it promptly rather than making the
+            # ACLs wait out its backoff.
+            if TIMER_ACLS in due:
+                for uuid, acls in self.acl_dirty.iteritems():
+                    if uuid in self.endpoints:
+                        self.worker.queue(self.update_acls,
+                                          self.endpoints[uuid], acls)
+                        self.retry_soon(uuid)
+                self.acl_dirty.clear()
+
+            # Write the statistics for external calls to the log now and then.
+            if TIMER_STATS in due:
+                fstats.set_value("Endpoints awaiting retry",
+                                 len(self.ep_retry))
+                fstats.set_value("Endpoints in retry backoff",
+                                 sum(1 for attempts in self.ep_retry.values()
+                                     if attempts > 1))
+                fstats.set_value("ACL updates collapsed", self.acl_collapsed)
+                fstats.set_value("Endpoints programmed", self.ep_program_count)
+                fstats.set_value("Endpoint programming failures",
+                                 self.ep_failure_count)
+                fstats.set_value("Worker jobs queued", self.worker.pending())
+                fstats.log_stats()
+                self.timers.schedule(TIMER_STATS, self.config.STATS_INT_SEC)
 
 
 def main():
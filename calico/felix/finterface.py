@@ -18,16 +18,70 @@ felix.finterface
 
 Utility functions for managing interfaces in Felix.
 """
+import errno
 import logging
 import os
 import re
+import socket
 import time
 
+from calico.felix import fnetlink
 from calico.felix import futils
 
 # Logger
 log = logging.getLogger(__name__)
 
+# Methods of programming routes and ARP entries; either by running "ip"
+# commands, or over an rtnetlink socket.
+ROUTE_BACKEND_IP      = "ip"
+ROUTE_BACKEND_NETLINK = "netlink"
+ROUTE_BACKENDS        = (ROUTE_BACKEND_IP, ROUTE_BACKEND_NETLINK)
+
+# The method in use, and the rtnetlink socket if that is it.
+route_backend = ROUTE_BACKEND_IP
+_netlink      = None
+
+#*****************************************************************************#
+#* Snapshot of the routes to each interface, taken at the start of a resync  *#
+#* so that programming each endpoint does not need to run "ip route list"    *#
+#* for its tap interface. This is a dictionary mapping type to a dictionary  *#
+#* mapping interface name to a tuple of (ifindex, set of addresses with      *#
+#* routes to the interface), or to None if the routes are not known. It is   *#
+#* None if there is no snapshot.                                             *#
+#*                                                                           *#
+#* The ifindex is used to spot interfaces that have been deleted (and maybe  *#
+#* recreated) since the snapshot was taken; deleting an interface deletes    *#
+#* all the routes to it.                                                     *#
+#*****************************************************************************#
+_routes = None
+
+#*****************************************************************************#
+#* Dictionary mapping the name of each tap interface that has been           *#
+#* configured (see configure_tap) to its ifindex at the time, so that it is  *#
+#* not configured again unless it has been deleted and recreated.            *#
+#*****************************************************************************#
+_configured_taps = {}
+
+def set_route_backend(backend):
+    """
+    Select the method used to program routes and ARP entries; one of the
+    ROUTE_BACKEND_* values. If the rtnetlink socket cannot be opened, "ip"
+    commands are used instead.
+    """
+    global route_backend, _netlink
+    assert backend in ROUTE_BACKENDS
+
+    if backend == ROUTE_BACKEND_NETLINK and _netlink is None:
+        try:
+            _netlink = fnetlink.NetlinkSocket()
+        except socket.error:
+            log.exception("Unable to open rtnetlink socket")
+            backend = ROUTE_BACKEND_IP
+
+    log.info("Using %s to program routes" % backend)
+    route_backend = backend
+
+
 def tap_exists(tap):
     """
     Returns True if tap device exists.
@@ -35,10 +89,116 @@ def tap_exists(tap):
     return os.path.exists("/sys/class/net/" + tap)
 
 
+def load_routes():
+    """
+    Take a snapshot of the routes to all interfaces, with a single "ip route
+    list" for each of IPv4 and IPv6. Until clear_routes is called,
+    list_tap_ips uses the snapshot rather than reading the routes for each
+    tap interface.
+    """
+    global _routes
+
+    routes = {}
+    try:
+        for type in (futils.IPV4, futils.IPV6):
+            if type == futils.IPV4:
+                data = futils.check_call(["ip", "route", "list"]).stdout
+            else:
+                data = futils.check_call(["ip", "-6", "route", "list"]).stdout
+
+            routes[type] = {}
+            for line in data.split("\n"):
+                #*************************************************************#
+                #* Example of the lines we care about is :                   *#
+                #* 10.11.2.66 dev tap1234 proto static scope link            *#
+                #* Routes to subnets or via gateways are not interesting.    *#
+                #*************************************************************#
+                words = line.split()
+
+                if "dev" not in words[1:-1]:
+                    continue
+
+                ip  = words[0]
+                tap = words[words.index("dev") + 1]
+                if futils.IPV4_REGEX.match(ip) or futils.IPV6_REGEX.match(ip):
+                    if tap not in routes[type]:
+                        routes[type][tap] = (_ifindex(tap), set())
+                    routes[type][tap][1].add(ip)
+    except futils.FailedSystemCall:
+        log.exception("Failed to read routes; reading them for each "
+                      "interface instead")
+        routes = None
+
+    _routes = routes
+
+
+def clear_routes():
+    """
+    Discard the snapshot of routes taken by load_routes.
+    """
+    global _routes
+    _routes = None
+
+
+def _ifindex(tap):
+    """
+    Returns the ifindex of an interface, or None if it does not exist.
+    """
+    try:
+        with open("/sys/class/net/%s/ifindex" % tap) as f:
+            return int(f.read())
+    except IOError:
+        return None
+
+
+def _snapshot_ips(type, tap):
+    """
+    Returns the set of addresses with routes to an interface according to the
+    snapshot of routes, or None if they are not known. The set is changed in
+    place as routes are added and deleted.
+    """
+    ifindex = _ifindex(tap)
+
+    if tap not in _routes[type]:
+        # There were no routes to the interface when the snapshot was taken.
+        _routes[type][tap] = (ifindex, set())
+
+    entry = _routes[type][tap]
+    if entry is None:
+        return None
+
+    if entry[0] != ifindex:
+        # The interface has been deleted since, and its routes with it.
+        entry = _routes[type][tap] = (ifindex, set())
+
+    return entry[1]
+
+
 def list_tap_ips(type, tap):
     """
     List IP addresses for which there are routes to a given tap interface.
     Returns a set with all addresses for which there is a route to the device.
+
+    If there is a snapshot of routes (see load_routes), it is used rather than
+    reading the routes.
+    """
+    if _routes is not None:
+        ips = _snapshot_ips(type, tap)
+        if ips is not None:
+            return set(ips)
+
+    ips = _read_tap_ips(type, tap)
+
+    if _routes is not None:
+        _routes[type][tap] = (_ifindex(tap), set(ips))
+
+    return ips
+
+
+def _read_tap_ips(type, tap):
+    """
+    Read the IP addresses for which there are routes to a given tap
+    interface, returning them as a set.
     """
     ips = set()
 
@@ -80,24 +240,45 @@ def configure_tap(tap):
 
     Specifically, allow packets from tap interfaces to be directed to
     localhost, and enable proxy ARP.
+
+    Nothing is written if this interface has already been configured.
     """
+    ifindex = _ifindex(tap)
+    if ifindex is not None and _configured_taps.get(tap) == ifindex:
+        log.debug("Tap interface %s already configured" % tap)
+        return
+
     with open('/proc/sys/net/ipv4/conf/%s/route_localnet' % tap, 'wb') as f:
         f.write('1')
 
     with open("/proc/sys/net/ipv4/conf/%s/proxy_arp" % tap, 'wb') as f:
         f.write('1')
 
+    if ifindex is not None:
+        _configured_taps[tap] = ifindex
+
+
+def forget_tap(tap):
+    """
+    Forget that a tap interface has been configured, when it is no longer in
+    use.
+    """
+    _configured_taps.pop(tap, None)
+
 
 def add_route(type, ip, tap, mac):
     """
     Add a route to a given tap interface (including arp config).
     Errors lead to exceptions that are not handled here.
+
+    With the netlink backend (see set_route_backend) the route and ARP entry
+    are programmed over rtnetlink. Otherwise the commands are sent with
+    futils.check_ip_batch, so may be run in the long-lived "ip -batch"
+    session. The static ARP entry is set with "ip neigh replace" (equivalent
+    to "arp -s") so that it can be too, and the route with "ip route replace"
+    so that it is safe to repeat.
     """
-    if type == futils.IPV4:
-        futils.check_call(['arp', '-s', ip, mac, '-i', tap])
-        futils.check_call(["ip", "route", "add", ip, "dev", tap])
-    else:
-        futils.check_call(["ip", "-6", "route", "add", ip, "dev", tap])
+    _change_route(type, ip, tap, mac, True)
 
 
 def del_route(type, ip, tap):
@@ -105,9 +286,202 @@ def del_route(type, ip, tap):
     Delete a route to a given tap interface (including arp config).
     Errors lead to exceptions that are not handled here.
     """
-    if type == futils.IPV4:
-        futils.check_call(['arp', '-d', ip, '-i', tap])
-        futils.check_call(["ip", "route", "del", ip, "dev", tap])
+    _change_route(type, ip, tap, None, False)
+
+
+def _change_route(type, ip, tap, mac, add):
+    """
+    Add or delete a route to a tap interface, and for IPv4 its ARP entry,
+    keeping the snapshot of routes (if any) up to date.
+    """
+    try:
+        if route_backend == ROUTE_BACKEND_NETLINK:
+            _netlink.check_request(_route_messages(type, ip, tap, mac, add))
+        else:
+            futils.check_ip_batch(_route_commands(type, ip, tap, mac, add))
+    except (futils.FailedSystemCall, fnetlink.NetlinkError):
+        _forget_routes(type, tap)
+        raise
+
+    _note_route(type, tap, ip, add)
+
+
+def _route_commands(type, ip, tap, mac, add):
+    """
+    Returns the list of "ip" commands (for futils.ip_batch) that add or delete
+    a route to a tap interface, and for IPv4 its ARP entry. The address family
+    is taken from the address.
+    """
+    commands = []
+
+    if add:
+        if type == futils.IPV4:
+            commands.append(["neigh", "replace", ip, "lladdr", mac,
+                             "dev", tap, "nud", "permanent"])
+        commands.append(["route", "replace", ip, "dev", tap])
     else:
-        futils.check_call(["ip", "-6", "route", "del", ip, "dev", tap])
+        if type == futils.IPV4:
+            commands.append(["neigh", "del", ip, "dev", tap])
+        commands.append(["route", "del", ip, "dev", tap])
+
+    return commands
+
+
+def _route_messages(type, ip, tap, mac, add):
+    """
+    Returns the list of rtnetlink messages that add or delete a route to a
+    tap interface, and for IPv4 its ARP entry. Throws a NetlinkError if the
+    interface does not exist.
+    """
+    ifindex = _ifindex(tap)
+    if ifindex is None:
+        raise fnetlink.NetlinkError("No such interface %s" % tap,
+                                    errno.ENODEV)
+
+    messages = []
+    if type == futils.IPV4:
+        messages.append(fnetlink.neigh_message(type, ip, mac, ifindex, add))
+    messages.append(fnetlink.route_message(type, ip, ifindex, add))
+
+    return messages
+
+
+class RouteBatch(object):
+    """
+    A set of route (and ARP) changes for any number of endpoints, which are
+    made together: in a single run of "ip -batch", or a single rtnetlink
+    request with the netlink backend. Tap interfaces can also be configured
+    (see configure_tap) as part of the batch, before the routes are changed.
+
+    Each change is made on behalf of an owner (such as an endpoint UUID), and
+    failures are reported by owner, so that just the endpoints whose changes
+    failed can be retried.
+
+    Changes in the batch are taken into account by list_tap_ips, so that an
+    endpoint programmed more than once before the batch is applied works out
+    its changes from the routes it will have, not those it has now.
+    """
+    def __init__(self):
+        # List of (owner, type, ip, tap, mac, add) tuples.
+        self._changes = []
+
+        # List of (owner, tap) pairs for the tap interfaces to configure.
+        self._taps = []
+
+        # Dictionary mapping (type, tap) to a dictionary mapping address to
+        # whether the last change in the batch adds or deletes its route.
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._changes) + len(self._taps)
+
+    def configure_tap(self, owner, tap):
+        self._taps.append((owner, tap))
+
+    def add_route(self, owner, type, ip, tap, mac):
+        self._changes.append((owner, type, ip, tap, mac, True))
+        self._pending.setdefault((type, tap), {})[ip] = True
+
+    def del_route(self, owner, type, ip, tap):
+        self._changes.append((owner, type, ip, tap, None, False))
+        self._pending.setdefault((type, tap), {})[ip] = False
+
+    def list_tap_ips(self, type, tap):
+        """
+        As the module function list_tap_ips, but returns the addresses that
+        will have routes to the tap interface once the batch is applied.
+        """
+        ips = list_tap_ips(type, tap)
+        for ip, add in self._pending.get((type, tap), {}).iteritems():
+            if add:
+                ips.add(ip)
+            else:
+                ips.discard(ip)
+        return ips
+
+    def apply(self):
+        """
+        Make all the changes in the batch, and empty it. Every change is
+        attempted, even if some fail. Returns the set of owners for which any
+        change failed.
+        """
+        changes       = self._changes
+        taps          = self._taps
+        self._changes = []
+        self._taps    = []
+        self._pending = {}
+        failed        = set()
+
+        for owner, tap in taps:
+            try:
+                configure_tap(tap)
+            except IOError as e:
+                log.warning("Failed to configure tap %s : %s" % (tap, e))
+                failed.add(owner)
+
+        if not changes:
+            return failed
+
+        #*********************************************************************#
+        #* Build the list of commands (or messages), recording which of them *#
+        #* make up each change, so that failures can be mapped back.         *#
+        #*********************************************************************#
+        requests = []
+        ranges   = []
+        messages = [[] for change in changes]
+        for index, (owner, type, ip, tap, mac, add) in enumerate(changes):
+            start = len(requests)
+            if route_backend == ROUTE_BACKEND_NETLINK:
+                try:
+                    requests.extend(_route_messages(type, ip, tap, mac, add))
+                except fnetlink.NetlinkError as e:
+                    messages[index].append(str(e))
+            else:
+                requests.extend(_route_commands(type, ip, tap, mac, add))
+            ranges.append((start, len(requests)))
+
+        if route_backend == ROUTE_BACKEND_NETLINK:
+            errors = dict((request, os.strerror(error)) for request, error in
+                          _netlink.request(requests).items())
+        else:
+            errors = futils.ip_batch(requests)
+
+        for index, (owner, type, ip, tap, mac, add) in enumerate(changes):
+            start, end = ranges[index]
+            messages[index].extend(errors[request].strip()
+                                   for request in range(start, end)
+                                   if request in errors)
+            if messages[index]:
+                log.warning("Failed to %s route to %s for %s : %s" %
+                            ("add" if add else "delete", ip, tap,
+                             "; ".join(messages[index])))
+                failed.add(owner)
+                _forget_routes(type, tap)
+            else:
+                _note_route(type, tap, ip, add)
+
+        return failed
+
+
+def _note_route(type, tap, ip, present):
+    """
+    Update the snapshot of routes (if any) after adding or deleting a route.
+    """
+    if _routes is not None:
+        ips = _snapshot_ips(type, tap)
+        if ips is not None:
+            if present:
+                ips.add(ip)
+            else:
+                ips.discard(ip)
+
+
+def _forget_routes(type, tap):
+    """
+    Mark the routes to an interface as unknown in the snapshot of routes (if
+    any), so that they are read again when next needed. This is done when
+    changing them fails, leaving them in an unknown state.
+    """
+    if _routes is not None:
+        _routes[type][tap] = None
 
@@ -25,6 +25,8 @@ import os
 import re
 import time
 
+from calico.felix import fchains
+from calico.felix import fstats
 from calico.felix import futils
 from calico.felix.futils import IPV4, IPV6
 
@@ -34,6 +36,18 @@ log = logging.getLogger(__name__)
 # Special value to mean "put this rule at the end".
 RULE_POSN_LAST = -1
 
+# The tables in which Felix owns chains.
+TABLES = ((IPV4, "filter"), (IPV4, "nat"), (IPV6, "filter"))
+
+#*****************************************************************************#
+#* Model of the chains that Felix owns, as a dictionary mapping (type, table *#
+#* name) to fchains.TableState. This is loaded from the kernel by load_state *#
+#* (at start of day and at each resync), and from then on it is updated      *#
+#* every time we write to a Felix chain, so that we never need to read those *#
+#* chains back from the kernel.                                              *#
+#*****************************************************************************#
+_state = {}
+
 #*****************************************************************************#
 #* Load the conntrack tables. This is a workaround for this issue            *#
 #* https://github.com/ldx/python-iptables/issues/112                         *#
@@ -65,6 +79,11 @@ class Rule(object):
     It would be nicer if it were a subclass of iptc.Rule, but sometimes it
     would need to be a subclass of iptc.Rule6 (which is not a subclass of
     iptc.Rule).
+
+    As well as building the python-iptables rule, the wrapper records the rule
+    parameters so that the rule can be rendered as text in the same format as
+    iptables-save uses (see the spec property); that is what is written when
+    rules are programmed with iptables-restore.
     """
     def __init__(self, type, target_name=None):
         self.type = type
@@ -75,8 +94,18 @@ class Rule(object):
             assert(type == IPV6)
             self._rule = iptc.Rule6()
 
+        # Parameters used to build the text form of the rule.
+        self._src           = None
+        self._dst           = None
+        self._in_interface  = None
+        self._out_interface = None
+        self._protocol      = None
+        self._matches       = []
+        self._target        = None
+
         if target_name is not None:
             self._rule.create_target(target_name)
+            self._target = ["-j", target_name]
 
     @property
     def protocol(self):
@@ -85,6 +114,7 @@ class Rule(object):
     @protocol.setter
     def protocol(self, value):
         self._rule.protocol = value
+        self._protocol = value
 
     @property
     def src(self):
@@ -93,6 +123,16 @@ class Rule(object):
     @src.setter
     def src(self, value):
         self._rule.src = value
+        self._src = value
+
+    @property
+    def dst(self):
+        return self._rule.dst
+
+    @dst.setter
+    def dst(self, value):
+        self._rule.dst = value
+        self._dst = value
 
     @property
     def in_interface(self):
@@ -101,6 +141,7 @@ class Rule(object):
     @in_interface.setter
     def in_interface(self, value):
         self._rule.in_interface = value
+        self._in_interface = value
 
     @property
     def out_interface(self):
@@ -109,41 +150,115 @@ class Rule(object):
     @out_interface.setter
     def out_interface(self, value):
         self._rule.out_interface = value
+        self._out_interface = value
 
     def create_target(self, name, parameters=None):
         target = self._rule.create_target(name)
+        self._target = ["-j", name]
         if parameters is not None:
-            for name, value in parameters.iteritems():
-                setattr(target, name, value)
+            for param, value in sorted(parameters.iteritems()):
+                setattr(target, param, value)
+                if param == "set_mark":
+                    # iptables-save always reports the mask explicitly.
+                    self._target += ["--set-xmark",
+                                     "0x%x/0xffffffff" % int(value)]
+                else:
+                    self._target += ["--" + param.replace("_", "-"),
+                                     _quote(value)]
 
     def create_tcp_match(self, dport):
         match = self._rule.create_match("tcp")
         match.dport = dport
+        self._matches += ["-m", "tcp", "--dport", dport]
 
     def create_icmp6_match(self, icmp_type):
         match = self._rule.create_match("icmp6")
         match.icmpv6_type = icmp_type
+        self._matches += ["-m", "icmp6", "--icmpv6-type", ",".join(icmp_type)]
 
     def create_conntrack_match(self, state):
         match = self._rule.create_match("conntrack")
         match.ctstate = state
+        self._matches += ["-m", "conntrack", "--ctstate", ",".join(state)]
 
     def create_mark_match(self, mark):
         match = self._rule.create_match("mark")
         match.mark = mark
+        self._matches += ["-m", "mark"]
+        if mark.startswith("!"):
+            self._matches.append("!")
+            mark = mark[1:]
+        self._matches += ["--mark", "0x%x" % int(mark)]
 
     def create_mac_match(self, mac_source):
         match = self._rule.create_match("mac")
         match.mac_source = mac_source
+        self._matches += ["-m", "mac", "--mac-source", mac_source.upper()]
 
     def create_set_match(self, match_set):
         match = self._rule.create_match("set")
         match.match_set = match_set
+        self._matches += ["-m", "set", "--match-set"] + list(match_set)
 
     def create_udp_match(self, sport, dport):
         match = self._rule.create_match("udp")
         match.sport = sport
         match.dport = dport
+        self._matches += ["-m", "udp", "--sport", sport, "--dport", dport]
+
+    @property
+    def spec(self):
+        """
+        The rule as text, formatted as iptables-save would format it but
+        without the leading "-A <chain>"; for example
+        "-i tap1234 -j felix-from-1234".
+        """
+        parts = []
+
+        if self._src is not None:
+            parts += ["-s", _add_prefix_len(self.type, self._src)]
+        if self._dst is not None:
+            parts += ["-d", _add_prefix_len(self.type, self._dst)]
+        if self._in_interface is not None:
+            parts += ["-i", self._in_interface]
+        if self._out_interface is not None:
+            parts += ["-o", self._out_interface]
+        if self._protocol is not None:
+            if self._protocol == "icmpv6":
+                parts += ["-p", "ipv6-icmp"]
+            else:
+                parts += ["-p", self._protocol]
+
+        parts += self._matches
+
+        if self._target is not None:
+            parts += self._target
+
+        return " ".join(parts)
+
+
+def _quote(value):
+    """
+    Quote a parameter value the way iptables-save does if it contains spaces,
+    quotes or backslashes, so that the spec matches iptables-save output.
+    """
+    value = str(value)
+    if value and not re.search(r'[\s"\\]', value):
+        return value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _add_prefix_len(type, addr):
+    """
+    Add the prefix length to an address if it is not already present, since
+    iptables-save always includes it.
+    """
+    if "/" in addr:
+        return addr
+    elif type == IPV4:
+        return addr + "/32"
+    else:
+        return addr + "/128"
 
 
 def insert_rule(rule, chain, position=0, force_position=True):
@@ -155,17 +270,30 @@ def insert_rule(rule, chain, position=0, force_position=True):
     If force_position is True, then the rule is added at the specified point
     unless it already exists there. If force_position is False, then the rule
     is added only if it does not exist anywhere in the list of rules.
+
+    For chains owned by Felix, the check for whether the rule exists uses the
+    model of the chain rather than reading the chain from the kernel.
     """
-    found = False
-    rules = chain.rules
+    state = _get_chain_state(rule.type, chain)
+
+    if state is None:
+        start = time.time()
+        rules = chain.rules
+        fstats.record("iptc read", time.time() - start)
+        exists_at = lambda posn: rule._rule == rules[posn]
+        exists = lambda: rule._rule in rules
+    else:
+        rules = state.rules(chain.name)
+        exists_at = lambda posn: rule.spec == rules[posn]
+        exists = lambda: rule.spec in rules
 
     if position == RULE_POSN_LAST:
         position = len(rules)
 
     if force_position:
-        if (len(rules) <= position) or (rule._rule != chain.rules[position]):
+        if (len(rules) <= position) or not exists_at(position):
             # Either adding after existing rules, or replacing an existing rule.
-            chain.insert_rule(rule._rule, position)
+            _insert_rule(rule, chain, position, state)
     else:
         #*********************************************************************#
         #* The python-iptables code to compare rules does a comparison on    *#
@@ -173,12 +301,26 @@ def insert_rule(rule, chain, position=0, force_position=True):
         #* the offset into the chain. Hence the test below finds whether     *#
         #* there is a rule with the same parameters anywhere in the chain.   *#
         #*********************************************************************#
-        if rule._rule not in chain.rules:
-            chain.insert_rule(rule._rule, position)
+        if not exists():
+            _insert_rule(rule, chain, position, state)
 
     return
 
 
+def _insert_rule(rule, chain, position, state):
+    """
+    Insert a rule into a chain, keeping the model of the chain (if any) up to
+    date. If the chain is not owned by Felix, the index of rules jumping to
+    Felix chains is still updated.
+    """
+    start = time.time()
+    chain.insert_rule(rule._rule, position)
+    fstats.record("iptc insert", time.time() - start)
+    if state is None:
+        state = get_state(rule.type, chain.table.name)
+    state.apply("-I %s %d %s" % (chain.name, position + 1, rule.spec))
+
+
 def get_table(type, name):
     """
     Gets a table. This is a simple helper method that returns either
@@ -196,11 +338,20 @@ def get_chain(table, name):
     """
     Gets a chain, creating it first if it does not exist.
     """
-    if table.is_chain(name):
+    state = _get_chain_state(_table_type(table), name, table.name)
+
+    if state is not None and state.has_chain(name):
+        # Known to exist; no need to check.
+        chain = iptc.Chain(table, name)
+    elif table.is_chain(name):
         chain = iptc.Chain(table, name)
     else:
+        start = time.time()
         table.create_chain(name)
+        fstats.record("iptc create chain", time.time() - start)
         chain = iptc.Chain(table, name)
+        if state is not None:
+            state.apply(":%s - [0:0]" % name)
 
     return chain
 
@@ -213,8 +364,173 @@ def truncate_rules(chain, count):
 
     It takes a chain object, and a count for how many of the rules should be
     left in place.
+
+    The rules are deleted by position in a single iptables-restore
+    transaction. Deleting them through python-iptables is not safe, since it
+    deletes the first rule in the chain that matches the rule passed in, which
+    may be one of the rules we want to keep.
     """
-    while len(chain.rules) > count:
-        rule = chain.rules[-1]
-        chain.delete_rule(rule)
+    type  = _table_type(chain.table)
+    state = _get_chain_state(type, chain)
+
+    if state is None:
+        start  = time.time()
+        length = len(chain.rules)
+        fstats.record("iptc read", time.time() - start)
+    else:
+        length = len(state.rules(chain.name))
+
+    # Delete from the end so that the earlier rule numbers do not change.
+    lines = ["-D %s %d" % (chain.name, posn)
+             for posn in range(length, count, -1)]
+    restore(type, chain.table.name, lines)
+
+
+def update_chain(chain, rules):
+    """
+    Make a chain owned by Felix contain exactly the rules passed in (a list
+    of Rule objects), making as few changes as possible. Nothing is written
+    if the chain already contains those rules.
+
+    Rules are inserted and replaced using python-iptables. Any rules to be
+    deleted are removed by position using iptables-restore, for the reasons
+    given in truncate_rules.
+
+    Returns the list of changes made, as returned by fchains.diff_rules.
+    """
+    type  = _table_type(chain.table)
+    state = _get_chain_state(type, chain)
+    specs = [rule.spec for rule in rules]
+    ops   = fchains.diff_rules(state.rules(chain.name), specs)
+
+    # Deletes are batched up until the next insert or replace.
+    deletes = []
+    for op, posn, index in ops:
+        if op == fchains.OP_DELETE:
+            deletes.append("%s %s %d" % (op, chain.name, posn))
+            continue
+
+        restore(type, chain.table.name, deletes)
+        deletes = []
+
+        start = time.time()
+        if op == fchains.OP_INSERT:
+            chain.insert_rule(rules[index]._rule, posn - 1)
+            fstats.record("iptc insert", time.time() - start)
+        else:
+            chain.replace_rule(rules[index]._rule, posn - 1)
+            fstats.record("iptc replace", time.time() - start)
+        state.apply("%s %s %d %s" % (op, chain.name, posn, specs[index]))
+
+    restore(type, chain.table.name, deletes)
+
+    return ops
 
+
+def restore(type, table_name, lines):
+    """
+    Apply a set of changes to a table in a single transaction, using
+    iptables-restore (or ip6tables-restore) with --noflush.
+
+    *lines* is a list of iptables-restore lines, such as chain declarations
+    (":felix-to-1234 - [0:0]", which creates the chain if it does not exist and
+    empties it if it does) and rule commands ("-A felix-to-1234 -j DROP").
+    Either every change is applied or none are; if the restore fails then a
+    FailedSystemCall exception is thrown. On success the model of the table
+    is updated to match.
+    """
+    if not lines:
+        return
+
+    if type == IPV4:
+        cmd = "iptables-restore"
+    else:
+        cmd = "ip6tables-restore"
+
+    data = "*%s\n%s\nCOMMIT\n" % (table_name, "\n".join(lines))
+    log.debug("Restore %s table %s :\n%s" % (type, table_name, data))
+    futils.check_call([cmd, "--noflush"], input_data=data)
+
+    state = get_state(type, table_name)
+    for line in lines:
+        state.apply(line)
+
+    #*************************************************************************#
+    #* python-iptables keeps a cached copy of each table, and writes back    *#
+    #* the whole of that copy when it next changes the table; refresh it so  *#
+    #* that it does not undo what we just did.                               *#
+    #*************************************************************************#
+    start = time.time()
+    get_table(type, table_name).refresh()
+    fstats.record("iptc refresh", time.time() - start)
+
+
+def load_state():
+    """
+    Load the model of the chains owned by Felix from the kernel, using a
+    single iptables-save (or ip6tables-save) per table. This is done at start
+    of day and on each resync; the rest of the time the model is kept up to
+    date as we make changes.
+    """
+    for type, table_name in TABLES:
+        _load_table_state(type, table_name)
+
+
+def _load_table_state(type, table_name):
+    """
+    Load the model of the chains owned by Felix in a single table.
+    """
+    if type == IPV4:
+        cmd = "iptables-save"
+    else:
+        cmd = "ip6tables-save"
+
+    data = futils.check_call([cmd, "-t", table_name]).stdout
+    _state[(type, table_name)] = fchains.parse_save(data)
+    log.debug("Loaded %s %s table state : %s" %
+              (type, table_name, _state[(type, table_name)].chains))
+
+
+def get_state(type, table_name):
+    """
+    Returns the fchains.TableState modelling the Felix chains in a table.
+
+    If the model has been found not to match the kernel (for example because
+    a rule that we deleted was not in it), it is loaded again first, rather
+    than waiting for the next resync.
+    """
+    state = _state.get((type, table_name))
+    if state is not None and state.stale:
+        log.warning("Reload %s %s table state, which does not match the "
+                    "kernel" % (type, table_name))
+        _load_table_state(type, table_name)
+
+    return _state.setdefault((type, table_name), fchains.TableState())
+
+
+def _get_chain_state(type, chain, table_name=None):
+    """
+    Returns the TableState for the table containing a chain, or None if the
+    chain is not owned by Felix (and so is not in the model). *chain* may be
+    a chain object or, if *table_name* is supplied, a chain name.
+    """
+    if table_name is None:
+        name       = chain.name
+        table_name = chain.table.name
+    else:
+        name       = chain
+
+    if fchains.is_felix_chain(name):
+        return get_state(type, table_name)
+    else:
+        return None
+
+
+def _table_type(table):
+    """
+    Returns the type (IPV4 or IPV6) of a python-iptables table.
+    """
+    if isinstance(table, iptc.Table6):
+        return IPV6
+    else:
+        return IPV4
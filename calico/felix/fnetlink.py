@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fnetlink
+~~~~~~~~~~~~
+
+Programming of routes and neighbour (ARP) entries by talking rtnetlink to the
+kernel directly, rather than running "ip" commands.
+
+Messages are built by route_message and neigh_message, and sent with a
+NetlinkSocket, which sends many messages at a time and collects the kernel's
+acknowledgement of each.
+
+A LinkWatcher listens for notifications of interfaces being created or
+changed, so that Felix can react to tap interfaces appearing.
+"""
+import binascii
+import errno
+import logging
+import os
+import socket
+import struct
+import time
+
+from calico.felix import fstats
+from calico.felix.futils import IPV4, IPV6
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Netlink protocol, message types and flags, from linux/netlink.h and
+# linux/rtnetlink.h.
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR   = 2
+RTM_NEWLINK   = 16
+RTM_NEWROUTE  = 24
+RTM_DELROUTE  = 25
+RTM_NEWNEIGH  = 28
+RTM_DELNEIGH  = 29
+
+MESSAGE_NAMES = {RTM_NEWROUTE: "RTM_NEWROUTE",
+                 RTM_DELROUTE: "RTM_DELROUTE",
+                 RTM_NEWNEIGH: "RTM_NEWNEIGH",
+                 RTM_DELNEIGH: "RTM_DELNEIGH"}
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK     = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE  = 0x400
+
+RT_TABLE_MAIN    = 254
+RTPROT_BOOT      = 3
+RT_SCOPE_LINK    = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST      = 1
+RTA_DST          = 1
+RTA_OIF          = 4
+
+NUD_PERMANENT = 0x80
+NDA_DST       = 1
+NDA_LLADDR    = 2
+
+RTMGRP_LINK   = 0x1
+IFLA_IFNAME   = 3
+
+# Message and attribute headers, in host byte order.
+NLMSGHDR = struct.Struct("=IHHII")
+RTMSG    = struct.Struct("=BBBBBBBBI")
+NDMSG    = struct.Struct("=BBHiHBB")
+IFINFOMSG = struct.Struct("=BBHiII")
+RTATTR   = struct.Struct("=HH")
+ERRNO    = struct.Struct("=i")
+
+FAMILIES = {IPV4: socket.AF_INET, IPV6: socket.AF_INET6}
+
+
+class NetlinkError(Exception):
+    def __init__(self, message, errno):
+        super(NetlinkError, self).__init__(message)
+        self.errno = errno
+
+
+def _align(length):
+    """
+    Round a length up to the 4 byte alignment that netlink uses.
+    """
+    return (length + 3) & ~3
+
+
+def _attr(attr_type, data):
+    """
+    Encode a netlink attribute, with padding.
+    """
+    length = RTATTR.size + len(data)
+    return (RTATTR.pack(length, attr_type) + data +
+            "\0" * (_align(length) - length))
+
+
+def route_message(type, ip, ifindex, add=True):
+    """
+    Build a message that adds (or replaces) or deletes a route to a single
+    address through an interface, like "ip route replace <ip> dev <tap>" or
+    "ip route del <ip> dev <tap>". Returns a (message type, flags, payload)
+    tuple for NetlinkSocket.
+    """
+    family = FAMILIES[type]
+    addr   = socket.inet_pton(family, ip)
+
+    if add:
+        msg = RTMSG.pack(family, len(addr) * 8, 0, 0, RT_TABLE_MAIN,
+                         RTPROT_BOOT, RT_SCOPE_LINK, RTN_UNICAST, 0)
+        return (RTM_NEWROUTE,
+                NLM_F_CREATE | NLM_F_REPLACE,
+                msg + _attr(RTA_DST, addr) +
+                      _attr(RTA_OIF, struct.pack("=i", ifindex)))
+    else:
+        msg = RTMSG.pack(family, len(addr) * 8, 0, 0, RT_TABLE_MAIN,
+                         0, RT_SCOPE_NOWHERE, 0, 0)
+        return (RTM_DELROUTE,
+                0,
+                msg + _attr(RTA_DST, addr) +
+                      _attr(RTA_OIF, struct.pack("=i", ifindex)))
+
+
+def neigh_message(type, ip, mac, ifindex, add=True):
+    """
+    Build a message that adds (or replaces) or deletes a permanent neighbour
+    entry, like "ip neigh replace <ip> lladdr <mac> dev <tap> nud permanent"
+    or "ip neigh del <ip> dev <tap>". Returns a (message type, flags, payload)
+    tuple for NetlinkSocket.
+    """
+    family = FAMILIES[type]
+    msg    = NDMSG.pack(family, 0, 0, ifindex, NUD_PERMANENT, 0, 0)
+    dst    = _attr(NDA_DST, socket.inet_pton(family, ip))
+
+    if add:
+        lladdr = binascii.unhexlify(mac.replace(":", ""))
+        return (RTM_NEWNEIGH,
+                NLM_F_CREATE | NLM_F_REPLACE,
+                msg + dst + _attr(NDA_LLADDR, lladdr))
+    else:
+        return (RTM_DELNEIGH, 0, msg + dst)
+
+
+class NetlinkSocket(object):
+    """
+    A socket for sending requests to the kernel's rtnetlink interface.
+
+    Requests are sent many messages at a time, each asking for an
+    acknowledgement; the acknowledgements are matched to the messages by
+    sequence number, so that each failure can be reported against the
+    message that caused it.
+    """
+    # Messages sent at a time; this limits how many acknowledgements can be
+    # queued on the socket.
+    BATCH_SIZE = 100
+
+    # Time to wait for the kernel to acknowledge a batch of messages.
+    TIMEOUT_SECS = 5
+
+    def __init__(self, sock=None):
+        """
+        Open a netlink socket, or use the (connected, datagram) socket passed
+        in, which is useful for testing.
+        """
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 NETLINK_ROUTE)
+            sock.bind((0, 0))
+            sock.connect((0, 0))
+        sock.settimeout(self.TIMEOUT_SECS)
+
+        self._sock = sock
+        self._seq  = 0
+
+    def close(self):
+        self._sock.close()
+
+    def request(self, messages):
+        """
+        Send a list of messages, each a (message type, flags, payload) tuple,
+        and wait for them all to be acknowledged. Every message is sent, even
+        if some fail.
+
+        Returns a dictionary mapping the index of each message that failed to
+        its errno; if all the messages succeeded, the dictionary is empty.
+        """
+        errors = {}
+        start  = time.time()
+
+        for first in range(0, len(messages), self.BATCH_SIZE):
+            pending = {}
+            data    = []
+            for index in range(first,
+                               min(first + self.BATCH_SIZE, len(messages))):
+                msg_type, flags, payload = messages[index]
+                self._seq = (self._seq + 1) & 0xffffffff
+                pending[self._seq] = index
+                data.append(NLMSGHDR.pack(NLMSGHDR.size + len(payload),
+                                          msg_type,
+                                          flags | NLM_F_REQUEST | NLM_F_ACK,
+                                          self._seq,
+                                          0))
+                data.append(payload + "\0" * (_align(len(payload)) -
+                                              len(payload)))
+
+            try:
+                self._sock.send("".join(data))
+                while pending:
+                    for seq, errno in _parse_acks(self._sock.recv(65536)):
+                        index = pending.pop(seq, None)
+                        if index is not None and errno:
+                            errors[index] = errno
+            except socket.timeout:
+                raise NetlinkError("Timed out waiting for netlink "
+                                   "acknowledgement", 0)
+
+        fstats.record("netlink", time.time() - start)
+
+        return errors
+
+    def check_request(self, messages):
+        """
+        As request, but throws a NetlinkError exception (for the first message
+        that failed) if any of the messages fail.
+        """
+        errors = self.request(messages)
+        if errors:
+            index = min(errors)
+            raise NetlinkError("Netlink %s request failed : %s" %
+                               (MESSAGE_NAMES.get(messages[index][0],
+                                                  messages[index][0]),
+                                os.strerror(errors[index])),
+                               errors[index])
+
+
+class LinkWatcher(object):
+    """
+    A netlink socket subscribed to notifications of interfaces being
+    created, deleted or changed. The socket is non-blocking, and can be
+    polled for input using its file descriptor.
+    """
+    # Receive buffer size; a larger buffer makes it less likely that
+    # notifications are lost when many interfaces change at once.
+    RCVBUF_SIZE = 1024 * 1024
+
+    def __init__(self, sock=None):
+        """
+        Open a netlink socket, or use the (datagram) socket passed in, which
+        is useful for testing.
+        """
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 NETLINK_ROUTE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.RCVBUF_SIZE)
+            sock.bind((0, RTMGRP_LINK))
+        sock.setblocking(0)
+
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+    def read_links(self):
+        """
+        Read all the pending notifications. Returns the set of names of the
+        interfaces that have been created or changed, or None if
+        notifications have been lost (in which case any interface might have
+        changed).
+        """
+        names = set()
+
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.error as e:
+                if e.errno == errno.EAGAIN:
+                    return names
+                elif e.errno == errno.ENOBUFS:
+                    log.warning("Lost interface notifications")
+                    names = None
+                    continue
+                raise
+
+            if names is None:
+                # Keep reading, so that the socket is drained.
+                continue
+
+            for msg_type, seq, body in _parse_messages(data):
+                if msg_type == RTM_NEWLINK:
+                    name = _ifname(body[IFINFOMSG.size:])
+                    if name is not None:
+                        names.add(name)
+
+
+def _ifname(data):
+    """
+    Find the interface name in the attributes of an interface message.
+    """
+    offset = 0
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        if attr_type == IFLA_IFNAME:
+            return data[offset + RTATTR.size:offset + length].rstrip("\0")
+        offset += _align(length)
+
+    return None
+
+
+def _parse_messages(data):
+    """
+    Split the data received from the kernel into messages, generating a
+    (message type, sequence number, body) tuple for each.
+    """
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, flags, seq, pid = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            log.warning("Ignoring malformed netlink message")
+            break
+
+        yield msg_type, seq, data[offset + NLMSGHDR.size:offset + length]
+        offset += _align(length)
+
+
+def _parse_acks(data):
+    """
+    Parse the messages received from the kernel, generating a (sequence
+    number, errno) pair for each acknowledgement; errno is 0 for success.
+    Other messages are ignored.
+    """
+    for msg_type, seq, body in _parse_messages(data):
+        if msg_type == NLMSG_ERROR:
+            error, = ERRNO.unpack_from(body)
+            yield seq, -error
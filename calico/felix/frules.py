@@ -18,12 +18,15 @@ felix.frules
 
 Felix rule management, including iptables and ipsets.
 """
+import collections
+import hashlib
+import itertools
 import logging
 import os
 import re
-import subprocess
 import time
 
+from calico.felix import fchains
 from calico.felix import fiptables
 from calico.felix import futils
 from calico.felix.futils import FailedSystemCall
@@ -38,6 +41,8 @@ CHAIN_INPUT              = "felix-INPUT"
 CHAIN_FORWARD            = "felix-FORWARD"
 CHAIN_TO_PREFIX          = "felix-to-"
 CHAIN_FROM_PREFIX        = "felix-from-"
+CHAIN_DISPATCH_TO_PREFIX   = "felix-TO-"
+CHAIN_DISPATCH_FROM_PREFIX = "felix-FROM-"
 
 #*****************************************************************************#
 #* ipset names. The "to" ipsets are referenced from the "to" chains, and the *#
@@ -87,6 +92,87 @@ IPSET6_TMP_PORT         = "felix-6-tmp-port"
 IPSET6_TMP_ADDR         = "felix-6-tmp-addr"
 IPSET6_TMP_ICMP         = "felix-6-tmp-icmp"
 
+#*****************************************************************************#
+#* Shared ipsets. With shared ipsets enabled, each of the endpoint ipsets    *#
+#* above is replaced by a "list:set" ipset (named with the prefixes below)   *#
+#* whose only member is a shared ipset holding the actual entries. Shared    *#
+#* ipsets are named after a hash of their contents, so endpoints with the    *#
+#* same ACLs (for example, all the endpoints in a security group) use the    *#
+#* same shared ipsets, and the entries are only stored and written once.     *#
+#* Shared ipsets are reference counted, and destroyed when no longer used.   *#
+#*****************************************************************************#
+IPSET_LIST_TO_ADDR_PREFIX    = "felix-l-to-addr-"
+IPSET_LIST_TO_PORT_PREFIX    = "felix-l-to-port-"
+IPSET_LIST_TO_ICMP_PREFIX    = "felix-l-to-icmp-"
+IPSET_LIST_FROM_ADDR_PREFIX  = "felix-l-from-addr-"
+IPSET_LIST_FROM_PORT_PREFIX  = "felix-l-from-port-"
+IPSET_LIST_FROM_ICMP_PREFIX  = "felix-l-from-icmp-"
+IPSET6_LIST_TO_ADDR_PREFIX   = "felix-6-l-to-addr-"
+IPSET6_LIST_TO_PORT_PREFIX   = "felix-6-l-to-port-"
+IPSET6_LIST_TO_ICMP_PREFIX   = "felix-6-l-to-icmp-"
+IPSET6_LIST_FROM_ADDR_PREFIX = "felix-6-l-from-addr-"
+IPSET6_LIST_FROM_PORT_PREFIX = "felix-6-l-from-port-"
+IPSET6_LIST_FROM_ICMP_PREFIX = "felix-6-l-from-icmp-"
+IPSET_TMP_LIST               = "felix-tmp-list"
+IPSET_SHARED_NET_PREFIX      = "felix-net-"
+IPSET_SHARED_PORT_PREFIX     = "felix-netport-"
+IPSET6_SHARED_NET_PREFIX     = "felix-6-net-"
+IPSET6_SHARED_PORT_PREFIX    = "felix-6-netport-"
+IPSET_SHARED_PREFIXES        = (IPSET_SHARED_NET_PREFIX,
+                                IPSET_SHARED_PORT_PREFIX,
+                                IPSET6_SHARED_NET_PREFIX,
+                                IPSET6_SHARED_PORT_PREFIX)
+
+# Number of hex digits of the content hash in shared ipset names.
+IPSET_SHARED_HASH_LEN = 12
+
+# Whether shared ipsets are in use; see set_shared_ipsets.
+shared_ipsets = False
+
+# Dictionary mapping shared ipset name to the number of references to it.
+_shared_ipset_refs = {}
+
+# Dictionary mapping (endpoint id, type) to the list of shared ipsets
+# referenced by the ipsets for that endpoint.
+_ep_shared_ipsets = {}
+
+# The names of all the ipsets that exist; see load_inventory.
+_ipsets = set()
+
+#*****************************************************************************#
+#* Methods for programming the per-endpoint iptables state. The default is   *#
+#* to make changes rule by rule using python-iptables; alternatively the     *#
+#* complete chain set for each endpoint (or batch of endpoints) can be       *#
+#* rendered as text and applied in a single iptables-restore transaction.    *#
+#*****************************************************************************#
+IPTABLES_BACKEND_IPTC    = "python-iptables"
+IPTABLES_BACKEND_RESTORE = "restore"
+IPTABLES_BACKENDS        = (IPTABLES_BACKEND_IPTC, IPTABLES_BACKEND_RESTORE)
+
+# The method in use; see set_iptables_backend.
+iptables_backend = IPTABLES_BACKEND_IPTC
+
+#*****************************************************************************#
+#* How packets are sent from felix-INPUT and felix-FORWARD to the chains for *#
+#* each endpoint. By default ("flat") there is a rule for each endpoint in   *#
+#* those chains, so every packet is checked against each of them in turn.    *#
+#* Alternatively ("tree") the rules are arranged as a tree of dispatch       *#
+#* chains keyed on prefixes of the interface name, using iptables interface  *#
+#* wildcards such as "-i tap1a+", so that each packet only passes O(log n)   *#
+#* rules. A dispatch chain is split once it would contain more than          *#
+#* DISPATCH_MAX_RULES rules for individual endpoints.                        *#
+#*****************************************************************************#
+DISPATCH_FLAT      = "flat"
+DISPATCH_TREE      = "tree"
+DISPATCH_MODES     = (DISPATCH_FLAT, DISPATCH_TREE)
+DISPATCH_MAX_RULES = 16
+
+# The mode in use; see set_dispatch_mode.
+dispatch_mode = DISPATCH_FLAT
+
+# Regex matching the line number that ipset restore reports on failure.
+IPSET_ERROR_LINE_REGEX = re.compile("Error in line ([0-9]+)")
+
 
 def set_global_rules(config):
     """
@@ -99,7 +185,7 @@ def set_global_rules(config):
 
     if config.METADATA_IP is None:
         # No metadata IP. The chain should be empty - if not, clean it out.
-        chain.flush()
+        fiptables.truncate_rules(chain, 0)
     else:
         # Now add the single rule to that chain. It looks like this.
         #  DNAT tcp -- any any anywhere 169.254.169.254 tcp dpt:http to:127.0.0.1:9697
@@ -114,27 +200,8 @@ def set_global_rules(config):
         fiptables.insert_rule(rule, chain)
         fiptables.truncate_rules(chain, 1)
 
-    #*************************************************************************#
-    #* This is a hack, because of a bug in python-iptables where it fails to *#
-    #* correctly match some rules; see                                       *#
-    #* https://github.com/ldx/python-iptables/issues/111 If any of the rules *#
-    #* relating to this tap device already exist, assume that they all do so *#
-    #* as not to recreate them.                                              *#
-    #*                                                                       *#
-    #* This is Calico issue #35,                                             *#
-    #* https://github.com/Metaswitch/calico/issues/35                        *#
-    #*************************************************************************#
-    rules_check = subprocess.call("iptables -L %s | grep %s" %
-                                  ("INPUT", CHAIN_INPUT),
-                                  shell=True)
-
-    if rules_check == 0:
-        log.debug("Static rules already exist")
-    else:
-        # Add a rule that forces us through the chain we just created.
-        chain = fiptables.get_chain(table, "PREROUTING")
-        rule = fiptables.Rule(futils.IPV4, CHAIN_PREROUTING)
-        fiptables.insert_rule(rule, chain)
+    # Add a rule that forces us through the chain we just created.
+    _insert_jump_rule(IPV4, table, "PREROUTING", CHAIN_PREROUTING)
 
     #*************************************************************************#
     #* Now the filter table. This needs to have calico-filter-FORWARD and    *#
@@ -146,15 +213,77 @@ def set_global_rules(config):
         fiptables.get_chain(table, CHAIN_FORWARD)
         fiptables.get_chain(table, CHAIN_INPUT)
 
-        if rules_check != 0:
-            # Add rules that forces us through the chain we just created.
-            chain = fiptables.get_chain(table, "FORWARD")
-            rule  = fiptables.Rule(type, CHAIN_FORWARD)
-            fiptables.insert_rule(rule, chain)
+        # Add rules that forces us through the chain we just created.
+        _insert_jump_rule(type, table, "FORWARD", CHAIN_FORWARD)
+        _insert_jump_rule(type, table, "INPUT", CHAIN_INPUT)
+
+        #*********************************************************************#
+        #* If using dispatch chains, rearrange any existing rules for        *#
+        #* endpoints into the tree. If not, but there are dispatch chains    *#
+        #* left over from a previous run, put the rules back in felix-INPUT  *#
+        #* and felix-FORWARD and remove the dispatch chains.                 *#
+        #*********************************************************************#
+        state = fiptables.get_state(type, "filter")
+        if (dispatch_mode == DISPATCH_TREE or
+                any(_is_dispatch_chain(name) for name in state.chains)):
+            fiptables.restore(type, "filter", _dispatch_updates(type))
+
+
+def _insert_jump_rule(type, table, chain_name, target):
+    """
+    Insert a rule at the start of a built in chain, sending all packets to a
+    Felix chain, unless such a rule already exists.
+    """
+    #*************************************************************************#
+    #* Whether the rule exists is found from the index of jump rules in the  *#
+    #* model (loaded from iptables-save), rather than by asking              *#
+    #* python-iptables, because of a bug in python-iptables where it fails   *#
+    #* to correctly match some rules; see                                    *#
+    #* https://github.com/ldx/python-iptables/issues/111                     *#
+    #*                                                                       *#
+    #* This is Calico issue #35,                                             *#
+    #* https://github.com/Metaswitch/calico/issues/35                        *#
+    #*************************************************************************#
+    state = fiptables.get_state(type, table.name)
+    rule  = fiptables.Rule(type, target)
+
+    if (chain_name, rule.spec) in state.jumps_to(target):
+        log.debug("%s rule from %s to %s already exists" %
+                  (type, chain_name, target))
+    else:
+        chain = fiptables.get_chain(table, chain_name)
+        fiptables.insert_rule(rule, chain)
+
+
+def set_iptables_backend(backend):
+    """
+    Select the method used to program the per-endpoint iptables state; one of
+    the IPTABLES_BACKEND_* values.
+    """
+    global iptables_backend
+    assert backend in IPTABLES_BACKENDS
+    log.info("Using %s to program endpoint rules" % backend)
+    iptables_backend = backend
+
+
+def set_dispatch_mode(mode):
+    """
+    Select how packets are sent to the chains for each endpoint; one of the
+    DISPATCH_* values.
+    """
+    global dispatch_mode
+    assert mode in DISPATCH_MODES
+    log.info("Using %s dispatch to endpoint chains" % mode)
+    dispatch_mode = mode
+
 
-            chain = fiptables.get_chain(table, "INPUT")
-            rule  = fiptables.Rule(type, CHAIN_INPUT)
-            fiptables.insert_rule(rule, chain)
+def set_shared_ipsets(enabled):
+    """
+    Select whether endpoints with identical ACLs share ipsets.
+    """
+    global shared_ipsets
+    log.info("Shared ipsets %s" % ("enabled" if enabled else "disabled"))
+    shared_ipsets = enabled
 
 
 def set_ep_specific_rules(id, iface, type, localips, mac):
@@ -175,28 +304,429 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     Note however that this routine handles IPv4 or IPv6 not both; it is
     normally called twice in succession (once for each).
     """
+    if iptables_backend == IPTABLES_BACKEND_RESTORE:
+        set_ep_specific_rules_batch(type, [(id, iface, localips, mac)])
+        return
+
     to_chain_name   = CHAIN_TO_PREFIX + id
     from_chain_name = CHAIN_FROM_PREFIX + id
 
-    # Set up all the ipsets.
+    _create_ep_ipsets(id, type)
+
+    # Get the table.
+    table = fiptables.get_table(type, "filter")
+
+    #*************************************************************************#
+    #* Create the chains for packets to and from the interface, and bring    *#
+    #* the rules in them up to date. Only the rules that differ from what is *#
+    #* already there are changed, and any rules present which should not     *#
+    #* have been are deleted.                                                *#
+    #*************************************************************************#
+    to_chain = fiptables.get_chain(table, to_chain_name)
+    ops = fiptables.update_chain(to_chain, _ep_to_rules(id, type))
+
+    from_chain = fiptables.get_chain(table, from_chain_name)
+    ops += fiptables.update_chain(from_chain,
+                                  _ep_from_rules(id, type, localips, mac))
+
+    _log_rule_changes(id, type, ops)
+
+    #*************************************************************************#
+    #* We have created the chains and rules that control input and output    *#
+    #* for the interface but not routed traffic through them. Add the input  *#
+    #* rule detecting packets arriving for the endpoint.  Note that these    *#
+    #* rules should perhaps be restructured and simplified given that this   *#
+    #* is not a bridged network -                                            *#
+    #* https://github.com/Metaswitch/calico/issues/36                        *#
+    #*                                                                       *#
+    #* Similarly, create the rules that direct packets that are forwarded    *#
+    #* either to or from the endpoint, sending them to the "to" or "from"    *#
+    #* chains as appropriate.                                                *#
+    #*************************************************************************#
+    if dispatch_mode == DISPATCH_TREE:
+        fiptables.restore(type, "filter", _dispatch_updates(type, {iface: id}))
+        return
+
+    state = fiptables.get_state(type, "filter")
+    for chain_name, rule in _missing_jump_rules(state, id, iface, type):
+        chain = fiptables.get_chain(table, chain_name)
+        fiptables.insert_rule(rule, chain, fiptables.RULE_POSN_LAST)
+    return
+
+
+def set_ep_specific_rules_batch(type, eps):
+    """
+    Add (or modify) the rules for a batch of endpoints, using a single
+    iptables-restore transaction for the whole batch. The end state is the
+    same as calling set_ep_specific_rules for each endpoint in turn.
+
+    *eps* is a list of (id, iface, localips, mac) tuples, one per endpoint.
+    """
+    if not eps:
+        return
+
+    # The ipsets must exist before any rule referring to them is committed.
+    for id, iface, localips, mac in eps:
+        _create_ep_ipsets(id, type)
+
+    _restore_ep_specific_rules(type, eps)
+
+
+def _restore_ep_specific_rules(type, eps):
+    """
+    Program the rules for a batch of endpoints, whose ipsets already exist,
+    in a single iptables-restore transaction (see set_ep_specific_rules_batch).
+    """
+    state = fiptables.get_state(type, "filter")
+
+    #*************************************************************************#
+    #* Only the rules that differ from the model of each chain are written.  *#
+    #* Missing chains are declared first, since the jump rules refer to      *#
+    #* them; declaring a chain that already exists would empty it, so        *#
+    #* existing chains are never declared.                                   *#
+    #*************************************************************************#
+    declarations = []
+    rules        = []
+    for id, iface, localips, mac in eps:
+        to_chain_name   = CHAIN_TO_PREFIX + id
+        from_chain_name = CHAIN_FROM_PREFIX + id
+
+        ops = []
+        for chain_name, chain_rules in (
+                (to_chain_name, _ep_to_rules(id, type)),
+                (from_chain_name, _ep_from_rules(id, type, localips, mac))):
+            if not state.has_chain(chain_name):
+                declarations.append(":%s - [0:0]" % chain_name)
+
+            specs     = [rule.spec for rule in chain_rules]
+            chain_ops = fchains.diff_rules(state.rules(chain_name), specs)
+            rules    += _diff_lines(chain_name, specs, chain_ops)
+            ops      += chain_ops
+
+        _log_rule_changes(id, type, ops)
+
+        if dispatch_mode == DISPATCH_FLAT:
+            for chain_name, rule in _missing_jump_rules(state, id, iface,
+                                                        type):
+                rules.append("-A %s %s" % (chain_name, rule.spec))
+
+    if dispatch_mode == DISPATCH_TREE:
+        ifaces = {iface: id for id, iface, localips, mac in eps}
+        rules += _dispatch_updates(type, ifaces)
+
+    log.debug("Program %s rules for %d endpoint(s) with iptables-restore" %
+              (type, len(eps)))
+    fiptables.restore(type, "filter", declarations + rules)
+
+
+class RuleBatch(object):
+    """
+    The rules for any number of endpoints, which are programmed together: in
+    a single iptables-restore transaction per table, rather than one for each
+    endpoint. Only used with the "restore" iptables backend.
+
+    Each endpoint is added on behalf of an owner (such as its UUID), and
+    failures are reported by owner, so that just the endpoints in the failed
+    transaction can be retried. The ipsets for an endpoint are created when it
+    is added, so that its ACLs can be programmed before the batch is applied.
+    """
+    def __init__(self):
+        # Dictionary mapping type to an ordered dictionary mapping endpoint id
+        # to (owner, iface, localips, mac). If an endpoint is added again
+        # before the batch is applied, its latest rules replace the earlier
+        # ones.
+        self._eps = {}
+
+    def __len__(self):
+        return sum(len(eps) for eps in self._eps.values())
+
+    def set_ep_specific_rules(self, owner, id, iface, type, localips, mac):
+        """
+        As the module function set_ep_specific_rules, but the rules are
+        programmed when the batch is applied.
+        """
+        _create_ep_ipsets(id, type)
+        eps = self._eps.setdefault(type, collections.OrderedDict())
+        eps[id] = (owner, iface, localips, mac)
+
+    def discard(self, id):
+        """
+        Remove an endpoint from the batch, for example because it has been
+        deleted since it was added.
+        """
+        for eps in self._eps.values():
+            eps.pop(id, None)
+
+    def apply(self):
+        """
+        Program the rules for all the endpoints in the batch, and empty it.
+        Returns the set of owners of endpoints whose rules were not
+        programmed.
+        """
+        batches   = self._eps
+        self._eps = {}
+        failed    = set()
+
+        for type, eps in sorted(batches.items()):
+            if not eps:
+                continue
+
+            try:
+                _restore_ep_specific_rules(
+                    type,
+                    [(id, iface, localips, mac)
+                     for id, (owner, iface, localips, mac) in eps.items()])
+            except FailedSystemCall as e:
+                log.warning("Failed to program %s rules for %d endpoint(s) :"
+                            " %s" % (type, len(eps), e))
+                failed.update(owner for owner, iface, localips, mac
+                              in eps.values())
+
+        return failed
+
+
+def _diff_lines(chain_name, specs, ops):
+    """
+    Returns the iptables-restore lines for the changes to a chain returned by
+    fchains.diff_rules, where *specs* are the desired rule specs.
+    """
+    lines = []
+    for op, posn, index in ops:
+        if op == fchains.OP_DELETE:
+            lines.append("%s %s %d" % (op, chain_name, posn))
+        else:
+            lines.append("%s %s %d %s" % (op, chain_name, posn, specs[index]))
+
+    return lines
+
+
+def _is_dispatch_chain(name):
+    return (name.startswith(CHAIN_DISPATCH_TO_PREFIX) or
+            name.startswith(CHAIN_DISPATCH_FROM_PREFIX))
+
+
+def _dispatch_updates(type, add=None, remove=()):
+    """
+    Returns the iptables-restore lines that bring felix-INPUT, felix-FORWARD
+    and the dispatch chains in the filter table up to date.
+
+    The endpoints covered are those that already have rules sending packets
+    to their chains (found from the model), plus those in *add* (a dictionary
+    mapping interface name to endpoint id), less those in *remove* (a list of
+    endpoint ids). Only the rules that differ from the model are changed, so
+    the tree is rebalanced incrementally as endpoints come and go.
+    """
+    state  = fiptables.get_state(type, "filter")
+    ifaces = _dispatch_endpoints(state)
+    ifaces.update(add or {})
+    for iface, id in list(ifaces.items()):
+        if id in remove:
+            del ifaces[iface]
+
+    chains = _dispatch_chains(ifaces)
+
+    #*************************************************************************#
+    #* New chains are declared before any rules that refer to them, and      *#
+    #* chains no longer needed are removed after the rules that referred to  *#
+    #* them have been changed.                                               *#
+    #*************************************************************************#
+    declarations = []
+    rules        = []
+    deletions    = []
+    for name in sorted(chains):
+        if not state.has_chain(name):
+            declarations.append(":%s - [0:0]" % name)
+        ops = fchains.diff_rules(state.rules(name), chains[name])
+        rules += _diff_lines(name, chains[name], ops)
+
+    for name in sorted(state.chains):
+        if _is_dispatch_chain(name) and name not in chains:
+            deletions.append("-F %s" % name)
+            deletions.append("-X %s" % name)
+
+    return declarations + rules + deletions
+
+
+def _dispatch_endpoints(state):
+    """
+    Returns a dictionary mapping interface name to endpoint id for each
+    endpoint with a rule sending packets from its interface to its chain.
+    """
+    ifaces = {}
+    for target in state.jumps:
+        if not target.startswith(CHAIN_FROM_PREFIX):
+            continue
+        for chain_name, spec in state.jumps_to(target):
+            words = spec.split()
+            if "-i" in words:
+                iface = words[words.index("-i") + 1]
+                ifaces[iface] = target[len(CHAIN_FROM_PREFIX):]
+
+    return ifaces
+
+
+def _dispatch_chains(ifaces):
+    """
+    Returns the rules (as a dictionary mapping chain name to list of rule
+    specs) for felix-INPUT, felix-FORWARD and any dispatch chains, sending
+    packets for each interface in *ifaces* (a dictionary mapping interface
+    name to endpoint id) to the chains for its endpoint.
+    """
+    chains = {}
+    names  = sorted(ifaces)
+
+    if dispatch_mode == DISPATCH_FLAT:
+        from_rules = []
+        to_rules   = []
+        for name in names:
+            from_rules.append("-i %s -j %s%s" %
+                              (name, CHAIN_FROM_PREFIX, ifaces[name]))
+            to_rules.append("-o %s -j %s%s" %
+                            (name, CHAIN_TO_PREFIX, ifaces[name]))
+        chains[CHAIN_INPUT]   = from_rules
+        chains[CHAIN_FORWARD] = [rule for pair in zip(from_rules, to_rules)
+                                 for rule in pair]
+    else:
+        from_rules = _dispatch_node(chains, "-i", CHAIN_FROM_PREFIX,
+                                    CHAIN_DISPATCH_FROM_PREFIX, names, ifaces)
+        to_rules   = _dispatch_node(chains, "-o", CHAIN_TO_PREFIX,
+                                    CHAIN_DISPATCH_TO_PREFIX, names, ifaces)
+        chains[CHAIN_INPUT]   = from_rules
+        chains[CHAIN_FORWARD] = from_rules + to_rules
+
+    return chains
+
+
+def _dispatch_node(chains, flag, target_prefix, chain_prefix, names, ifaces):
+    """
+    Returns the rules for one node of the dispatch tree, covering a sorted
+    list of interface names. Any dispatch chains needed below this node are
+    added to *chains*.
+    """
+    if len(names) <= DISPATCH_MAX_RULES:
+        return ["%s %s -j %s%s" % (flag, name, target_prefix, ifaces[name])
+                for name in names]
+
+    #*************************************************************************#
+    #* Split the names on the first character after their common prefix.     *#
+    #* Each group of more than one name gets its own dispatch chain, named   *#
+    #* after the group's prefix (at most 26 characters, since interface      *#
+    #* names are at most 15 characters).                                     *#
+    #*************************************************************************#
+    length = len(os.path.commonprefix(names)) + 1
+    rules  = []
+    for prefix, group in itertools.groupby(names, lambda name: name[:length]):
+        group = list(group)
+        if len(group) == 1:
+            rules += _dispatch_node(chains, flag, target_prefix, chain_prefix,
+                                    group, ifaces)
+        else:
+            chain_name = chain_prefix + prefix
+            chains[chain_name] = _dispatch_node(chains, flag, target_prefix,
+                                                chain_prefix, group, ifaces)
+            rules.append("%s %s+ -j %s" % (flag, prefix, chain_name))
+
+    return rules
+
+
+def _missing_jump_rules(state, id, iface, type):
+    """
+    Returns the jump rules for an endpoint (as returned by _ep_jump_rules)
+    that do not already exist, according to the index of jump rules in the
+    model of the filter table.
+    """
+    missing = []
+    for chain_name, rule in _ep_jump_rules(id, iface, type):
+        target = fchains.rule_target(rule.spec)
+        if (chain_name, rule.spec) in state.jumps_to(target):
+            log.debug("%s rule %s in %s already exists" %
+                      (type, rule.spec, chain_name))
+        else:
+            missing.append((chain_name, rule))
+
+    return missing
+
+
+def _log_rule_changes(id, type, ops):
+    """
+    Log the number of rules changed in the chains for an endpoint, given the
+    list of changes returned by fchains.diff_rules.
+    """
+    counts = {}
+    for op, posn, index in ops:
+        counts[op] = counts.get(op, 0) + 1
+
+    if ops:
+        log.info("Updated %s rules for endpoint %s : %d inserted, "
+                 "%d replaced, %d deleted" %
+                 (type, id,
+                  counts.get(fchains.OP_INSERT, 0),
+                  counts.get(fchains.OP_REPLACE, 0),
+                  counts.get(fchains.OP_DELETE, 0)))
+    else:
+        log.debug("%s rules for endpoint %s are up to date" % (type, id))
+
+
+def _ep_ipset_names(id, type, shared=None):
+    """
+    Returns the names of the ipsets for an endpoint, as a tuple of
+    (to_port, to_addr, to_icmp, from_port, from_addr, from_icmp). These are
+    the "list:set" ipsets if *shared* is True, and otherwise the ordinary
+    ipsets; *shared* defaults to whether shared ipsets are in use.
+    """
+    if shared is None:
+        shared = shared_ipsets
+
+    if shared and type == IPV4:
+        return (IPSET_LIST_TO_PORT_PREFIX + id,
+                IPSET_LIST_TO_ADDR_PREFIX + id,
+                IPSET_LIST_TO_ICMP_PREFIX + id,
+                IPSET_LIST_FROM_PORT_PREFIX + id,
+                IPSET_LIST_FROM_ADDR_PREFIX + id,
+                IPSET_LIST_FROM_ICMP_PREFIX + id)
+    elif shared:
+        return (IPSET6_LIST_TO_PORT_PREFIX + id,
+                IPSET6_LIST_TO_ADDR_PREFIX + id,
+                IPSET6_LIST_TO_ICMP_PREFIX + id,
+                IPSET6_LIST_FROM_PORT_PREFIX + id,
+                IPSET6_LIST_FROM_ADDR_PREFIX + id,
+                IPSET6_LIST_FROM_ICMP_PREFIX + id)
+    elif type == IPV4:
+        return (IPSET_TO_PORT_PREFIX + id,
+                IPSET_TO_ADDR_PREFIX + id,
+                IPSET_TO_ICMP_PREFIX + id,
+                IPSET_FROM_PORT_PREFIX + id,
+                IPSET_FROM_ADDR_PREFIX + id,
+                IPSET_FROM_ICMP_PREFIX + id)
+    else:
+        return (IPSET6_TO_PORT_PREFIX + id,
+                IPSET6_TO_ADDR_PREFIX + id,
+                IPSET6_TO_ICMP_PREFIX + id,
+                IPSET6_FROM_PORT_PREFIX + id,
+                IPSET6_FROM_ADDR_PREFIX + id,
+                IPSET6_FROM_ICMP_PREFIX + id)
+
+
+def _create_ep_ipsets(id, type):
+    """
+    Create the ipsets for an endpoint if they do not already exist.
+    """
+    (to_ipset_port, to_ipset_addr, to_ipset_icmp,
+     from_ipset_port, from_ipset_addr, from_ipset_icmp) = \
+        _ep_ipset_names(id, type)
+
+    if shared_ipsets:
+        # The list:set ipsets have no family, and are created in one go.
+        ipset_restore(type + " endpoint",
+                      ["create %s list:set" % name
+                       for name in _ep_ipset_names(id, type)])
+        return
+
     if type == IPV4:
-        to_ipset_port   = IPSET_TO_PORT_PREFIX + id
-        to_ipset_addr   = IPSET_TO_ADDR_PREFIX + id
-        to_ipset_icmp   = IPSET_TO_ICMP_PREFIX + id
-        from_ipset_port = IPSET_FROM_PORT_PREFIX + id
-        from_ipset_addr = IPSET_FROM_ADDR_PREFIX + id
-        from_ipset_icmp = IPSET_FROM_ICMP_PREFIX + id
-        family          = "inet"
+        family = "inet"
     else:
-        to_ipset_port   = IPSET6_TO_PORT_PREFIX + id
-        to_ipset_addr   = IPSET6_TO_ADDR_PREFIX + id
-        to_ipset_icmp   = IPSET6_TO_ICMP_PREFIX + id
-        from_ipset_port = IPSET6_FROM_PORT_PREFIX + id
-        from_ipset_addr = IPSET6_FROM_ADDR_PREFIX + id
-        from_ipset_icmp = IPSET6_FROM_ICMP_PREFIX + id
-        family            = "inet6"
+        family = "inet6"
 
-    # Create ipsets if they do not already exist.
     create_ipset(to_ipset_port, "hash:net,port", family)
     create_ipset(to_ipset_addr, "hash:net", family)
     create_ipset(to_ipset_icmp, "hash:net", family)
@@ -204,11 +734,16 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     create_ipset(from_ipset_addr, "hash:net", family)
     create_ipset(from_ipset_icmp, "hash:net", family)
 
-    # Get the table.
-    table = fiptables.get_table(type, "filter")
 
-    # Create the chains for packets to the interface
-    to_chain = fiptables.get_chain(table, to_chain_name)
+def _ep_to_rules(id, type):
+    """
+    Returns the list of rules that should be in the "to" chain for an
+    endpoint, in order.
+    """
+    (to_ipset_port, to_ipset_addr, to_ipset_icmp, _, _, _) = \
+        _ep_ipset_names(id, type)
+
+    rules = []
 
     #*************************************************************************#
     #* Put rules into that "from" chain, i.e. the chain traversed by         *#
@@ -218,8 +753,6 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     #* would be rejected by the "to" rules for another endpoint to which it  *#
     #* is addressed which happens to exist on the same host.                 *#
     #*************************************************************************#
-    index = 0
-
     if type == IPV6:
         #************************************************************************#
         #* In ipv6 only, there are 6 rules that need to be created first.       *#
@@ -238,30 +771,25 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
             rule = fiptables.Rule(futils.IPV6, "RETURN")
             rule.protocol = "icmpv6"
             rule.create_icmp6_match([icmp])
-            fiptables.insert_rule(rule, to_chain, index)
-            index += 1
+            rules.append(rule)
 
     rule = fiptables.Rule(type, "DROP")
     rule.create_conntrack_match(["INVALID"])
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
     # "Return if state RELATED or ESTABLISHED".
     rule = fiptables.Rule(type, "RETURN")
     rule.create_conntrack_match(["RELATED,ESTABLISHED"])
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
     # "Return anything whose source matches this ipset" (for three ipsets)
     rule = fiptables.Rule(type, "RETURN")
     rule.create_set_match([to_ipset_port, "src,dst"])
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
     rule = fiptables.Rule(type, "RETURN")
     rule.create_set_match([to_ipset_addr, "src"])
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
     rule = fiptables.Rule(type, "RETURN")
     if type is IPV4:
@@ -269,53 +797,47 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     else:
         rule.protocol = "icmpv6"
     rule.create_set_match([to_ipset_icmp, "src"])
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
     # If we get here, drop the packet.
     rule = fiptables.Rule(type, "DROP")
-    fiptables.insert_rule(rule, to_chain, index)
-    index += 1
+    rules.append(rule)
 
-    #*************************************************************************#
-    #* Delete all rules from here to the end of the chain, in case there     *#
-    #* were rules present which should not have been.                        *#
-    #*************************************************************************#
-    fiptables.truncate_rules(to_chain, index)
+    return rules
 
-    #*************************************************************************#
-    #* Now the chain that manages packets from the interface, and the rules  *#
-    #* in that chain.                                                        *#
-    #*************************************************************************#
-    from_chain = fiptables.get_chain(table, from_chain_name)
 
-    index = 0
+def _ep_from_rules(id, type, localips, mac):
+    """
+    Returns the list of rules that should be in the "from" chain for an
+    endpoint, in order.
+    """
+    (_, _, _, from_ipset_port, from_ipset_addr, from_ipset_icmp) = \
+        _ep_ipset_names(id, type)
+
+    rules = []
+
     if type == IPV6:
         # In ipv6 only, allows all ICMP traffic from this endpoint to anywhere.
         rule = fiptables.Rule(type, "RETURN")
         rule.protocol = "icmpv6"
-        fiptables.insert_rule(rule, from_chain, index)
-        index += 1
+        rules.append(rule)
 
     # "Drop if state INVALID".
     rule = fiptables.Rule(type, "DROP")
     rule.create_conntrack_match(["INVALID"])
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
     # "Return if state RELATED or ESTABLISHED".
     rule = fiptables.Rule(type, "RETURN")
     rule.create_conntrack_match(["RELATED,ESTABLISHED"])
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
     if type == IPV4:
         # Allow outgoing DHCP packets.
         rule = fiptables.Rule(type, "RETURN")
         rule.protocol = "udp"
         rule.create_udp_match("68", "67")
-        fiptables.insert_rule(rule, from_chain, index)
-        index += 1
+        rules.append(rule)
 
         #*********************************************************************#
         #* Drop UDP that would allow this server to act as a DHCP server.    *#
@@ -325,16 +847,14 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
         rule = fiptables.Rule(type, "DROP")
         rule.protocol = "udp"
         rule.create_udp_match("67", "68")
-        fiptables.insert_rule(rule, from_chain, index)
-        index += 1
+        rules.append(rule)
 
     else:
         # Allow outgoing DHCP packets.
         rule = fiptables.Rule(type, "RETURN")
         rule.protocol = "udp"
         rule.create_udp_match("546", "547")
-        fiptables.insert_rule(rule, from_chain, index)
-        index += 1
+        rules.append(rule)
 
     #*************************************************************************#
     #* Now only allow through packets from the correct MAC and IP address.   *#
@@ -344,29 +864,25 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     #* we insert before them and they get tidied up when we truncate the     *#
     #* chain.                                                                *#
     #*************************************************************************#
-    for ip in localips:
+    for ip in sorted(localips):
         rule = fiptables.Rule(type)
         rule.create_target("MARK", {"set_mark": "1"})
         rule.src = ip
         rule.create_mac_match(mac)
-        fiptables.insert_rule(rule, from_chain, index)
-        index += 1
+        rules.append(rule)
 
     rule = fiptables.Rule(type, "DROP")
     rule.create_mark_match("!1")
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
-  
+    rules.append(rule)
+
     # "Permit packets whose destination matches the supplied ipsets."
     rule = fiptables.Rule(type, "RETURN")
     rule.create_set_match([from_ipset_port, "dst,dst"])
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
     rule = fiptables.Rule(type, "RETURN")
     rule.create_set_match([from_ipset_addr, "dst"])
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
     rule = fiptables.Rule(type, "RETURN")
     if type is IPV4:
@@ -374,137 +890,93 @@ def set_ep_specific_rules(id, iface, type, localips, mac):
     else:
         rule.protocol = "icmpv6"
     rule.create_set_match([from_ipset_icmp, "dst"])
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
     # If we get here, drop the packet.
     rule = fiptables.Rule(type, "DROP")
-    fiptables.insert_rule(rule, from_chain, index)
-    index += 1
+    rules.append(rule)
 
-    #*************************************************************************#
-    #* Delete all rules from here to the end of the chain, in case there     *#
-    #* were rules present which should not have been.                        *#
-    #*************************************************************************#
-    fiptables.truncate_rules(from_chain, index)
+    return rules
 
-    #*************************************************************************#
-    #* This is a hack, because of a bug in python-iptables where it fails to *#
-    #* correctly match some rules; see                                       *#
-    #* https://github.com/ldx/python-iptables/issues/111 If any of the rules *#
-    #* relating to this tap device already exist, assume that they all do so *#
-    #* as not to recreate them.                                              *#
-    #*                                                                       *#
-    #* This is Calico issue #35,                                             *#
-    #* https://github.com/Metaswitch/calico/issues/35                        *#
-    #*************************************************************************#
-    if type == IPV4:
-        rules_check = subprocess.call(
-            "iptables -v -L %s | grep %s > /dev/null" %
-            (CHAIN_INPUT, iface), shell=True)
-    else:
-        rules_check = subprocess.call(
-            "ip6tables -v -L %s | grep %s > /dev/null" %
-            (CHAIN_INPUT, iface), shell=True)
 
-    if rules_check == 0:
-        log.debug("%s rules for interface %s already exist" % (type, iface))
-    else:
-        #*********************************************************************#
-        #* We have created the chains and rules that control input and       *#
-        #* output for the interface but not routed traffic through them. Add *#
-        #* the input rule detecting packets arriving for the endpoint.  Note *#
-        #* that these rules should perhaps be restructured and simplified    *#
-        #* given that this is not a bridged network -                        *#
-        #* https://github.com/Metaswitch/calico/issues/36                    *#
-        #*********************************************************************#
-        log.debug("%s rules for interface %s do not already exist" %
-                  (type, iface))
-        chain = fiptables.get_chain(table, CHAIN_INPUT)
+def _ep_jump_rules(id, iface, type):
+    """
+    Returns the rules that direct packets for an endpoint to its chains, as a
+    list of (chain name, rule) pairs. Packets arriving from the endpoint are
+    sent to the "from" chain by felix-INPUT and felix-FORWARD, and packets
+    forwarded to the endpoint are sent to the "to" chain by felix-FORWARD.
+    """
+    to_chain_name   = CHAIN_TO_PREFIX + id
+    from_chain_name = CHAIN_FROM_PREFIX + id
 
-        rule = fiptables.Rule(type, from_chain_name)
-        rule.in_interface = iface
-        fiptables.insert_rule(rule, chain, fiptables.RULE_POSN_LAST)
+    input_rule = fiptables.Rule(type, from_chain_name)
+    input_rule.in_interface = iface
 
-        #*********************************************************************#
-        #* Similarly, create the rules that direct packets that are          *#
-        #* forwarded either to or from the endpoint, sending them to the     *#
-        #* "to" or "from" chains as appropriate.                             *#
-        #*********************************************************************#
-        chain = fiptables.get_chain(table, CHAIN_FORWARD)
+    from_rule = fiptables.Rule(type, from_chain_name)
+    from_rule.in_interface = iface
 
-        rule = fiptables.Rule(type, from_chain_name)
-        rule.in_interface = iface
-        fiptables.insert_rule(rule, chain, fiptables.RULE_POSN_LAST)
+    to_rule = fiptables.Rule(type, to_chain_name)
+    to_rule.out_interface = iface
 
-        rule = fiptables.Rule(type, to_chain_name)
-        rule.out_interface = iface
-        fiptables.insert_rule(rule, chain, fiptables.RULE_POSN_LAST)
-    return
+    return [(CHAIN_INPUT, input_rule),
+            (CHAIN_FORWARD, from_rule),
+            (CHAIN_FORWARD, to_rule)]
 
 
 def del_rules(id, type):
     """
     Remove the rules for an endpoint which is no longer managed.
     """
-    log.debug("Delete %s rules for %s" % (type, id))
-    to_chain   = CHAIN_TO_PREFIX + id
-    from_chain = CHAIN_FROM_PREFIX + id
-    table = fiptables.get_table(type, "filter")
+    del_rules_batch([id], type)
 
-    if type == IPV4:
-        to_ipset_port   = IPSET_TO_PORT_PREFIX + id
-        to_ipset_addr   = IPSET_TO_ADDR_PREFIX + id
-        from_ipset_port = IPSET_FROM_PORT_PREFIX + id
-        from_ipset_addr = IPSET_FROM_ADDR_PREFIX + id
+
+def del_rules_batch(ids, type):
+    """
+    Remove the rules for a set of endpoints which are no longer managed,
+    using a single iptables-restore transaction for all of them.
+    """
+    log.debug("Delete %s rules for %s" % (type, ", ".join(ids)))
+    state = fiptables.get_state(type, "filter")
+
+    #*************************************************************************#
+    #* Remove the rules routing to the chains we are about to remove, then   *#
+    #* the chains themselves. The rules are found from the index of jump     *#
+    #* rules in the model, and deleted by their exact spec, so there is no   *#
+    #* need to scan felix-INPUT and felix-FORWARD or to track rule numbers.  *#
+    #* When using dispatch chains, the tree is rebalanced instead.           *#
+    #*************************************************************************#
+    if dispatch_mode == DISPATCH_TREE:
+        jumps = _dispatch_updates(type, remove=ids)
     else:
-        to_ipset_port   = IPSET6_TO_PORT_PREFIX + id
-        to_ipset_addr   = IPSET6_TO_ADDR_PREFIX + id
-        from_ipset_port = IPSET6_FROM_PORT_PREFIX + id
-        from_ipset_addr = IPSET6_FROM_ADDR_PREFIX + id
+        jumps = []
+
+    chains = []
+    for id in ids:
+        for name in (CHAIN_TO_PREFIX + id, CHAIN_FROM_PREFIX + id):
+            if dispatch_mode == DISPATCH_FLAT:
+                for chain_name, spec in state.jumps_to(name):
+                    jumps.append("-D %s %s" % (chain_name, spec))
+
+            # Delete the from and to chains for this endpoint.
+            if state.has_chain(name):
+                chains.append("-F %s" % name)
+                chains.append("-X %s" % name)
 
+    fiptables.restore(type, "filter", jumps + chains)
 
     #*************************************************************************#
-    #* Remove the rules routing to the chain we are about to remove. The     *#
-    #* baroque structure is caused by the python-iptables interface.         *#
-    #* chain.rules returns a list of rules, each of which contains its index *#
-    #* (i.e. position). If we get rules 7 and 8 and try to remove them in    *#
-    #* that order, then the second fails because rule 8 got renumbered when  *#
-    #* rule 7 was deleted, so the rule we have in our hand neither matches   *#
-    #* the old rule 8 (now at index 7) or the new rule 8 (with a different   *#
-    #* target etc. Hence each time we remove a rule we rebuild the list of   *#
-    #* rules to iterate through.                                             *#
-    #*                                                                       *#
-    #* In principle we could use autocommit to make this much nicer (as the  *#
-    #* python-iptables docs suggest), but in practice it seems a bit buggy,  *#
-    #* and leads to errors elsewhere. Reversing the list sounds like it      *#
-    #* should work too, but in practice does not.                            *#
+    #* Delete the ipsets for these endpoints, of both kinds in case shared   *#
+    #* ipsets have been turned on or off, then release any shared ipsets     *#
+    #* they referenced.                                                      *#
     #*************************************************************************#
-    for name in (CHAIN_INPUT, CHAIN_FORWARD):
-        chain = fiptables.get_chain(table, name)
-        done  = False
-        while not done:
-            done = True
-            for rule in chain.rules:
-                if rule.target.name in (to_chain, from_chain):
-                    chain.delete_rule(rule)
-                    done = False
-                    break
-
-    # Delete the from and to chains for this endpoint.
-    for name in (from_chain, to_chain):
-        if table.is_chain(name):
-            chain = fiptables.get_chain(table, name)
-            log.debug("Flush chain %s", name)
-            chain.flush()
-            log.debug("Delete chain %s", name)
-            table.delete_chain(name)
-
-    # Delete the ipsets for this endpoint.
-    for ipset in [from_ipset_addr, from_ipset_port,
-                  to_ipset_addr, to_ipset_port]:
-        if futils.call_silent(["ipset", "list", ipset]) == 0:
-            futils.check_call(["ipset", "destroy", ipset])
+    for id in ids:
+        for ipset in (_ep_ipset_names(id, type, shared=True) +
+                      _ep_ipset_names(id, type, shared=False)):
+            if ipset in _ipsets:
+                futils.check_ipset(["destroy", ipset])
+                _ipsets.discard(ipset)
+
+        _release_shared_ipsets(_ep_shared_ipsets.pop((id, type), []))
 
 
 def set_acls(id, type, inbound, in_default, outbound, out_default):
@@ -545,14 +1017,10 @@ def set_acls(id, type, inbound, in_default, outbound, out_default):
         #*********************************************************************#
         log.critical("Only default deny rules are implemented")
 
-    # Verify that the tmp ipsets exist and are empty.
-    create_ipset(tmp_ipset_port, "hash:net,port", family)
-    create_ipset(tmp_ipset_addr, "hash:net", family)
-    create_ipset(tmp_ipset_icmp, "hash:net", family)
-
-    futils.check_call(["ipset", "flush", tmp_ipset_port])
-    futils.check_call(["ipset", "flush", tmp_ipset_addr])
-    futils.check_call(["ipset", "flush", tmp_ipset_icmp])
+    if shared_ipsets:
+        set_shared_acls(id, type, inbound, outbound,
+                        tmp_ipset_addr, tmp_ipset_port, tmp_ipset_icmp)
+        return
 
     update_ipsets(type, type + " inbound",
                   inbound,
@@ -564,6 +1032,125 @@ def set_acls(id, type, inbound, in_default, outbound, out_default):
                   tmp_ipset_addr, tmp_ipset_port, tmp_ipset_icmp)
 
 
+def set_shared_acls(id, type, inbound, outbound,
+                    tmp_ipset_addr, tmp_ipset_port, tmp_ipset_icmp):
+    """
+    Set up the ACLs for an endpoint using shared ipsets, in a single
+    "ipset restore" command.
+
+    Any shared ipsets not already in use are created and filled (using the
+    tmp ipsets and swapping, in case the set exists from a previous run and
+    is in use). The endpoint's list:set ipsets are then pointed at the shared
+    ipsets, again by filling a tmp list:set and swapping it with the real one,
+    so that no packets see an empty set. Shared ipsets that are no longer
+    referenced are destroyed afterwards.
+    """
+    if type == IPV4:
+        family      = "inet"
+        net_prefix  = IPSET_SHARED_NET_PREFIX
+        port_prefix = IPSET_SHARED_PORT_PREFIX
+    else:
+        family      = "inet6"
+        net_prefix  = IPSET6_SHARED_NET_PREFIX
+        port_prefix = IPSET6_SHARED_PORT_PREFIX
+
+    (to_ipset_port, to_ipset_addr, to_ipset_icmp,
+     from_ipset_port, from_ipset_addr, from_ipset_icmp) = \
+        _ep_ipset_names(id, type)
+
+    lines  = _tmp_ipset_lines(type, tmp_ipset_addr, tmp_ipset_port,
+                              tmp_ipset_icmp)
+    lines += ["create %s list:set" % IPSET_TMP_LIST,
+              "flush %s" % IPSET_TMP_LIST]
+
+    # List of (endpoint list:set ipset, shared ipset) pairs.
+    members = []
+    created = set()
+
+    for descr, rule_list, ipset_port, ipset_addr, ipset_icmp in (
+            (type + " inbound", inbound,
+             to_ipset_port, to_ipset_addr, to_ipset_icmp),
+            (type + " outbound", outbound,
+             from_ipset_port, from_ipset_addr, from_ipset_icmp)):
+        addr_entries, port_entries, icmp_entries = _ipset_entries(type,
+                                                                  descr,
+                                                                  rule_list)
+        for ipset, tmp_ipset, typename, prefix, entries in (
+                (ipset_port, tmp_ipset_port, "hash:net,port", port_prefix,
+                 port_entries),
+                (ipset_addr, tmp_ipset_addr, "hash:net", net_prefix,
+                 addr_entries),
+                (ipset_icmp, tmp_ipset_icmp, "hash:net", net_prefix,
+                 icmp_entries)):
+            entries = sorted(set(entries))
+            shared  = _shared_ipset_name(prefix, entries)
+            members.append((ipset, shared))
+
+            # Shared ipsets already in use are left alone, unless they have
+            # been destroyed from under us.
+            if ((shared in _shared_ipset_refs and shared in _ipsets) or
+                    shared in created):
+                continue
+
+            created.add(shared)
+            lines.append("create %s %s family %s" % (shared, typename, family))
+            for entry in entries:
+                lines.append("add %s %s" % (tmp_ipset, entry))
+            lines.append("swap %s %s" % (tmp_ipset, shared))
+            lines.append("flush %s" % tmp_ipset)
+
+    for ipset, shared in members:
+        lines.append("create %s list:set" % ipset)
+        lines.append("add %s %s" % (IPSET_TMP_LIST, shared))
+        lines.append("swap %s %s" % (IPSET_TMP_LIST, ipset))
+        lines.append("flush %s" % IPSET_TMP_LIST)
+
+    ipset_restore(type + " ACL", lines)
+
+    log.debug("Set %s ACLs for %s using shared ipsets %s (%d new)" %
+              (type, id, [shared for ipset, shared in members], len(created)))
+
+    # Now update the reference counts, releasing the old shared ipsets.
+    old = _ep_shared_ipsets.get((id, type), [])
+    new = [shared for ipset, shared in members]
+    for shared in new:
+        _shared_ipset_refs[shared] = _shared_ipset_refs.get(shared, 0) + 1
+    _ep_shared_ipsets[(id, type)] = new
+    _release_shared_ipsets(old)
+
+
+def _shared_ipset_name(prefix, entries):
+    """
+    Returns the name of the shared ipset with the given prefix holding a
+    sorted list of entries.
+    """
+    digest = hashlib.sha1("\n".join(entries)).hexdigest()
+    return prefix + digest[:IPSET_SHARED_HASH_LEN]
+
+
+def _release_shared_ipsets(names):
+    """
+    Drop a reference to each of a list of shared ipsets, destroying those
+    that are no longer referenced.
+    """
+    for name in names:
+        _shared_ipset_refs[name] -= 1
+        if _shared_ipset_refs[name] > 0:
+            continue
+
+        del _shared_ipset_refs[name]
+
+        #*********************************************************************#
+        #* After a restart, an ipset may still be referenced by an endpoint  *#
+        #* whose ACLs have not been set since; in that case it cannot be     *#
+        #* destroyed yet, and is destroyed by a later resync instead.        *#
+        #*********************************************************************#
+        if futils.call_ipset_silent(["destroy", name]) == 0:
+            _ipsets.discard(name)
+        else:
+            log.debug("Shared ipset %s is still in use" % name)
+
+
 def update_ipsets(type,
                   descr,
                   rule_list,
@@ -576,7 +1163,64 @@ def update_ipsets(type,
     """
     Update the ipsets with a given set of rules. If a rule is invalid we do
     not throw an exception or give up, but just log an error and continue.
+
+    The temporary ipsets are created if necessary, filled, swapped with the
+    real ones and emptied again by a single "ipset restore" command.
+    """
+    lines = _tmp_ipset_lines(type, tmp_ipset_addr, tmp_ipset_port,
+                             tmp_ipset_icmp)
+
+    addr_entries, port_entries, icmp_entries = _ipset_entries(type,
+                                                              descr,
+                                                              rule_list)
+    for ipset, entries in ((tmp_ipset_addr, addr_entries),
+                           (tmp_ipset_port, port_entries),
+                           (tmp_ipset_icmp, icmp_entries)):
+        for entry in entries:
+            lines.append("add %s %s" % (ipset, entry))
+
+    # Now that we have filled the tmp ipset, swap it with the real one.
+    lines.append("swap %s %s" % (tmp_ipset_addr, ipset_addr))
+    lines.append("swap %s %s" % (tmp_ipset_port, ipset_port))
+    lines.append("swap %s %s" % (tmp_ipset_icmp, ipset_icmp))
+
+    # Get the temporary ipsets clean again - we leave them existing but empty.
+    lines.append("flush %s" % tmp_ipset_port)
+    lines.append("flush %s" % tmp_ipset_addr)
+    lines.append("flush %s" % tmp_ipset_icmp)
+
+    ipset_restore(descr, lines)
+
+
+def _tmp_ipset_lines(type, tmp_ipset_addr, tmp_ipset_port, tmp_ipset_icmp):
+    """
+    Returns the "ipset restore" lines that verify that the tmp ipsets exist
+    and are empty.
     """
+    if type == IPV4:
+        family = "inet"
+    else:
+        family = "inet6"
+
+    return ["create %s hash:net,port family %s" % (tmp_ipset_port, family),
+            "create %s hash:net family %s" % (tmp_ipset_addr, family),
+            "create %s hash:net family %s" % (tmp_ipset_icmp, family),
+            "flush %s" % tmp_ipset_port,
+            "flush %s" % tmp_ipset_addr,
+            "flush %s" % tmp_ipset_icmp]
+
+
+def _ipset_entries(type, descr, rule_list):
+    """
+    Works out the ipset entries for a given set of rules. If a rule is
+    invalid we do not throw an exception or give up, but just log an error
+    and continue.
+
+    Returns a tuple of three lists of entries, for the "addr", "port" and
+    "icmp" ipsets respectively.
+    """
+    entries = {"addr": [], "port": [], "icmp": []}
+
     for rule in rule_list:
         if rule.get('cidr') is None:
             log.error("Invalid %s rule without cidr for %s : %s",
@@ -625,12 +1269,12 @@ def update_ipsets(type,
                     descr, id, rule)
                 continue
             suffix = ""
-            ipset  = tmp_ipset_addr
+            ipset  = "addr"
         elif protocol in ("tcp", "sctp", "udp", "udplite"):
             if port is None:
                 # ipsets use port 0 to mean "any port"
                 suffix = ",%s:0" % (protocol)
-                ipset = tmp_ipset_port
+                ipset = "port"
             else:
                 if not futils.PORT_REGEX.match(str(port)):
                     # Port was supplied but was not an integer.
@@ -641,7 +1285,7 @@ def update_ipsets(type,
 
                 # An integer port was specified.
                 suffix = ",%s:%s" % (protocol, port)
-                ipset = tmp_ipset_port
+                ipset = "port"
         elif protocol in ("icmp", "icmpv6"):
             if (icmp_type is None and icmp_code is not None):
                 # A code but no type - not allowed.
@@ -652,17 +1296,17 @@ def update_ipsets(type,
             if icmp_type is None:
                 # No type - all ICMP to / from the cidr, so use the ICMP ipset.
                 suffix = ""
-                ipset  = tmp_ipset_icmp
+                ipset  = "icmp"
             elif futils.INT_REGEX.match(str(icmp_type)):
                 if icmp_code is None:
                     # Code defaults to 0 if not supplied.
                     icmp_code = 0
                 suffix = ",%s:%s/%s" % (protocol, icmp_type, icmp_code)
-                ipset  = tmp_ipset_port
+                ipset  = "port"
             else:
                 # Not an integer ICMP type - must be a string code name.
                 suffix = ",%s:%s" % (protocol, icmp_type)
-                ipset  = tmp_ipset_port
+                ipset  = "port"
         else:
             if port is not None:
                 # The supplied protocol does not allow ports.
@@ -672,25 +1316,164 @@ def update_ipsets(type,
                 continue
             # ipsets use port 0 to mean "any port"
             suffix = ",%s:0" % (protocol)
-            ipset = tmp_ipset_port
+            ipset = "port"
 
         # Now add those values to the ipsets.
         for cidr in cidrs:
-            args = ["ipset", "add", ipset, cidr + suffix, "-exist"]
+            entries[ipset].append(cidr + suffix)
+
+    return entries["addr"], entries["port"], entries["icmp"]
+
+
+def ipset_restore(descr, lines):
+    """
+    Apply a list of ipset commands (in "ipset restore" format, such as
+    "add felix-tmp-addr 10.0.0.0/8") with "ipset restore -exist".
+
+    ipset restore is not transactional; it applies each line in turn and
+    stops at the first one that fails. If that line adds an entry to a set,
+    the entry is reported and dropped, and ipset restore is run again on the
+    lines after it. Each line is therefore written at most once, however many
+    entries are bad. Any other failure throws a FailedSystemCall exception.
+
+    If sessions are in use (see futils.set_use_sessions), the lines are sent
+    to the long-lived "ipset -" session instead; see _ipset_session_restore.
+    """
+    lines = list(lines)
+    start = 0
+
+    if futils.use_sessions:
+        _ipset_session_restore(descr, lines)
+        return
+
+    try:
+        while start < len(lines):
             try:
-                stdout, stderr = futils.check_call(args)
-            except FailedSystemCall:
-                log.exception("Failed to add %s rule for %s" % (descr, id))
+                futils.check_call(["ipset", "restore", "-exist"],
+                                  input_data="\n".join(lines[start:]) + "\n")
+                start = len(lines)
+            except FailedSystemCall as e:
+                match = IPSET_ERROR_LINE_REGEX.search(e.stderr)
+                if match is None:
+                    raise
+
+                index = start + int(match.group(1)) - 1
+                if index >= len(lines) or not lines[index].startswith("add "):
+                    # The lines before this one were applied.
+                    start = min(index, len(lines))
+                    raise
+
+                log.error("Failed to add %s ipset entry \"%s\" : %s" %
+                          (descr, lines[index][len("add "):], e.stderr.strip()))
+                del lines[index]
+                start = index
+    finally:
+        # Keep the inventory of ipsets up to date.
+        for line in lines[:start]:
+            words = line.split()
+            if words[0] == "create":
+                _ipsets.add(words[1])
+            elif words[0] == "destroy":
+                _ipsets.discard(words[1])
+
+
+def _ipset_session_restore(descr, lines):
+    """
+    As ipset_restore, but the lines are run as separate commands by the
+    long-lived "ipset -" session. A bad entry is therefore reported and
+    dropped without anything being run again. After any other failure the
+    lines after it are still run, and then a FailedSystemCall exception is
+    thrown for the first such failure.
+    """
+    commands = [line.split() + ["-exist"] for line in lines]
+    errors   = futils.ipset_batch(commands)
 
-    # Now that we have filled the tmp ipset, swap it with the real one.
-    futils.check_call(["ipset", "swap", tmp_ipset_addr, ipset_addr])
-    futils.check_call(["ipset", "swap", tmp_ipset_port, ipset_port])
-    futils.check_call(["ipset", "swap", tmp_ipset_icmp, ipset_icmp])
+    # Keep the inventory of ipsets up to date.
+    for index, line in enumerate(lines):
+        if index in errors:
+            continue
+        words = line.split()
+        if words[0] == "create":
+            _ipsets.add(words[1])
+        elif words[0] == "destroy":
+            _ipsets.discard(words[1])
+
+    failure = None
+    for index in sorted(errors):
+        if lines[index].startswith("add "):
+            log.error("Failed to add %s ipset entry \"%s\" : %s" %
+                      (descr, lines[index][len("add "):],
+                       errors[index].strip()))
+        elif failure is None:
+            failure = index
+
+    if failure is not None:
+        raise FailedSystemCall("Failed system call",
+                               ["ipset"] + commands[failure], 1, "",
+                               errors[failure])
+
+
+def load_inventory():
+    """
+    Take a snapshot of the dataplane state that Felix owns, for use by
+    list_eps_with_rules and all the checks for whether chains and ipsets
+    exist. This is done at start of day and on each resync; the rest of the
+    time the snapshot is kept up to date as we make changes.
+
+    The snapshot is taken with a single iptables-save (or ip6tables-save) per
+    table, and a single "ipset list -n", which lists just the names of the
+    ipsets rather than all of their members. Unreferenced shared ipsets are
+    then destroyed.
+    """
+    fiptables.load_state()
+
+    data = futils.check_call(["ipset", "list", "-n"]).stdout
+    _ipsets.clear()
+    _ipsets.update(name for name in data.split() if name.startswith("felix-"))
+    log.debug("Loaded %d ipsets" % len(_ipsets))
+
+    _collect_shared_ipsets()
 
-    # Get the temporary ipsets clean again - we leave them existing but empty.
-    futils.check_call(["ipset", "flush", tmp_ipset_port])
-    futils.check_call(["ipset", "flush", tmp_ipset_addr])
-    futils.check_call(["ipset", "flush", tmp_ipset_icmp])
+
+def _collect_shared_ipsets():
+    """
+    Destroy any shared ipsets that exist but that we hold no references to.
+
+    The reference counts are only kept in memory, so shared ipsets left
+    behind by a previous run would otherwise never be destroyed. The kernel
+    refuses to destroy an ipset that is still a member of a list:set, so
+    those still used by an endpoint whose ACLs have not been set since the
+    restart are kept, and are counted again when its ACLs are next set.
+    """
+    for name in sorted(_ipsets):
+        if (not name.startswith(IPSET_SHARED_PREFIXES) or
+            name in _shared_ipset_refs):
+            continue
+
+        if futils.call_ipset_silent(["destroy", name]) == 0:
+            log.info("Destroyed unreferenced shared ipset %s" % name)
+            _ipsets.discard(name)
+        else:
+            log.debug("Unreferenced shared ipset %s is still in use" % name)
+
+
+def ep_ipsets_exist(id, type):
+    """
+    Returns True if all the ipsets for an endpoint exist, according to the
+    snapshot taken by load_inventory.
+    """
+    return all(name in _ipsets for name in _ep_ipset_names(id, type))
+
+
+def ep_acl_ipsets_exist(id, type):
+    """
+    Returns True if all the ipsets holding an endpoint's ACLs exist, according
+    to the snapshot taken by load_inventory: the endpoint's own ipsets, and
+    with shared ipsets the shared ipsets that they refer to.
+    """
+    return (ep_ipsets_exist(id, type) and
+            all(name in _ipsets
+                for name in _ep_shared_ipsets.get((id, type), [])))
 
 
 def list_eps_with_rules(type):
@@ -701,7 +1484,7 @@ def list_eps_with_rules(type):
 
     The purpose of this routine is to get a list of endpoints (actually tap
     suffices) for which there is configuration that Felix might need to tidy up
-    from a previous iteration.
+    from a previous iteration. It uses the snapshot taken by load_inventory.
     """
 
     #*************************************************************************#
@@ -712,23 +1495,21 @@ def list_eps_with_rules(type):
     #* creation created one ipset then Felix terminated, where we have to    *#
     #* detect that there is an ipset lying around that needs tidying up.     *#
     #*************************************************************************#
-    table = fiptables.get_table(type, "filter")
+    state = fiptables.get_state(type, "filter")
 
-    eps  = {chain.name.replace(CHAIN_TO_PREFIX, "")
-            for chain in table.chains
-            if chain.name.startswith(CHAIN_TO_PREFIX)}
+    eps  = {name.replace(CHAIN_TO_PREFIX, "")
+            for name in state.chains
+            if name.startswith(CHAIN_TO_PREFIX)}
 
-    data  = futils.check_call(["ipset", "list"]).stdout
-    lines = data.split("\n")
+    if type == IPV4:
+        prefixes = (IPSET_TO_PORT_PREFIX, IPSET_LIST_TO_PORT_PREFIX)
+    else:
+        prefixes = (IPSET6_TO_PORT_PREFIX, IPSET6_LIST_TO_PORT_PREFIX)
 
-    for line in lines:
-        words = line.split()
-        if (len(words) > 1 and words[0] == "Name:" and
-                words[1].startswith(IPSET_TO_PORT_PREFIX)):
-            eps.add(words[1].replace(IPSET_TO_PORT_PREFIX, ""))
-        elif (len(words) > 1 and words[0] == "Name:" and
-              words[1].startswith(IPSET6_TO_PORT_PREFIX)):
-            eps.add(words[1].replace(IPSET6_TO_PORT_PREFIX, ""))
+    for name in _ipsets:
+        for prefix in prefixes:
+            if name.startswith(prefix):
+                eps.add(name[len(prefix):])
 
     return eps
 
@@ -740,9 +1521,10 @@ def create_ipset(name, typename, family):
     *typename* must be a valid type, such as "hash:net" or "hash:net,port"
     *family* must be *inet* or *inet6*
     """
-    if futils.call_silent(["ipset", "list", name]) != 0:
-        # ipset list failed - either does not exist, or an error. Either way,
-        # try creation, throwing an error if it does not work.
-        futils.check_call(
-            ["ipset", "create", name, typename, "family", family])
+    if name not in _ipsets:
+        # Not in the inventory, so try creation, throwing an error if it does
+        # not work.
+        futils.check_ipset(
+            ["create", name, typename, "family", family, "-exist"])
+        _ipsets.add(name)
 
@@ -53,9 +53,17 @@ class Socket(object):
 
     ZTYPE = {TYPE_EP_REQ:  zmq.REQ,
              TYPE_EP_REP:  zmq.REP,
-             TYPE_ACL_REQ: zmq.REQ,
+             TYPE_ACL_REQ: zmq.DEALER,
              TYPE_ACL_SUB: zmq.SUB}
 
+    #*************************************************************************#
+    #* Request sockets on which requests are pipelined: up to a window of    *#
+    #* requests can be outstanding at once. Each request carries a request   *#
+    #* ID, which the other end echoes in its response so that the response   *#
+    #* can be matched to the request.                                        *#
+    #*************************************************************************#
+    PIPELINED_TYPES = set((TYPE_ACL_REQ,))
+
     def __init__(self, type, config):
         self.config = config
         self.type = type
@@ -65,11 +73,20 @@ class Socket(object):
         self.last_activity = None
         self.request_outstanding = False
 
+        # For pipelined sockets, the requests awaiting responses, keyed off
+        # request ID, and the most that can be outstanding.
+        self.in_flight = {}
+        self.window = 1
+        self.next_request_id = 0
+
         if type in Socket.EP_TYPES:
             self.remote_addr = self.config.PLUGIN_ADDR
         else:
             self.remote_addr = self.config.ACL_ADDR
 
+        if type == Socket.TYPE_ACL_REQ:
+            self.window = self.config.ACL_REQ_WINDOW
+
     def close(self):
         """
         Close this connection cleanly.
@@ -97,6 +114,10 @@ class Socket(object):
             self._zmq.setsockopt(zmq.IDENTITY, hostname)
             self._zmq.setsockopt(zmq.SUBSCRIBE, 'aclheartbeat')
 
+        # Responses to requests sent on any previous connection are lost.
+        self.in_flight = {}
+        self.request_outstanding = False
+
         # The socket connection event is always the time of last activity.
         self.last_activity = int(time.time() * 1000)
 
@@ -109,17 +130,29 @@ class Socket(object):
 
         #*********************************************************************#
         #* We never expect any type of socket that we use to block since we  *#
-        #* use only REQ or REP sockets - so if we get blocking then we       *#
-        #* consider that something is wrong, and let the exception take down *#
-        #* Felix.                                                            *#
+        #* never send more requests than we are allowed outstanding - so if  *#
+        #* we get blocking then we consider that something is wrong, and let *#
+        #* the exception take down Felix.                                    *#
         #*********************************************************************#
         try:
-            self._zmq.send(msg.zmq_msg, zmq.NOBLOCK)
+            if self.type in Socket.PIPELINED_TYPES:
+                # Send with the empty delimiter frame that a REQ socket
+                # would add.
+                request_id = str(self.next_request_id)
+                self.next_request_id += 1
+                msg.fields['request_id'] = request_id
+                self._zmq.send_multipart(["", msg.zmq_msg], zmq.NOBLOCK)
+
+                self.in_flight[request_id] = msg
+                self.request_outstanding = (len(self.in_flight) >=
+                                            self.window)
+            else:
+                self._zmq.send(msg.zmq_msg, zmq.NOBLOCK)
 
-            if self.type in Socket.REQUEST_TYPES:
-                self.request_outstanding = True
+                if self.type in Socket.REQUEST_TYPES:
+                    self.request_outstanding = True
         except:
-            log.exception("Socket %s blocked on send", sock.type)
+            log.exception("Socket %s blocked on send", self.type)
             raise
 
     def receive(self):
@@ -135,7 +168,10 @@ class Socket(object):
         #* that something is wrong, and let the exception take down Felix.   *#
         #*********************************************************************#
         try:
-            if self.type != Socket.TYPE_ACL_SUB:
+            if self.type in Socket.PIPELINED_TYPES:
+                data = self._zmq.recv_multipart(zmq.NOBLOCK)[-1]
+                uuid = None
+            elif self.type != Socket.TYPE_ACL_SUB:
                 data = self._zmq.recv(zmq.NOBLOCK)
                 uuid = None
             else:
@@ -149,12 +185,26 @@ class Socket(object):
         # Log that we received the message.
         log.info("Received %s on socket %s" % (message.descr, self.type))
 
+        self.last_activity = int(time.time() * 1000)
+
         # If this is a response, we're no longer waiting for one.
-        if self.type in Socket.REQUEST_TYPES:
+        if self.type in Socket.PIPELINED_TYPES:
+            request_id = message.fields.get('request_id')
+            if request_id is None and self.in_flight:
+                # The other end does not echo request IDs, but answers
+                # requests in order, so this answers the oldest.
+                request_id = min(self.in_flight, key=int)
+
+            if self.in_flight.pop(request_id, None) is None:
+                # A response to a request we have given up on, sent on a
+                # previous connection; nothing is waiting for it.
+                log.warning("Ignoring %s on socket %s with unknown request "
+                            "ID %s" % (message.descr, self.type, request_id))
+                return None
+            self.request_outstanding = len(self.in_flight) >= self.window
+        elif self.type in Socket.REQUEST_TYPES:
             self.request_outstanding = False
 
-        self.last_activity = int(time.time() * 1000)
-
         # A special case: heartbeat messages on the subscription interface are
         # swallowed; the application code has no use for them.
         if (self.type == Socket.TYPE_ACL_SUB and
@@ -163,6 +213,13 @@ class Socket(object):
 
         return message
 
+    def readable(self):
+        """
+        Returns True if a message can be received on this socket without
+        blocking.
+        """
+        return bool(self._zmq.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+
     def timed_out(self):
         """
         Returns True if the socket has been inactive for at least the timeout;
@@ -180,6 +237,7 @@ class Message(object):
     TYPE_EP_UP     = "ENDPOINTUPDATED"
     TYPE_EP_RM     = "ENDPOINTDESTROYED"
     TYPE_GET_ACL   = "GETACLSTATE"
+    TYPE_GET_ACLS  = "GETACLSTATES"
     TYPE_ACL_UPD   = "ACLUPDATE"
     TYPE_HEARTBEAT = "HEARTBEAT"
 
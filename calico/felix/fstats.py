@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fstats
+~~~~~~~~~~~~
+
+Counts and timings of the calls that Felix makes to external programs and to
+python-iptables, so that we can see where the time goes.
+
+Recording a call just updates a few counters; the statistics are only
+formatted when they are read. Other values of interest, such as the lengths
+of queues, can be set to be reported with the statistics.
+"""
+import logging
+import os
+
+# Logger
+log = logging.getLogger(__name__)
+
+#*****************************************************************************#
+#* Number of buckets in each latency histogram. Bucket 0 counts calls that   *#
+#* took less than 1ms, and bucket n (for n > 0) calls that took from         *#
+#* 2^(n-1)ms to 2^n ms; the last bucket also counts anything slower.         *#
+#*****************************************************************************#
+HISTOGRAM_BUCKETS = 16
+
+# Dictionary mapping the name of each type of call to its CallStats.
+stats = {}
+
+# Dictionary mapping the name of each other value reported to its value.
+values = {}
+
+
+class CallStats(object):
+    """
+    Statistics for one type of call.
+    """
+    def __init__(self, name):
+        self.name      = name
+        self.count     = 0
+        self.total     = 0.0
+        self.max       = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        bucket = min(int(elapsed * 1000).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def __str__(self):
+        buckets = ["<%dms:%d" % (1 << bucket, count)
+                   for bucket, count in enumerate(self.histogram) if count]
+        return ("%s : count %d, total %.3fs, mean %.1fms, max %.1fms, %s" %
+                (self.name,
+                 self.count,
+                 self.total,
+                 self.total * 1000 / self.count,
+                 self.max * 1000,
+                 " ".join(buckets)))
+
+
+def record(name, elapsed):
+    """
+    Record a call of the named type that took *elapsed* seconds.
+    """
+    try:
+        stats[name].record(elapsed)
+    except KeyError:
+        stats[name] = CallStats(name)
+        stats[name].record(elapsed)
+
+
+def set_value(name, value):
+    """
+    Set a value to be reported with the statistics.
+    """
+    values[name] = value
+
+
+def command_name(args):
+    """
+    Returns the name under which a command (a list of arguments) is counted.
+    This is the program followed by its first argument that is not an option
+    (such as "ipset add" or "ip route"), so that the different uses of each
+    program are counted separately.
+    """
+    program = os.path.basename(args[0])
+    for arg in args[1:]:
+        if not arg.startswith("-"):
+            return "%s %s" % (program, arg)
+    return program
+
+
+def log_stats():
+    """
+    Write the statistics to the log, most expensive type of call first,
+    followed by the other values.
+    """
+    if stats:
+        log.info("Statistics for external calls :")
+        for call_stats in sorted(stats.values(),
+                                 key=lambda call_stats: call_stats.total,
+                                 reverse=True):
+            log.info("  %s" % call_stats)
+
+    for name in sorted(values):
+        log.info("%s : %s" % (name, values[name]))
+
+
+def reset():
+    """
+    Discard all of the statistics and values.
+    """
+    stats.clear()
+    values.clear()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.ftimers
+~~~~~~~~~~~~
+
+Named timers for the work that Felix does periodically, kept in a heap so
+that the main loop can sleep until the next one is due.
+"""
+import heapq
+import itertools
+import time
+
+
+class TimerHeap(object):
+    """
+    A set of named timers, each with a deadline (in seconds since the epoch).
+    A timer name can be any hashable value, and each name has at most one
+    deadline; scheduling a timer that is already scheduled moves it.
+
+    Moving or cancelling a timer leaves its old entry in the heap; entries
+    that no longer match the timer's deadline are discarded when they reach
+    the top of the heap.
+    """
+    def __init__(self):
+        # Heap of (deadline, sequence number, name) tuples; the sequence
+        # number stops names being compared when deadlines are equal.
+        self._heap = []
+        self._seq  = itertools.count()
+
+        # Dictionary mapping the name of each scheduled timer to its deadline.
+        self._deadlines = {}
+
+    def schedule(self, name, delay, now=None):
+        """
+        Schedule a timer to be due *delay* seconds from now.
+        """
+        if now is None:
+            now = time.time()
+        self.schedule_at(name, now + delay)
+
+    def schedule_at(self, name, deadline):
+        """
+        Schedule a timer to be due at a given time.
+        """
+        self._deadlines[name] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), name))
+
+    def cancel(self, name):
+        self._deadlines.pop(name, None)
+
+    def is_scheduled(self, name):
+        return name in self._deadlines
+
+    def timeout(self, now=None):
+        """
+        Returns the number of seconds until the next timer is due (0 if one
+        is already due), or None if no timers are scheduled.
+        """
+        self._discard_stale()
+
+        if not self._heap:
+            return None
+
+        if now is None:
+            now = time.time()
+        return max(0, self._heap[0][0] - now)
+
+    def pop_due(self, now=None):
+        """
+        Returns the set of names of the timers that are due, which are no
+        longer scheduled.
+        """
+        if now is None:
+            now = time.time()
+
+        due = set()
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, name = heapq.heappop(self._heap)
+            del self._deadlines[name]
+            due.add(name)
+            self._discard_stale()
+
+        return due
+
+    def _discard_stale(self):
+        while (self._heap and
+               self._deadlines.get(self._heap[0][2]) != self._heap[0][0]):
+            heapq.heappop(self._heap)
@@ -24,9 +24,11 @@ Felix utilities.
 import logging
 import os
 import re
+import select
 import subprocess
 import time
 
+from calico.felix import fstats
 from collections import namedtuple
 CommandOutput = namedtuple('CommandOutput', ['stdout', 'stderr'])
 
@@ -43,6 +45,23 @@ IPV6_REGEX = re.compile("^[a-f0-9]+:[:a-f0-9]+$")
 PORT_REGEX = re.compile("^(([0-9]+)|([0-9]+-[0-9]+))$")
 INT_REGEX  = re.compile("^[0-9]+$")
 
+# Regex matching the line that "ip -batch" writes when a command fails.
+IP_BATCH_FAILED_REGEX = re.compile("^Command failed -:([0-9]+)$")
+
+#*****************************************************************************#
+#* Whether to send "ip" and "ipset" commands to long-lived "ip -batch" and   *#
+#* "ipset -" processes rather than starting a new process for each set of    *#
+#* commands (or, for ipset, each command); see set_use_sessions.             *#
+#*****************************************************************************#
+use_sessions = False
+
+# The long-lived "ip -batch" and "ipset -" sessions, created when first used.
+_ip_session    = None
+_ipset_session = None
+
+# Output that is discarded is written here.
+_devnull = open(os.devnull, "w")
+
 class FailedSystemCall(Exception):
     def __init__(self, message, args, retcode, stdout, stderr):
         super(FailedSystemCall, self).__init__(message)
@@ -63,14 +82,16 @@ def call_silent(args):
     Wrapper round subprocess_call that discards all of the output to both
     stdout and stderr. *args* must be a list.
     """
+    start = time.time()
     retcode = subprocess.call(args,
-                              stdout=open('/dev/null', 'w'),
+                              stdout=_devnull,
                               stderr=subprocess.STDOUT)
+    fstats.record(fstats.command_name(args), time.time() - start)
 
     return retcode
 
 
-def check_call(args):
+def check_call(args, input_data=None):
     """
     Substitute for the subprocess.check_call funtion. It has the following useful
     characteristics.
@@ -79,17 +100,419 @@ def check_call(args):
       expects the caller to handle it). That exception contains the command
       output.
     - It returns a tuple with stdout and stderr.
+    - If *input_data* is supplied, it is written to the stdin of the command
+      (used for the various "restore" commands that read from stdin).
 
     If the command supplied does not exist, then an OSError is thrown.
     """
     log.debug("Calling out to system : %s" % args)
 
+    if input_data is None:
+        stdin = None
+    else:
+        stdin = subprocess.PIPE
+
+    start = time.time()
     proc = subprocess.Popen(args,
+                            stdin=stdin,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+    stdout, stderr = proc.communicate(input_data)
     retcode = proc.returncode
+    fstats.record(fstats.command_name(args), time.time() - start)
     if retcode:
         raise FailedSystemCall("Failed system call", args, retcode, stdout, stderr)
 
     return CommandOutput(stdout, stderr)
+
+
+def set_use_sessions(enabled):
+    """
+    Select whether "ip" commands sent with ip_batch are streamed to a
+    long-lived "ip -batch" process, and "ipset" commands sent with
+    ipset_batch, check_ipset or call_ipset_silent to a long-lived "ipset -"
+    process.
+    """
+    global use_sessions
+    log.info("Long-lived command sessions %s" %
+             ("enabled" if enabled else "disabled"))
+    use_sessions = enabled
+
+
+def ip_batch(commands):
+    """
+    Run a list of "ip" commands, each a list of arguments without the leading
+    "ip" (for example ["route", "add", "10.0.0.1", "dev", "tap1234"]). The
+    commands must be ones that do not produce output that we need, and cannot
+    include options such as "-6" (which "ip -batch" does not accept on each
+    line); the address family of a route or neighbour command is taken from
+    its address.
+
+    The commands are all run by a single "ip -batch" process, which is the
+    long-lived session if sessions are in use (see set_use_sessions).
+
+    Every command is run, even if some fail. Returns a dictionary mapping the
+    index in *commands* of each command that failed to its error output; if
+    all the commands succeeded, the dictionary is empty.
+    """
+    global _ip_session
+
+    if not commands:
+        return {}
+
+    if use_sessions:
+        if _ip_session is None:
+            _ip_session = IpBatchSession()
+        session = _ip_session
+    else:
+        session = IpBatchSession()
+
+    start = time.time()
+    try:
+        errors = session.run([" ".join(command) for command in commands])
+    finally:
+        if not use_sessions:
+            session.close()
+    fstats.record("ip -batch", time.time() - start)
+
+    return errors
+
+
+def check_ip_batch(commands):
+    """
+    As ip_batch, but throws a FailedSystemCall exception (for the first
+    command that failed) if any of the commands fail.
+    """
+    errors = ip_batch(commands)
+    if errors:
+        index = min(errors)
+        raise FailedSystemCall("Failed system call", ["ip"] + commands[index],
+                               1, "", errors[index])
+
+
+def ipset_batch(commands):
+    """
+    Run a list of "ipset" commands, each a list of arguments without the
+    leading "ipset" (for example ["destroy", "felix-to-addr-1234"]). The
+    commands must be ones that do not produce output that we need; "ipset
+    list" in particular is run as a separate command.
+
+    The commands are all run by a single "ipset -" process, which is the
+    long-lived session if sessions are in use (see set_use_sessions).
+
+    Every command is run, even if some fail. Returns a dictionary mapping the
+    index in *commands* of each command that failed to its error output; if
+    all the commands succeeded, the dictionary is empty.
+    """
+    global _ipset_session
+
+    if not commands:
+        return {}
+
+    if use_sessions:
+        if _ipset_session is None:
+            _ipset_session = IpsetSession()
+        session = _ipset_session
+    else:
+        session = IpsetSession()
+
+    start = time.time()
+    try:
+        errors = session.run([" ".join(command) for command in commands])
+    finally:
+        if not use_sessions:
+            session.close()
+    fstats.record("ipset -", time.time() - start)
+
+    return errors
+
+
+def check_ipset(args):
+    """
+    Run a single "ipset" command, given as a list of arguments without the
+    leading "ipset", throwing a FailedSystemCall exception if it fails. It is
+    sent to the long-lived "ipset -" session if sessions are in use, and
+    otherwise run with check_call.
+    """
+    if not use_sessions:
+        return check_call(["ipset"] + args)
+
+    errors = ipset_batch([args])
+    if errors:
+        raise FailedSystemCall("Failed system call", ["ipset"] + args,
+                               1, "", errors[0])
+    return CommandOutput("", "")
+
+
+def call_ipset_silent(args):
+    """
+    As check_ipset, but returns a return code (zero if the command succeeded)
+    rather than throwing an exception, and discards any output.
+    """
+    if not use_sessions:
+        return call_silent(["ipset"] + args)
+
+    return 1 if ipset_batch([args]) else 0
+
+
+class _CommandSession(object):
+    """
+    A long-lived process to which commands are written one per line, on its
+    stdin, and which reports errors on stderr. Each subclass works out from
+    that output which commands have completed and which failed.
+
+    Some errors make the process exit. In that case the command that was
+    running is reported as failed with whatever error was written, and the
+    remaining commands are run in a new process. The same is done if the
+    process writes nothing for READ_TIMEOUT seconds, in case it has hung.
+    """
+    # The command that starts the process, and its name for logs.
+    COMMAND = None
+    NAME    = None
+
+    # Commands are written in chunks, reading the results of each chunk
+    # before writing the next, so that neither pipe can fill up.
+    CHUNK_SIZE = 100
+
+    # Seconds to wait for the process to report on each command before giving
+    # up on it.
+    READ_TIMEOUT = 10
+
+    def __init__(self):
+        self._proc   = None
+        self._line   = 0
+        self._buffer = ""
+
+    def _start(self):
+        log.info("Starting %s session" % self.NAME)
+        self._proc = subprocess.Popen(self.COMMAND,
+                                      bufsize=-1,
+                                      stdin=subprocess.PIPE,
+                                      stdout=_devnull,
+                                      stderr=subprocess.PIPE)
+        self._line   = 0
+        self._buffer = ""
+
+    def close(self):
+        """
+        Stop the process once it has finished the commands written to it.
+        """
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+    def _stop(self):
+        try:
+            self._proc.kill()
+            self._proc.wait()
+        except OSError:
+            pass
+        self._proc = None
+
+    def run(self, lines):
+        """
+        Run a list of commands (each a line of input). Returns a dictionary
+        mapping the index of each command that failed to its error output.
+        """
+        errors   = {}
+        index    = 0
+        failures = 0
+
+        while index < len(lines):
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+
+            done, chunk_errors = self._run(lines[index:index +
+                                                 self.CHUNK_SIZE])
+            for offset, error in chunk_errors.items():
+                errors[index + offset] = error
+            index += done
+
+            # Give up if the process repeatedly cannot accept commands.
+            if done == 0:
+                failures += 1
+                if failures > 1:
+                    raise FailedSystemCall("%s session failed" % self.NAME,
+                                           self.COMMAND, -1, "", "")
+            else:
+                failures = 0
+
+        return errors
+
+    def _run(self, lines):
+        """
+        Write a chunk of commands, and wait for them to complete. Returns the
+        number of commands that have completed (successfully or not) and a
+        dictionary mapping the index of each command that failed to its error
+        output.
+        """
+        raise NotImplementedError()
+
+    def _write(self, data):
+        """
+        Write lines of input to the process. Returns False (having stopped
+        the process) if it cannot accept them.
+        """
+        try:
+            self._proc.stdin.write("\n".join(data) + "\n")
+            self._proc.stdin.flush()
+        except IOError as e:
+            log.warning("Failed to write to %s session : %r" % (self.NAME, e))
+            self._stop()
+            return False
+
+        self._line += len(data)
+        return True
+
+    def _lost(self, line, command, output):
+        """
+        Handle the process having hung (*line* is None) or exited (*line* is
+        "") while running *command*, whose error output so far is *output*.
+        Stops the process and returns the error to report for the command.
+        """
+        if line is None:
+            error = "".join(output) or "%s session timed out" % self.NAME
+            log.warning("%s session timed out running %s" %
+                        (self.NAME, command))
+        else:
+            error = "".join(output) or "%s session exited" % self.NAME
+            log.warning("%s session exited running %s : %s" %
+                        (self.NAME, command, error.strip()))
+        self._stop()
+        return error
+
+    def _readline(self):
+        """
+        Read a line of error output. Returns "" if the process has exited, or
+        None if it wrote nothing for READ_TIMEOUT seconds.
+        """
+        fd       = self._proc.stderr.fileno()
+        deadline = time.time() + self.READ_TIMEOUT
+
+        while "\n" not in self._buffer:
+            ready, _, _ = select.select([fd], [], [],
+                                        max(deadline - time.time(), 0))
+            if not ready:
+                return None
+
+            data = os.read(fd, 4096)
+            if not data:
+                line, self._buffer = self._buffer, ""
+                return line
+            self._buffer += data
+
+        line, self._buffer = self._buffer.split("\n", 1)
+        return line + "\n"
+
+
+class IpBatchSession(_CommandSession):
+    """
+    An "ip -batch - -force" process, to which commands are written one per
+    line. It can be kept running, as a long-lived session, to save the cost
+    of starting a process for each set of commands.
+
+    ip reports a failed command by writing its error and then "Command failed
+    -:<line number>" to stderr, and carries on with the next command. Each
+    command is followed by a sentinel command that always fails; once the
+    sentinel's failure has been reported, the command before it has
+    completed, and any error reported by line number can be matched to it.
+    The sentinel shows an interface whose name is too long for any interface
+    to have, so it cannot succeed.
+
+    Some errors make ip exit even with -force (see _CommandSession).
+    """
+    COMMAND  = ["ip", "-batch", "-", "-force"]
+    NAME     = "ip batch"
+    SENTINEL = "link show dev felix-sentinel-interface"
+
+    def _run(self, lines):
+        base = self._line
+        data = []
+        for line in lines:
+            data.append(line)
+            data.append(self.SENTINEL)
+
+        if not self._write(data):
+            return 0, {}
+
+        errors = {}
+        output = []
+        done   = 0
+        while done < len(lines):
+            line = self._readline()
+            if not line:
+                errors[done] = self._lost(line, lines[done], output)
+                return done + 1, errors
+
+            match = IP_BATCH_FAILED_REGEX.match(line.strip())
+            if match is None:
+                output.append(line)
+                continue
+
+            # Line numbers are 1-based; even offsets are commands, odd ones
+            # the sentinels that follow them.
+            offset = int(match.group(1)) - base - 1
+            if offset % 2 == 0:
+                errors[offset // 2] = "".join(output)
+                log.debug("ip batch command failed : %s : %s" %
+                          (lines[offset // 2], errors[offset // 2].strip()))
+            else:
+                done = offset // 2 + 1
+            output = []
+
+        return done, errors
+
+
+class IpsetSession(_CommandSession):
+    """
+    An "ipset -" process, which runs ipset commands (such as "create
+    felix-to-addr-1234 hash:net family inet -exist") written to it one per
+    line. It can be kept running, as a long-lived session, to save the cost
+    of starting a process for each command.
+
+    ipset reports a failed command by writing its error to stderr, without
+    saying which line it was, and carries on with the next command. As with
+    IpBatchSession, each command is followed by a sentinel command that
+    always fails: the sentinel names an ipset whose name is too long for any
+    ipset to have, and ipset's error for it contains that name. Any other
+    error output written before the sentinel's is for the command before it.
+    """
+    COMMAND       = ["ipset", "-"]
+    NAME          = "ipset"
+    SENTINEL_NAME = "felix-sentinel-ipset-name-is-too-long"
+    SENTINEL      = "list " + SENTINEL_NAME
+
+    def _run(self, lines):
+        data = []
+        for line in lines:
+            data.append(line)
+            data.append(self.SENTINEL)
+
+        if not self._write(data):
+            return 0, {}
+
+        errors = {}
+        output = []
+        done   = 0
+        while done < len(lines):
+            line = self._readline()
+            if not line:
+                errors[done] = self._lost(line, lines[done], output)
+                return done + 1, errors
+
+            if self.SENTINEL_NAME not in line:
+                # Some errors are followed by a hint to run "ipset help",
+                # which is not worth reporting.
+                if not line.startswith("Try `"):
+                    output.append(line)
+                continue
+
+            if output:
+                errors[done] = "".join(output)
+                log.debug("ipset command failed : %s : %s" %
+                          (lines[done], errors[done].strip()))
+            done  += 1
+            output = []
+
+        return done, errors
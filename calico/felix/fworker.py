@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.fworker
+~~~~~~~~~~~~
+
+A worker thread that runs jobs in the order in which they were queued, so that
+slow work (such as programming the dataplane) does not hold up the main loop.
+"""
+import collections
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import sys
+import threading
+
+# Logger
+log = logging.getLogger(__name__)
+
+
+class Worker(object):
+    """
+    A thread that runs jobs, each a function and its arguments, one at a time
+    in the order in which they were queued.
+
+    Whenever the worker runs out of jobs, it calls its idle function; if that
+    returns anything other than None, it is passed back as a result. So that
+    a steady stream of jobs cannot hold off the idle function for ever, it is
+    also called after every *idle_every* jobs, if that is set. Results are
+    collected by calling results(), and the worker can be polled for results
+    using its file descriptor.
+
+    If a job raises an exception, the worker stops, and the exception is
+    raised again from results().
+    """
+    def __init__(self, idle, name="Worker", idle_every=None):
+        self._jobs       = Queue.Queue()
+        self._results    = collections.deque()
+        self._idle       = idle
+        self._idle_every = idle_every
+        self._error      = None
+
+        # A byte is written to the pipe whenever there are results.
+        self._read_fd, self._write_fd = os.pipe()
+        flags = fcntl.fcntl(self._read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def fileno(self):
+        return self._read_fd
+
+    def queue(self, function, *args):
+        """
+        Queue a job, which calls the function with the arguments given.
+        """
+        self._jobs.put((function, args))
+
+    def pending(self):
+        """
+        Returns the (approximate) number of jobs waiting to be run.
+        """
+        return self._jobs.qsize()
+
+    def results(self):
+        """
+        Returns the list of results passed back since this was last called.
+        """
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+
+        return results
+
+    def _run(self):
+        try:
+            count = 0
+            while True:
+                function, args = self._jobs.get()
+                function(*args)
+                count += 1
+
+                if self._jobs.empty() or count == self._idle_every:
+                    count  = 0
+                    result = self._idle()
+                    if result is not None:
+                        self._results.append(result)
+                        os.write(self._write_fd, "R")
+        except:
+            log.exception("Worker failed")
+            self._error = sys.exc_info()
+            os.write(self._write_fd, "E")
@@ -19,6 +19,7 @@ felix.test.stub_fiptables
 IP tables management functions. This is a wrapper round python-iptables that
 allows us to mock it out for testing.
 """
+from calico.felix import fchains
 from calico.felix.futils import IPV4, IPV6
 
 # Special value to mean "put this rule at the end".
@@ -28,6 +29,12 @@ RULE_POSN_LAST = -1
 tables_v4 = dict()
 tables_v6 = dict()
 
+# List of (type, table name, lines) passed to restore, oldest first.
+restored = []
+
+# Model of the Felix chains, mapping (type, table name) to TableState.
+state = dict()
+
 class Rule(object):
     """
     Fake rule object.
@@ -214,8 +221,41 @@ def insert_rule(rule, chain, position=0, force_position=True):
 
     return
 
+def update_chain(chain, rules):
+    """
+    Make a chain contain exactly the rules passed in. The stub just replaces
+    the rules in the chain, and reports no changes.
+    """
+    chain.rules = [rule._rule for rule in rules]
+    return []
+
+def restore(type, table_name, lines):
+    """
+    Apply a set of iptables-restore lines to a table. The stub just records the
+    lines that would have been applied.
+    """
+    restored.append((type, table_name, list(lines)))
+    for line in lines:
+        get_state(type, table_name).apply(line)
+
+
+def load_state():
+    """
+    Load the model of the Felix chains. The stub starts with nothing.
+    """
+    state.clear()
+
+
+def get_state(type, table_name):
+    """
+    Returns the model of the Felix chains in a table.
+    """
+    return state.setdefault((type, table_name), fchains.TableState())
+
 def init_state():
-    tables_v4["filter"] = Table("filter")
-    tables_v4["nat"] = Table("nat")
-    tables_v6["filter"] = Table("filter")
+    tables_v4["filter"] = Table(IPV4, "filter")
+    tables_v4["nat"] = Table(IPV4, "nat")
+    tables_v6["filter"] = Table(IPV6, "filter")
+    del restored[:]
+    state.clear()
 
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.stub_fworker
+~~~~~~~~~~~~
+
+Stub worker, which has no thread. Jobs are queued up until the test runs them
+(or just checks what was queued).
+"""
+
+class Worker(object):
+    def __init__(self, idle, name="Worker", idle_every=None):
+        self.jobs     = []
+        self._idle    = idle
+        self._results = []
+
+    def queue(self, function, *args):
+        self.jobs.append((function, args))
+
+    def pending(self):
+        return len(self.jobs)
+
+    def run_jobs(self):
+        """
+        Run all the queued jobs, then the idle function, as the real worker
+        does when it runs out of jobs.
+        """
+        while self.jobs:
+            function, args = self.jobs.pop(0)
+            function(*args)
+
+        result = self._idle()
+        if result is not None:
+            self._results.append(result)
+
+    def results(self):
+        results       = self._results
+        self._results = []
+        return results
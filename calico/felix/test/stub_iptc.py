@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.stub_iptc
+~~~~~~~~~~~~
+
+Stub of the parts of python-iptables that fiptables uses, so that fiptables
+can be tested without it. Rules, matches and targets just record their
+attributes, and chains hold a list of rules.
+"""
+
+class Match(object):
+    """
+    Fake match (or target) object; parameters are set as attributes.
+    """
+    def __init__(self, rule, name):
+        self.rule = rule
+        self.name = name
+
+
+class Target(Match):
+    pass
+
+
+class Rule(object):
+    """
+    Fake IPv4 rule object.
+    """
+    def __init__(self):
+        self.protocol = None
+        self.src = None
+        self.dst = None
+        self.in_interface = None
+        self.out_interface = None
+        self.matches = []
+        self.target = None
+
+    def create_match(self, name):
+        match = Match(self, name)
+        self.matches.append(match)
+        return match
+
+    def create_target(self, name):
+        self.target = Target(self, name)
+        return self.target
+
+
+class Rule6(Rule):
+    """
+    Fake IPv6 rule object.
+    """
+    pass
+
+
+class Table(object):
+    """
+    Fake IPv4 table. Chains are created when first asked for.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.chains = {}
+
+    def is_chain(self, name):
+        return name in self.chains
+
+    def create_chain(self, name):
+        self.chains[name] = []
+
+    def refresh(self):
+        pass
+
+
+class Table6(Table):
+    """
+    Fake IPv6 table.
+    """
+    pass
+
+
+class Chain(object):
+    """
+    Fake chain, whose rules are held by its table.
+    """
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+        self.rules = table.chains.setdefault(name, [])
+
+    def insert_rule(self, rule, position=0):
+        self.rules.insert(position, rule)
+
+    def replace_rule(self, rule, position=0):
+        self.rules[position] = rule
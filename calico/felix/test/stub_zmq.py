@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.stub_zmq
+~~~~~~~~~~~~
+
+Stub of the parts of pyzmq that Felix uses, so that Felix can be tested
+without binding or connecting real sockets. Sockets record what is sent on
+them, and tests queue up the messages to be received on them.
+"""
+import collections
+
+# Socket types.
+PUB    = 1
+SUB    = 2
+REQ    = 3
+REP    = 4
+DEALER = 5
+ROUTER = 6
+
+# Flags and socket options.
+NOBLOCK     = 1
+IDENTITY    = 5
+SUBSCRIBE   = 6
+UNSUBSCRIBE = 7
+EVENTS      = 15
+LINGER      = 17
+
+# Poll events.
+POLLIN  = 1
+POLLOUT = 2
+
+
+class ZMQError(Exception):
+    pass
+
+
+class Again(ZMQError):
+    pass
+
+
+class Socket(object):
+    """
+    Fake socket. Each message sent or received is a list of frames.
+    """
+    def __init__(self, type):
+        self.type     = type
+        self.sent     = []
+        self.inbound  = collections.deque()
+        self.options  = []
+        self.address  = None
+        self.bound    = False
+        self.closed   = False
+
+    def bind(self, address):
+        self.address = address
+        self.bound   = True
+
+    def connect(self, address):
+        self.address = address
+
+    def close(self, linger=None):
+        self.closed = True
+
+    def setsockopt(self, option, value):
+        self.options.append((option, value))
+
+    def getsockopt(self, option):
+        assert option == EVENTS
+        return POLLIN if self.inbound else 0
+
+    def send(self, data, flags=0):
+        self.sent.append([data])
+
+    def send_multipart(self, frames, flags=0):
+        self.sent.append(list(frames))
+
+    def recv(self, flags=0):
+        return self.recv_multipart(flags)[-1]
+
+    def recv_multipart(self, flags=0):
+        if not self.inbound:
+            raise Again("No message to receive")
+        return self.inbound.popleft()
+
+    def queue(self, *frames):
+        """
+        Queue a message to be received (not part of pyzmq).
+        """
+        self.inbound.append(list(frames))
+
+
+class Context(object):
+    def __init__(self):
+        self.sockets = []
+
+    def socket(self, type):
+        sock = Socket(type)
+        self.sockets.append(sock)
+        return sock
+
+    def destroy(self, linger=None):
+        for sock in self.sockets:
+            sock.close()
+
+
+class Poller(object):
+    """
+    Fake poller. Stub sockets with messages queued on them are readable, as
+    are any other registered objects for which readable is set True by the
+    test.
+    """
+    def __init__(self):
+        self.registered = []
+        self.readable   = set()
+
+    def register(self, socket, flags=POLLIN):
+        if socket not in self.registered:
+            self.registered.append(socket)
+
+    def unregister(self, socket):
+        self.registered.remove(socket)
+
+    def poll(self, timeout=None):
+        return [(socket, POLLIN) for socket in self.registered
+                if socket in self.readable or
+                (isinstance(socket, Socket) and socket.inbound)]
@@ -33,6 +33,8 @@ class TestConfig(unittest.TestCase):
     def test_simple_good_config(self):
         config = Config("calico/felix/test/data/felix_basic.cfg")
         self.assertEqual(config.PLUGIN_ADDR, "localhost")
+        self.assertFalse(config.SHARED_IPSETS)
+        self.assertFalse(config.COMMAND_SESSIONS)
 
     def test_missing_section(self):
         with self.assertRaisesRegexp(ConfigException,
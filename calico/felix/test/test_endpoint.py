@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_endpoint
+~~~~~~~~~~~
+
+Tests for programming endpoint ACLs.
+"""
+import sys
+import unittest
+
+# Replace iptc with a stub, since we do not have it. Other tests replace
+# fiptables itself, so make sure that we load fresh copies of the real modules.
+import calico.felix
+import calico.felix.test.stub_iptc as stub_iptc
+sys.modules['iptc'] = stub_iptc
+for name in ('fiptables', 'frules', 'endpoint'):
+    sys.modules.pop('calico.felix.' + name, None)
+    calico.felix.__dict__.pop(name, None)
+
+from calico.felix import endpoint
+from calico.felix import frules
+from calico.felix.futils import IPV4, IPV6
+
+ACLS = {'inbound_default': 'deny',
+        'inbound': [{'cidr': "10.0.0.0/8"}],
+        'outbound_default': 'deny',
+        'outbound': []}
+
+class TestUpdateAcls(unittest.TestCase):
+    def setUp(self):
+        self.set_acls = []
+        self.real_set_acls = frules.set_acls
+        frules.set_acls = lambda *args: self.set_acls.append(args)
+        frules._ipsets.clear()
+
+        self.ep = endpoint.Endpoint("1234567890ab-cdef", "aa:bb:cc:dd:ee:ff")
+        self.ep.state = endpoint.Endpoint.STATE_ENABLED
+        self.ep.acl_data = {'v4': ACLS, 'v6': ACLS}
+
+    def tearDown(self):
+        frules.set_acls = self.real_set_acls
+        frules._ipsets.clear()
+        frules._ep_shared_ipsets.clear()
+
+    def create_ipsets(self):
+        for type in (IPV4, IPV6):
+            frules._ipsets.update(frules._ep_ipset_names(self.ep.suffix, type))
+
+    def test_not_programmed(self):
+        # Until the endpoint's ipsets exist, its ACLs are held.
+        self.ep.update_acls()
+        self.ep.update_acls(force=True)
+        self.assertEqual(self.set_acls, [])
+        self.assertIsNone(self.ep.acl_fingerprint)
+
+        self.create_ipsets()
+        self.ep.update_acls()
+        self.assertEqual(self.set_acls,
+                         [(self.ep.suffix, IPV4, ACLS['inbound'], 'deny',
+                           [], 'deny'),
+                          (self.ep.suffix, IPV6, ACLS['inbound'], 'deny',
+                           [], 'deny')])
+
+    def test_unchanged(self):
+        self.create_ipsets()
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 2)
+
+        # Unchanged ACLs are only programmed again if forced.
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 2)
+        self.ep.update_acls(force=True)
+        self.assertEqual(len(self.set_acls), 4)
+
+        # Disabling the endpoint changes its ACLs to deny everything.
+        self.ep.state = endpoint.Endpoint.STATE_DISABLED
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 6)
+        self.assertEqual(self.set_acls[-1][2:], ([], 'DENY', [], 'DENY'))
+
+    def test_missing_ipsets(self):
+        # Unchanged ACLs are programmed again if the ipsets holding them are
+        # found to be missing.
+        self.create_ipsets()
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 2)
+
+        frules._ep_shared_ipsets[(self.ep.suffix, IPV6)] = ["felix-6-net-gone"]
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 4)
+
+        frules._ipsets.add("felix-6-net-gone")
+        self.ep.update_acls()
+        self.assertEqual(len(self.set_acls), 4)
+
+    def test_no_acls(self):
+        self.create_ipsets()
+        self.ep.acl_data = None
+        self.ep.update_acls()
+        self.assertEqual(self.set_acls, [])
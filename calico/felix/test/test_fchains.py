@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fchains
+~~~~~~~~~~~
+
+Tests for the model of Felix iptables chains.
+"""
+import unittest
+from calico.felix import fchains
+
+SAVE_OUTPUT = """# Generated by iptables-save v1.4.21
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:felix-FORWARD - [0:0]
+:felix-INPUT - [0:0]
+:felix-from-1234 - [0:0]
+-A INPUT -j felix-INPUT
+-A FORWARD -j felix-FORWARD
+-A felix-FORWARD -i tap1234 -j felix-from-1234
+-A felix-FORWARD -o tap1234 -j felix-to-1234
+-A felix-INPUT -i tap1234 -j felix-from-1234
+-A felix-from-1234 -m conntrack --ctstate INVALID -j DROP
+-A felix-from-1234 -j DROP
+COMMIT
+# Completed
+"""
+
+class TestTableState(unittest.TestCase):
+    def test_parse_save(self):
+        state = fchains.parse_save(SAVE_OUTPUT)
+        self.assertEqual(sorted(state.chains.keys()),
+                         ["felix-FORWARD", "felix-INPUT", "felix-from-1234"])
+        self.assertEqual(state.rules("felix-FORWARD"),
+                         ["-i tap1234 -j felix-from-1234",
+                          "-o tap1234 -j felix-to-1234"])
+        self.assertEqual(state.rules("felix-to-1234"), [])
+        self.assertFalse(state.has_chain("INPUT"))
+
+    def test_apply(self):
+        state = fchains.parse_save(SAVE_OUTPUT)
+
+        state.apply("-I felix-from-1234 2 -j RETURN")
+        self.assertEqual(state.rules("felix-from-1234"),
+                         ["-m conntrack --ctstate INVALID -j DROP",
+                          "-j RETURN",
+                          "-j DROP"])
+
+        state.apply("-R felix-from-1234 3 -p udp -j DROP")
+        state.apply("-D felix-from-1234 1")
+        self.assertEqual(state.rules("felix-from-1234"),
+                         ["-j RETURN", "-p udp -j DROP"])
+
+        state.apply("-D felix-FORWARD -o tap1234 -j felix-to-1234")
+        self.assertEqual(state.rules("felix-FORWARD"),
+                         ["-i tap1234 -j felix-from-1234"])
+
+        state.apply(":felix-from-1234 - [0:0]")
+        self.assertEqual(state.rules("felix-from-1234"), [])
+
+        state.apply("-X felix-from-1234")
+        self.assertFalse(state.has_chain("felix-from-1234"))
+
+        # Chains not owned by Felix are not modelled.
+        state.apply("-A INPUT -j felix-INPUT")
+        self.assertFalse(state.has_chain("INPUT"))
+
+    def test_apply_missing(self):
+        # Deleting or replacing a rule that is not in the model marks it
+        # stale, rather than failing.
+        state = fchains.parse_save(SAVE_OUTPUT)
+        rules = state.rules("felix-from-1234")[:]
+
+        for line in ("-D felix-from-1234 -j ACCEPT",
+                     "-D felix-from-1234 9",
+                     "-R felix-from-1234 9 -j ACCEPT"):
+            state.stale = False
+            state.apply(line)
+            self.assertTrue(state.stale)
+            self.assertEqual(state.rules("felix-from-1234"), rules)
+
+    def test_rule_target(self):
+        self.assertEqual(fchains.rule_target("-i tap1 -j felix-from-1"),
+                         "felix-from-1")
+        self.assertEqual(fchains.rule_target(
+            "-j MARK --set-xmark 0x1/0xffffffff"), "MARK")
+        self.assertEqual(fchains.rule_target("-m mark --mark 0x1"), None)
+
+class TestDiffRules(unittest.TestCase):
+    def check_diff(self, current, desired):
+        # Applying the changes to the current rules must give the desired
+        # rules; return the changes so the caller can check there are few.
+        state = fchains.TableState()
+        state.chains["felix-test"] = list(current)
+        ops = fchains.diff_rules(current, desired)
+        for op, posn, index in ops:
+            if op == fchains.OP_DELETE:
+                state.apply("%s felix-test %d" % (op, posn))
+            else:
+                state.apply("%s felix-test %d %s" % (op, posn, desired[index]))
+        self.assertEqual(state.rules("felix-test"), desired)
+        return ops
+
+    def test_no_change(self):
+        rules = ["-j A", "-j B", "-j C"]
+        self.assertEqual(self.check_diff(rules, rules), [])
+        self.assertEqual(self.check_diff([], []), [])
+
+    def test_changes(self):
+        # One rule inserted in the middle.
+        ops = self.check_diff(["-j A", "-j C"], ["-j A", "-j B", "-j C"])
+        self.assertEqual(ops, [(fchains.OP_INSERT, 2, 1)])
+
+        # One rule removed.
+        ops = self.check_diff(["-j A", "-j B", "-j C"], ["-j A", "-j C"])
+        self.assertEqual(ops, [(fchains.OP_DELETE, 2, None)])
+
+        # One rule changed.
+        ops = self.check_diff(["-j A", "-j B", "-j C"], ["-j A", "-j X", "-j C"])
+        self.assertEqual(ops, [(fchains.OP_REPLACE, 2, 1)])
+
+        # Mixtures of changes.
+        self.check_diff(["-j A", "-j B", "-j C", "-j D", "-j E"],
+                        ["-j X", "-j B", "-j Y", "-j Z", "-j E", "-j F"])
+        self.check_diff(["-j A", "-j B", "-j C", "-j D"],
+                        ["-j D", "-j C", "-j B"])
+        self.check_diff([], ["-j A", "-j B"])
+        self.check_diff(["-j A", "-j B"], [])
+
+    def test_jump_index(self):
+        state = fchains.parse_save(SAVE_OUTPUT)
+        self.assertEqual(state.jumps_to("felix-from-1234"),
+                         [("felix-FORWARD", "-i tap1234 -j felix-from-1234"),
+                          ("felix-INPUT", "-i tap1234 -j felix-from-1234")])
+        self.assertEqual(state.jumps_to("felix-to-1234"),
+                         [("felix-FORWARD", "-o tap1234 -j felix-to-1234")])
+
+        # The index follows changes to the rules.
+        state.apply("-D felix-FORWARD 2")
+        state.apply("-R felix-FORWARD 1 -i tap5678 -j felix-from-5678")
+        state.apply("-I felix-INPUT 1 -i tap5678 -j felix-from-5678")
+        self.assertEqual(state.jumps_to("felix-to-1234"), [])
+        self.assertEqual(state.jumps_to("felix-from-1234"),
+                         [("felix-INPUT", "-i tap1234 -j felix-from-1234")])
+        self.assertEqual(len(state.jumps_to("felix-from-5678")), 2)
+
+        state.apply("-F felix-INPUT")
+        self.assertEqual(state.jumps_to("felix-from-1234"), [])
+        self.assertEqual(state.jumps_to("felix-from-5678"),
+                         [("felix-FORWARD", "-i tap5678 -j felix-from-5678")])
+
+    def test_unowned_jumps(self):
+        # Jumps to Felix chains from other chains are indexed.
+        state = fchains.parse_save(SAVE_OUTPUT)
+        self.assertEqual(state.jumps_to("felix-INPUT"),
+                         [("INPUT", "-j felix-INPUT")])
+
+        state.apply("-I FORWARD 1 -j felix-FORWARD")
+        state.apply("-D FORWARD -j felix-FORWARD")
+        self.assertEqual(state.jumps_to("felix-FORWARD"),
+                         [("FORWARD", "-j felix-FORWARD")])
+
+        state.apply("-F INPUT")
+        self.assertEqual(state.jumps_to("felix-INPUT"), [])
+        self.assertFalse(state.has_chain("INPUT"))
@@ -18,9 +18,14 @@ felix.test.test_felix
 
 Top level tests for Felix.
 """
+import json
 import sys
 import unittest
 
+# Replace zmq with a stub, so that no real sockets are bound or connected.
+import calico.felix.test.stub_zmq as stub_zmq
+sys.modules['zmq'] = stub_zmq
+
 # Hide iptc, since we do not have it.
 sys.modules['iptc'] = __import__('calico.felix.test.stub_empty')
 
@@ -31,10 +36,293 @@ calico.felix.fiptables = calico.felix.test.stub_fiptables
 
 # Now import felix, and away we go.
 import calico.felix.felix as felix
+from calico.felix import futils
+
+# Other tests load fresh copies of the endpoint module, so keep a reference to
+# the copy that felix uses; otherwise it would be torn down under felix.
+from calico.felix import endpoint
+
+# Replace the worker with a stub that runs jobs only when told to.
+import calico.felix.test.stub_fworker as stub_fworker
+felix.fworker = stub_fworker
+
+CONFIG_PATH = "calico/felix/test/data/felix_debug.cfg"
+
+class StopLoop(Exception):
+    pass
+
+
+def run_loop(agent, polls):
+    """
+    Run the main loop of *agent* until it has handled the results of *polls*
+    polls. Returns the timeout passed to each poll.
+    """
+    timeouts = []
+    real_poll = agent.poller.poll
+
+    def poll(timeout=None):
+        if len(timeouts) == polls:
+            raise StopLoop()
+        timeouts.append(timeout)
+        return real_poll(timeout)
+
+    agent.poller.poll = poll
+    try:
+        agent.run()
+    except StopLoop:
+        pass
+    finally:
+        agent.poller.poll = real_poll
+
+    return timeouts
+
 
 class TestBasic(unittest.TestCase):
     def test_startup(self):
         config_path = "calico/felix/test/data/felix_debug.cfg"
 
-        felix.default_logging()
+        felix.common.default_logging()
         agent = felix.FelixAgent(config_path)
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.agent = felix.FelixAgent(CONFIG_PATH)
+        self.ep = felix.Endpoint("1234567890ab-cdef", "aa:bb:cc:dd:ee:ff")
+
+    def test_program_revision(self):
+        # The revision of the data programmed is passed back, to be stored
+        # once programming has succeeded.
+        self.ep.program_endpoint = lambda route_batch, rule_batch: False
+
+        data = (frozenset(), "aa:bb:cc:dd:ee:ff", "enabled", "rev1")
+        self.agent.program_endpoint(self.ep, data)
+        self.assertEqual(self.ep.state, "enabled")
+        self.assertIsNone(self.ep.revision)
+        self.assertEqual(self.agent.apply_routes(),
+                         ({self.ep.uuid: "rev1"}, set()))
+
+        # Retries program the last data set, with its revision.
+        self.agent.program_endpoint(self.ep)
+        self.assertEqual(self.agent.apply_routes(),
+                         ({self.ep.uuid: "rev1"}, set()))
+
+    def test_program_failure(self):
+        # A failed system call puts the endpoint on the retry list, rather
+        # than stopping the worker.
+        def fail(route_batch, rule_batch):
+            raise futils.FailedSystemCall("Failed", ["ip"], 1, "", "")
+        self.ep.program_endpoint = fail
+
+        self.agent.program_endpoint(self.ep)
+        self.assertEqual(self.agent.apply_routes(),
+                         ({}, set([self.ep.uuid])))
+
+    def test_acl_failure(self):
+        def fail(force):
+            raise futils.FailedSystemCall("Failed", ["ipset"], 1, "", "")
+        self.ep.update_acls = fail
+
+        self.agent.update_acls(self.ep, {'v4': None, 'v6': None})
+        self.assertEqual(self.ep.acl_data, {'v4': None, 'v6': None})
+        self.assertEqual(self.agent.apply_routes(),
+                         ({}, set([self.ep.uuid])))
+
+    def test_retry_soon(self):
+        # New ACLs reset the backoff of an endpoint awaiting retry.
+        uuid = self.ep.uuid
+        self.agent.retry_later(uuid)
+        self.agent.retry_later(uuid)
+        self.assertEqual(self.agent.ep_retry[uuid], 2)
+        self.assertNotIn((felix.TIMER_RETRY, uuid),
+                         self.agent.timers.pop_due())
+
+        self.agent.retry_soon(uuid)
+        self.assertEqual(self.agent.ep_retry[uuid], 0)
+        self.assertIn((felix.TIMER_RETRY, uuid), self.agent.timers.pop_due())
+
+        # Endpoints not awaiting retry are left alone.
+        self.agent.cancel_retry(uuid)
+        self.agent.retry_soon(uuid)
+        self.assertNotIn(uuid, self.agent.ep_retry)
+
+
+class TestResync(unittest.TestCase):
+    def setUp(self):
+        self.agent = felix.FelixAgent(CONFIG_PATH)
+        self.frules = felix.frules
+        self.frules._ipsets.clear()
+
+    def tearDown(self):
+        self.frules._ipsets.clear()
+
+    def add_endpoint(self, id):
+        ep = felix.Endpoint(id, "aa:bb:cc:dd:ee:ff")
+        ep.pending_resync = False
+        self.agent.endpoints[ep.uuid] = ep
+        return ep
+
+    def test_repair(self):
+        # Completing a resync repairs the endpoints that are not waiting to
+        # be retried; it does not force their ACLs to be programmed again.
+        a = self.add_endpoint("aaaaaaaaaaaa-1")
+        b = self.add_endpoint("bbbbbbbbbbbb-2")
+        c = self.add_endpoint("cccccccccccc-3")
+        self.agent.retry_later(c.uuid)
+        self.agent.worker.jobs = []
+
+        self.agent.complete_endpoint_resync(True)
+        jobs = [args for function, args in self.agent.worker.jobs
+                if function == self.agent.repair_endpoints]
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(sorted(ep.uuid for ep in jobs[0][0]),
+                         [a.uuid, b.uuid])
+        self.assertFalse([args for function, args in self.agent.worker.jobs
+                          if function == self.agent.update_acls])
+
+        # Only the endpoint whose ipsets are missing is programmed again.
+        for type in (futils.IPV4, futils.IPV6):
+            self.frules._ipsets.update(
+                self.frules._ep_ipset_names(a.suffix, type))
+
+        calls = []
+        self.agent.program_endpoint = lambda ep: calls.append(("program", ep))
+        self.agent.update_acls = lambda ep: calls.append(("acls", ep))
+        self.agent.repair_endpoints([a, b])
+        self.assertEqual(calls, [("acls", a), ("program", b)])
+
+
+class TestAcls(unittest.TestCase):
+    def setUp(self):
+        self.agent = felix.FelixAgent(CONFIG_PATH)
+        self.sock = self.agent.sockets[felix.Socket.TYPE_ACL_REQ]
+        self.sock.window = 10
+        del self.sock._zmq.sent[:]
+
+        for id in ("ep1", "ep2"):
+            self.agent.endpoints[id] = felix.Endpoint(id, "aa:bb:cc:dd:ee:ff")
+
+    def sent(self):
+        """
+        Returns the requests sent on the ACL request socket since last time.
+        """
+        requests = [json.loads(frames[-1]) for frames in self.sock._zmq.sent]
+        del self.sock._zmq.sent[:]
+        return requests
+
+    def test_bulk(self):
+        self.agent.acl_requests = ["ep1", "ep2"]
+        self.agent.request_acls()
+
+        requests = self.sent()
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0]["type"], "GETACLSTATES")
+        self.assertEqual(requests[0]["endpoint_ids"], ["ep1", "ep2"])
+        self.assertEqual(self.agent.acl_requests, [])
+
+    def test_bulk_refused(self):
+        # An ACL manager that does not support bulk requests echoes the
+        # request back, refused. The endpoints that still exist are then
+        # requested one at a time, as are any later ones.
+        self.agent.acl_requests = ["ep1", "ep2", "gone"]
+        self.agent.request_acls()
+        request = self.sent()[0]
+
+        request["rc"] = "FAILURE"
+        request["message"] = "Unknown message type"
+        self.sock._zmq.queue("", json.dumps(request))
+        run_loop(self.agent, 1)
+
+        requests = self.sent()
+        self.assertEqual([(request["type"], request["endpoint_id"])
+                          for request in requests],
+                         [("GETACLSTATE", "ep1"), ("GETACLSTATE", "ep2")])
+        self.assertFalse(self.agent.bulk_acls)
+
+        self.agent.acl_requests = ["ep2"]
+        self.agent.request_acls()
+        requests = self.sent()
+        self.assertEqual([(request["type"], request["endpoint_id"])
+                          for request in requests],
+                         [("GETACLSTATE", "ep2")])
+
+    def test_collapse(self):
+        # Repeated ACL updates for an endpoint before they are flushed are
+        # programmed with a single update_acls, using the latest ACLs.
+        self.agent.config.ACL_FLUSH_MS = 0
+        sub = self.agent.sockets[felix.Socket.TYPE_ACL_SUB]._zmq
+        for id, version in (("ep1", 1), ("ep2", 1), ("ep1", 2), ("ep1", 3)):
+            sub.queue(id, json.dumps({'type': "ACLUPDATE",
+                                      'acls': {'v4': version}}))
+        self.agent.worker.jobs = []
+
+        # The updates are handled on the first time round the loop, and
+        # flushed on the next.
+        run_loop(self.agent, 1)
+        self.assertEqual(len(self.agent.acl_dirty), 2)
+        self.assertEqual(self.agent.acl_collapsed, 2)
+
+        run_loop(self.agent, 1)
+        jobs = [(args[0].uuid, args[1]) for function, args
+                in self.agent.worker.jobs
+                if function == self.agent.update_acls]
+        self.assertEqual(sorted(jobs), [("ep1", {'v4': 3}),
+                                        ("ep2", {'v4': 1})])
+        self.assertEqual(self.agent.acl_dirty, {})
+
+
+class TestLoop(unittest.TestCase):
+    def setUp(self):
+        self.agent = felix.FelixAgent(CONFIG_PATH)
+        self.agent.endpoints["ep1"] = felix.Endpoint("ep1",
+                                                     "aa:bb:cc:dd:ee:ff")
+
+    def jobs(self, function):
+        """
+        Returns the arguments of the jobs queued for the worker that call
+        *function*, and empties the worker's queue.
+        """
+        jobs = [args for job, args in self.agent.worker.jobs
+                if job == function]
+        self.agent.worker.jobs = []
+        return jobs
+
+    def test_drain_budget(self):
+        # At most MAX_MSGS_PER_POLL messages are handled from a socket each
+        # time round the loop. The rest wait until after the timers that are
+        # due have been handled, and the next poll.
+        self.agent.config.MAX_MSGS_PER_POLL = 3
+        sub = self.agent.sockets[felix.Socket.TYPE_ACL_SUB]._zmq
+        for ii in range(5):
+            sub.queue("gone%d" % ii, json.dumps({'type': "ACLUPDATE",
+                                                 'acls': {}}))
+
+        self.agent.acl_dirty["ep1"] = {'v4': 1}
+        self.agent.timers.schedule(felix.TIMER_ACLS, 0)
+        self.agent.worker.jobs = []
+
+        run_loop(self.agent, 1)
+        self.assertEqual(len(sub.inbound), 2)
+        self.assertEqual(len(self.jobs(self.agent.update_acls)), 1)
+
+        run_loop(self.agent, 1)
+        self.assertEqual(len(sub.inbound), 0)
+
+    def test_timers(self):
+        # The poll waits no longer than until the next timer is due, and due
+        # timers are acted on when it returns.
+        self.agent.timers = felix.ftimers.TimerHeap()
+        self.agent.timers.schedule(felix.TIMER_STATS, 60)
+        self.agent.config.EP_RETRY_INT_MS = 0
+        self.agent.retry_later("ep1")
+        self.agent.worker.jobs = []
+
+        timeouts = run_loop(self.agent, 1)
+        self.assertEqual(timeouts, [0])
+        self.assertEqual([args[0].uuid for args
+                          in self.jobs(self.agent.program_endpoint)],
+                         ["ep1"])
+
+        timeouts = run_loop(self.agent, 1)
+        self.assertTrue(59000 < timeouts[0] <= 60000)
+        self.assertEqual(self.jobs(self.agent.program_endpoint), [])
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_finterface
+~~~~~~~~~~~
+
+Tests for reading routes, configuring tap interfaces and batches of route
+changes.
+"""
+import unittest
+from calico.felix import finterface
+from calico.felix import futils
+from calico.felix.futils import IPV4, IPV6
+
+# A tap interface that does not exist, so has no ifindex.
+TAP = "tapnotthere0"
+
+# Output of "ip route list" and "ip -6 route list" on a compute host.
+IPV4_ROUTES = """\
+default via 172.18.203.1 dev eth0
+10.65.0.0/24 via 172.18.203.50 dev eth0 proto bird
+10.65.0.2 dev tap1a2b3c4d-5e  scope link
+10.65.0.3 dev tap1a2b3c4d-5e  scope link
+10.65.0.4 dev tap9f8e7d6c-5b  proto static  scope link
+172.18.203.0/24 dev eth0  proto kernel  scope link  src 172.18.203.42
+"""
+IPV6_ROUTES = """\
+2001:db8:a41:2::12 dev tap1a2b3c4d-5e  metric 1024
+2001:db8:a41:2::/64 via fd5f::2 dev eth0  proto bird  metric 1024
+fe80::/64 dev eth0  proto kernel  metric 256
+unreachable ::/96 dev lo  metric 1024  error -101
+default via fe80::1 dev eth0  metric 1024
+"""
+
+class TestLoadRoutes(unittest.TestCase):
+    def setUp(self):
+        self.commands = []
+        self.fail = False
+        self.ifindexes = {"tap1a2b3c4d-5e": 7, "tap9f8e7d6c-5b": 8}
+        self.real_check_call = futils.check_call
+        self.real_ifindex = finterface._ifindex
+        futils.check_call = self.check_call
+        finterface._ifindex = self.ifindexes.get
+
+    def tearDown(self):
+        futils.check_call = self.real_check_call
+        finterface._ifindex = self.real_ifindex
+        finterface.clear_routes()
+
+    def check_call(self, args, input_data=None):
+        self.commands.append(args)
+        outputs = {"ip route list": IPV4_ROUTES,
+                   "ip -6 route list": IPV6_ROUTES,
+                   "ip route list dev tap9f8e7d6c-5b":
+                       "10.65.0.9 scope link\n"}
+        command = " ".join(args)
+        if self.fail or command not in outputs:
+            raise futils.FailedSystemCall("Failed system call", args, 1, "",
+                                          "")
+        return futils.CommandOutput(outputs[command], "")
+
+    def test_parse(self):
+        finterface.load_routes()
+
+        # Only routes to single addresses through an interface are kept.
+        self.assertEqual(finterface._routes, {
+            IPV4: {"tap1a2b3c4d-5e": (7, set(["10.65.0.2", "10.65.0.3"])),
+                   "tap9f8e7d6c-5b": (8, set(["10.65.0.4"]))},
+            IPV6: {"tap1a2b3c4d-5e": (7, set(["2001:db8:a41:2::12"]))}})
+
+    def test_snapshot(self):
+        finterface.load_routes()
+        del self.commands[:]
+
+        # Routes are listed from the snapshot, with no more commands; a tap
+        # with no routes when the snapshot was taken has none.
+        self.assertEqual(finterface.list_tap_ips(IPV4, "tap9f8e7d6c-5b"),
+                         set(["10.65.0.4"]))
+        self.assertEqual(finterface.list_tap_ips(IPV6, "tap9f8e7d6c-5b"),
+                         set())
+        self.assertEqual(self.commands, [])
+
+        # A tap that has been recreated since has lost its routes.
+        self.ifindexes["tap1a2b3c4d-5e"] = 9
+        self.assertEqual(finterface.list_tap_ips(IPV4, "tap1a2b3c4d-5e"),
+                         set())
+
+        # Without the snapshot, the routes are read for the tap.
+        finterface.clear_routes()
+        self.assertEqual(finterface.list_tap_ips(IPV4, "tap9f8e7d6c-5b"),
+                         set(["10.65.0.9"]))
+        self.assertEqual(self.commands,
+                         [["ip", "route", "list", "dev", "tap9f8e7d6c-5b"]])
+
+    def test_failure(self):
+        # If the routes cannot be read, there is no snapshot.
+        self.fail = True
+        finterface.load_routes()
+        self.assertIsNone(finterface._routes)
+
+
+class FakeFile(object):
+    """
+    Records writes to a /proc file.
+    """
+    def __init__(self, writes, path):
+        self.writes = writes
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write(self, data):
+        self.writes.append((self.path, data))
+
+
+class TestConfigureTap(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+        self.ifindexes = {"tap1": 7}
+        self.real_ifindex = finterface._ifindex
+        finterface._ifindex = self.ifindexes.get
+        finterface.open = lambda path, mode: FakeFile(self.writes, path)
+        finterface._configured_taps.clear()
+
+    def tearDown(self):
+        finterface._ifindex = self.real_ifindex
+        del finterface.open
+        finterface._configured_taps.clear()
+
+    def configure(self):
+        """
+        Configure tap1, returning the files written.
+        """
+        del self.writes[:]
+        finterface.configure_tap("tap1")
+        return [path for path, data in self.writes]
+
+    def test_cache(self):
+        self.assertEqual(self.configure(),
+                         ["/proc/sys/net/ipv4/conf/tap1/route_localnet",
+                          "/proc/sys/net/ipv4/conf/tap1/proxy_arp"])
+
+        # Nothing is written while the tap has the same ifindex.
+        self.assertEqual(self.configure(), [])
+
+        # A tap that has been recreated is configured again.
+        self.ifindexes["tap1"] = 8
+        self.assertEqual(len(self.configure()), 2)
+        self.assertEqual(self.configure(), [])
+
+        # As is one that has been forgotten.
+        finterface.forget_tap("tap1")
+        self.assertEqual(len(self.configure()), 2)
+
+    def test_no_ifindex(self):
+        # If the ifindex cannot be read, the tap is configured every time.
+        del self.ifindexes["tap1"]
+        self.assertEqual(len(self.configure()), 2)
+        self.assertEqual(len(self.configure()), 2)
+        self.assertEqual(finterface._configured_taps, {})
+
+
+class TestRouteBatch(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.errors = {}
+        self.real_ip_batch = futils.ip_batch
+        futils.ip_batch = self.ip_batch
+
+        # Snapshot of routes, as load_routes would take.
+        finterface._routes = {IPV4: {TAP: (None, set(["10.0.0.1"]))},
+                              IPV6: {}}
+
+    def tearDown(self):
+        futils.ip_batch = self.real_ip_batch
+        finterface.clear_routes()
+
+    def ip_batch(self, commands):
+        self.batches.append([" ".join(command) for command in commands])
+        return self.errors
+
+    def test_pending(self):
+        batch = finterface.RouteBatch()
+        self.assertEqual(batch.list_tap_ips(IPV4, TAP), set(["10.0.0.1"]))
+
+        # Changes not yet applied are included.
+        batch.add_route("ep1", IPV4, "10.0.0.2", TAP, "aa:bb:cc:dd:ee:ff")
+        batch.del_route("ep1", IPV4, "10.0.0.1", TAP)
+        batch.add_route("ep1", IPV6, "2001::1", TAP, "aa:bb:cc:dd:ee:ff")
+        self.assertEqual(batch.list_tap_ips(IPV4, TAP), set(["10.0.0.2"]))
+        self.assertEqual(batch.list_tap_ips(IPV6, TAP), set(["2001::1"]))
+
+        # The last change for an address wins, so a later programming pass
+        # that drops the address it just added deletes it again.
+        batch.del_route("ep1", IPV4, "10.0.0.2", TAP)
+        self.assertEqual(batch.list_tap_ips(IPV4, TAP), set())
+
+        # The snapshot is unchanged until the batch is applied.
+        self.assertEqual(finterface.list_tap_ips(IPV4, TAP),
+                         set(["10.0.0.1"]))
+
+        self.assertEqual(batch.apply(), set())
+        self.assertEqual(self.batches,
+                         [["neigh replace 10.0.0.2 lladdr aa:bb:cc:dd:ee:ff "
+                           "dev %s nud permanent" % TAP,
+                           "route replace 10.0.0.2 dev %s" % TAP,
+                           "neigh del 10.0.0.1 dev %s" % TAP,
+                           "route del 10.0.0.1 dev %s" % TAP,
+                           "route replace 2001::1 dev %s" % TAP,
+                           "neigh del 10.0.0.2 dev %s" % TAP,
+                           "route del 10.0.0.2 dev %s" % TAP]])
+        self.assertEqual(finterface.list_tap_ips(IPV4, TAP), set())
+        self.assertEqual(finterface.list_tap_ips(IPV6, TAP),
+                         set(["2001::1"]))
+
+        # Applying the batch empties it.
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.list_tap_ips(IPV6, TAP), set(["2001::1"]))
+
+    def test_failures(self):
+        batch = finterface.RouteBatch()
+        batch.add_route("ep1", IPV4, "10.0.0.2", TAP, "aa:bb:cc:dd:ee:ff")
+        batch.add_route("ep2", IPV6, "2001::2", TAP, "aa:bb:cc:dd:ee:ff")
+        batch.add_route("ep3", IPV6, "2001::3", TAP, "aa:bb:cc:dd:ee:ff")
+
+        # The failed command is mapped back to the change that caused it.
+        self.errors = {2: "RTNETLINK answers: File exists"}
+        self.assertEqual(batch.apply(), set(["ep2"]))
+
+        # The routes for the tap are no longer known, but the others are.
+        self.assertIsNone(finterface._routes[IPV6][TAP])
+        self.assertEqual(finterface.list_tap_ips(IPV4, TAP),
+                         set(["10.0.0.1", "10.0.0.2"]))
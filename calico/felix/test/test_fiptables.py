@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fiptables
+~~~~~~~~~~~
+
+Tests for rule rendering and the iptables-restore paths in fiptables.
+"""
+import sys
+import unittest
+
+# Replace iptc with a stub, since we do not have it. Other tests replace
+# fiptables itself, so make sure that we load fresh copies of the real modules.
+import calico.felix
+import calico.felix.test.stub_iptc as stub_iptc
+sys.modules['iptc'] = stub_iptc
+for name in ('fiptables',):
+    sys.modules.pop('calico.felix.' + name, None)
+    calico.felix.__dict__.pop(name, None)
+
+from calico.felix import fiptables
+from calico.felix import futils
+from calico.felix.futils import IPV4, IPV6
+
+class TestRuleSpec(unittest.TestCase):
+    def test_matches(self):
+        rule = fiptables.Rule(IPV4, "ACCEPT")
+        rule.src = "10.0.0.1"
+        rule.in_interface = "tap1234"
+        rule.protocol = "tcp"
+        rule.create_tcp_match("80")
+        self.assertEqual(rule.spec,
+                         "-s 10.0.0.1/32 -i tap1234 -p tcp "
+                         "-m tcp --dport 80 -j ACCEPT")
+
+        rule = fiptables.Rule(IPV6, "DROP")
+        rule.dst = "2001::/64"
+        rule.out_interface = "tap1234"
+        rule.protocol = "icmpv6"
+        rule.create_icmp6_match(["135"])
+        self.assertEqual(rule.spec,
+                         "-d 2001::/64 -o tap1234 -p ipv6-icmp "
+                         "-m icmp6 --icmpv6-type 135 -j DROP")
+
+        rule = fiptables.Rule(IPV4, "RETURN")
+        rule.create_mark_match("!1")
+        self.assertEqual(rule.spec, "-m mark ! --mark 0x1 -j RETURN")
+
+        rule = fiptables.Rule(IPV4, "DROP")
+        rule.create_mac_match("aa:bb:cc:dd:ee:ff")
+        self.assertEqual(rule.spec,
+                         "-m mac --mac-source AA:BB:CC:DD:EE:FF -j DROP")
+
+        rule = fiptables.Rule(IPV4, "RETURN")
+        rule.create_set_match(["felix-to-addr-1234", "src"])
+        rule.create_conntrack_match(["RELATED", "ESTABLISHED"])
+        self.assertEqual(rule.spec,
+                         "-m set --match-set felix-to-addr-1234 src "
+                         "-m conntrack --ctstate RELATED,ESTABLISHED "
+                         "-j RETURN")
+
+    def test_targets(self):
+        rule = fiptables.Rule(IPV4)
+        self.assertEqual(rule.spec, "")
+
+        rule.create_target("MARK", {"set_mark": "1"})
+        self.assertEqual(rule.spec, "-j MARK --set-xmark 0x1/0xffffffff")
+
+        rule = fiptables.Rule(IPV4)
+        rule.protocol = "tcp"
+        rule.create_target("DNAT", {"to_destination": "127.0.0.1:9697"})
+        self.assertEqual(rule.spec,
+                         "-p tcp -j DNAT --to-destination 127.0.0.1:9697")
+
+    def test_quoting(self):
+        rule = fiptables.Rule(IPV4)
+        rule.create_target("LOG", {"log_prefix": "felix drop: "})
+        self.assertEqual(rule.spec, '-j LOG --log-prefix "felix drop: "')
+
+        rule = fiptables.Rule(IPV4)
+        rule.create_target("LOG", {"log_prefix": 'say "hi"\\'})
+        self.assertEqual(rule.spec, '-j LOG --log-prefix "say \\"hi\\"\\\\"')
+
+        rule = fiptables.Rule(IPV4)
+        rule.create_target("LOG", {"log_prefix": ""})
+        self.assertEqual(rule.spec, '-j LOG --log-prefix ""')
+
+
+SAVE_OUTPUT = """# Generated by iptables-save v1.4.21
+*%s
+:INPUT ACCEPT [0:0]
+:felix-INPUT - [0:0]
+:felix-from-1234 - [0:0]
+-A INPUT -j felix-INPUT
+-A felix-INPUT -i tap1234 -j felix-from-1234
+-A felix-from-1234 -m conntrack --ctstate INVALID -j DROP
+COMMIT
+# Completed
+"""
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.real_check_call = futils.check_call
+        futils.check_call = self.check_call
+        fiptables._state.clear()
+
+        self.table = stub_iptc.Table("filter")
+        self.chain = stub_iptc.Chain(self.table, "felix-to-1234")
+        self.state = fiptables.get_state(IPV4, "filter")
+        self.state.apply(":felix-to-1234 - [0:0]")
+
+    def tearDown(self):
+        futils.check_call = self.real_check_call
+        fiptables._state.clear()
+
+    def check_call(self, args, input_data=None):
+        self.calls.append((args, input_data))
+        return futils.CommandOutput("", "")
+
+    def rule(self, target):
+        return fiptables.Rule(IPV4, target)
+
+    def test_restore(self):
+        fiptables.restore(IPV4, "filter", [])
+        self.assertEqual(self.calls, [])
+
+        fiptables.restore(IPV6, "filter", ["-A felix-to-1234 -j DROP"])
+        self.assertEqual(self.calls,
+                         [(["ip6tables-restore", "--noflush"],
+                           "*filter\n-A felix-to-1234 -j DROP\nCOMMIT\n")])
+        self.assertEqual(fiptables.get_state(IPV6, "filter").rules(
+                             "felix-to-1234"),
+                         ["-j DROP"])
+        self.assertEqual(self.state.rules("felix-to-1234"), [])
+
+    def test_restore_failure(self):
+        def fail(args, input_data=None):
+            raise futils.FailedSystemCall("Failed system call", args, 1, "",
+                                          "iptables-restore: line 2 failed")
+        futils.check_call = fail
+
+        self.assertRaises(futils.FailedSystemCall,
+                          fiptables.restore,
+                          IPV4, "filter", ["-A felix-to-1234 -j DROP"])
+
+        # The model is unchanged.
+        self.assertEqual(self.state.rules("felix-to-1234"), [])
+
+    def test_truncate_rules(self):
+        for target in ("ACCEPT", "RETURN", "DROP"):
+            self.state.apply("-A felix-to-1234 -j %s" % target)
+
+        fiptables.truncate_rules(self.chain, 1)
+
+        self.assertEqual(self.calls,
+                         [(["iptables-restore", "--noflush"],
+                           "*filter\n"
+                           "-D felix-to-1234 3\n"
+                           "-D felix-to-1234 2\n"
+                           "COMMIT\n")])
+        self.assertEqual(self.state.rules("felix-to-1234"), ["-j ACCEPT"])
+
+        # Nothing to delete means nothing is written.
+        self.calls = []
+        fiptables.truncate_rules(self.chain, 1)
+        self.assertEqual(self.calls, [])
+
+    def test_update_chain(self):
+        for target in ("ACCEPT", "felix-from-1", "felix-from-2", "DROP"):
+            self.state.apply("-A felix-to-1234 -j %s" % target)
+
+        rules = [self.rule("RETURN"), self.rule("ACCEPT"), self.rule("DROP")]
+        ops = fiptables.update_chain(self.chain, rules)
+
+        # The two jumps are deleted in one restore, and the new first rule is
+        # inserted through python-iptables.
+        self.assertEqual(self.calls,
+                         [(["iptables-restore", "--noflush"],
+                           "*filter\n"
+                           "-D felix-to-1234 3\n"
+                           "-D felix-to-1234 2\n"
+                           "COMMIT\n")])
+        self.assertEqual(self.chain.rules, [rules[0]._rule])
+        self.assertEqual(self.state.rules("felix-to-1234"),
+                         ["-j RETURN", "-j ACCEPT", "-j DROP"])
+        self.assertEqual(self.state.jumps_to("felix-from-1"), [])
+        self.assertEqual(len(ops), 3)
+
+        # A chain that already has the right rules is not touched.
+        self.calls = []
+        self.assertEqual(fiptables.update_chain(self.chain, rules), [])
+        self.assertEqual(self.calls, [])
+
+    def test_load_state(self):
+        def save(args, input_data=None):
+            self.calls.append((args, input_data))
+            return futils.CommandOutput(SAVE_OUTPUT % args[2], "")
+        futils.check_call = save
+
+        fiptables.load_state()
+
+        self.assertEqual([args for args, _ in self.calls],
+                         [["iptables-save", "-t", "filter"],
+                          ["iptables-save", "-t", "nat"],
+                          ["ip6tables-save", "-t", "filter"]])
+        for type, table_name in fiptables.TABLES:
+            state = fiptables.get_state(type, table_name)
+            self.assertEqual(sorted(state.chains),
+                             ["felix-INPUT", "felix-from-1234"])
+            self.assertEqual(state.rules("felix-from-1234"),
+                             ["-m conntrack --ctstate INVALID -j DROP"])
+            self.assertEqual(state.jumps_to("felix-from-1234"),
+                             [("felix-INPUT",
+                               "-i tap1234 -j felix-from-1234")])
+
+        # Loading replaces whatever the model held before.
+        self.assertFalse(fiptables.get_state(IPV4, "filter").has_chain(
+                             "felix-to-1234"))
+
+    def test_reload_stale(self):
+        def save(args, input_data=None):
+            self.calls.append((args, input_data))
+            return futils.CommandOutput(SAVE_OUTPUT % args[2], "")
+        futils.check_call = save
+
+        # A model that has drifted from the kernel is loaded again when it is
+        # next used.
+        self.state.apply("-D felix-to-1234 -j DROP")
+        self.assertTrue(self.state.stale)
+        self.assertEqual(self.calls, [])
+
+        state = fiptables.get_state(IPV4, "filter")
+        self.assertEqual([args for args, _ in self.calls],
+                         [["iptables-save", "-t", "filter"]])
+        self.assertFalse(state.stale)
+        self.assertTrue(state.has_chain("felix-from-1234"))
+        self.assertFalse(state.has_chain("felix-to-1234"))
+
+        # Once reloaded, it is not loaded again.
+        fiptables.get_state(IPV4, "filter")
+        self.assertEqual(len(self.calls), 1)
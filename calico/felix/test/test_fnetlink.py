@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fnetlink
+~~~~~~~~~~~
+
+Tests for rtnetlink programming, using a socket pair in place of the kernel.
+"""
+import errno
+import socket
+import struct
+import unittest
+from calico.felix import fnetlink
+
+def ack(seq, error=0):
+    """
+    Build the acknowledgement the kernel sends for a message.
+    """
+    payload = struct.pack("=i", -error) + fnetlink.NLMSGHDR.pack(0, 0, 0, seq, 0)
+    return fnetlink.NLMSGHDR.pack(fnetlink.NLMSGHDR.size + len(payload),
+                                  fnetlink.NLMSG_ERROR, 0, seq, 0) + payload
+
+def parse(data):
+    """
+    Split a datagram into a list of (header fields, payload) pairs.
+    """
+    messages = []
+    offset   = 0
+    while offset < len(data):
+        header = fnetlink.NLMSGHDR.unpack_from(data, offset)
+        messages.append((header,
+                         data[offset + fnetlink.NLMSGHDR.size:
+                              offset + header[0]]))
+        offset += (header[0] + 3) & ~3
+    return messages
+
+class TestNetlink(unittest.TestCase):
+    def setUp(self):
+        self.kernel, sock = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_DGRAM)
+        self.netlink = fnetlink.NetlinkSocket(sock)
+
+    def tearDown(self):
+        self.kernel.close()
+        self.netlink.close()
+
+    def test_messages(self):
+        type, flags, payload = fnetlink.route_message("IPv4", "10.1.2.3", 7)
+        self.assertEqual(type, fnetlink.RTM_NEWROUTE)
+        self.assertEqual(payload,
+                         fnetlink.RTMSG.pack(socket.AF_INET, 32, 0, 0, 254,
+                                             3, 253, 1, 0) +
+                         struct.pack("=HH", 8, fnetlink.RTA_DST) +
+                         "\x0a\x01\x02\x03" +
+                         struct.pack("=HHi", 8, fnetlink.RTA_OIF, 7))
+
+        type, flags, payload = fnetlink.neigh_message("IPv4", "10.1.2.3",
+                                                      "aa:bb:cc:dd:ee:ff", 7)
+        self.assertEqual(type, fnetlink.RTM_NEWNEIGH)
+        self.assertTrue(payload.endswith(
+            struct.pack("=HH", 10, fnetlink.NDA_LLADDR) +
+            "\xaa\xbb\xcc\xdd\xee\xff\0\0"))
+
+        type, flags, payload = fnetlink.route_message("IPv6", "2001:db8::1", 7,
+                                                      add=False)
+        self.assertEqual(type, fnetlink.RTM_DELROUTE)
+        self.assertEqual(len(payload), 12 + 20 + 8)
+
+    def test_request(self):
+        messages = [fnetlink.route_message("IPv4", "10.1.2.3", 7),
+                    fnetlink.neigh_message("IPv4", "10.1.2.3", None, 7,
+                                           add=False),
+                    fnetlink.route_message("IPv6", "2001:db8::1", 7)]
+
+        # The acknowledgements can arrive in any grouping.
+        self.kernel.send(ack(1) + ack(2, errno.ENOENT))
+        self.kernel.send(ack(3))
+        self.assertEqual(self.netlink.request(messages), {1: errno.ENOENT})
+
+        # All the messages are sent in one datagram, each asking for an ack.
+        sent = parse(self.kernel.recv(65536))
+        self.assertEqual([header[1] for header, payload in sent],
+                         [fnetlink.RTM_NEWROUTE,
+                          fnetlink.RTM_DELNEIGH,
+                          fnetlink.RTM_NEWROUTE])
+        self.assertEqual([header[3] for header, payload in sent], [1, 2, 3])
+        for header, payload in sent:
+            self.assertTrue(header[2] & fnetlink.NLM_F_ACK)
+
+        self.kernel.send(ack(4, errno.EEXIST))
+        with self.assertRaises(fnetlink.NetlinkError) as cm:
+            self.netlink.check_request(messages[:1])
+        self.assertEqual(cm.exception.errno, errno.EEXIST)
+
+    def test_link_watcher(self):
+        kernel, sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        watcher = fnetlink.LinkWatcher(sock)
+        self.assertEqual(watcher.read_links(), set())
+
+        def link(msg_type, name):
+            payload = (fnetlink.IFINFOMSG.pack(0, 0, 0, 5, 0, 0) +
+                       struct.pack("=HH", 4 + len(name) + 1,
+                                   fnetlink.IFLA_IFNAME) +
+                       name + "\0" * (4 - len(name) % 4))
+            return fnetlink.NLMSGHDR.pack(fnetlink.NLMSGHDR.size + len(payload),
+                                          msg_type, 0, 0, 0) + payload
+
+        kernel.send(link(fnetlink.RTM_NEWLINK, "tap1234") +
+                    link(fnetlink.RTM_NEWLINK, "eth0"))
+        kernel.send(link(fnetlink.RTM_NEWLINK + 1, "tap5678"))
+        self.assertEqual(watcher.read_links(), set(["tap1234", "eth0"]))
+        self.assertEqual(watcher.read_links(), set())
+
+        watcher.close()
+        kernel.close()
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_frules
+~~~~~~~~~~~
+
+Tests for Felix rule and ipset management.
+"""
+import sys
+import unittest
+
+# Replace iptc with a stub, since we do not have it. Other tests replace
+# fiptables itself, so make sure that we load fresh copies of the real modules.
+import calico.felix
+import calico.felix.test.stub_iptc as stub_iptc
+sys.modules['iptc'] = stub_iptc
+for name in ('fiptables', 'frules'):
+    sys.modules.pop('calico.felix.' + name, None)
+    calico.felix.__dict__.pop(name, None)
+
+from calico.felix import fiptables
+from calico.felix import frules
+from calico.felix import futils
+from calico.felix.futils import FailedSystemCall, IPV4, IPV6
+
+class TestIpsetRestore(unittest.TestCase):
+    def setUp(self):
+        self.inputs = []
+        self.applied = []
+        self.real_check_call = futils.check_call
+        futils.check_call = self.ipset_restore
+        frules._ipsets.clear()
+
+    def tearDown(self):
+        futils.check_call = self.real_check_call
+        frules._ipsets.clear()
+
+    def ipset_restore(self, args, input_data=None):
+        """
+        Mimics "ipset restore", which stops at the first line that fails;
+        here, any line containing "bad".
+        """
+        self.inputs.append(input_data)
+        for num, line in enumerate(input_data.splitlines(), 1):
+            if "bad" in line:
+                raise FailedSystemCall("Failed system call", args, 1, "",
+                                       "ipset v6.20.1: Error in line %d: "
+                                       "Syntax error\n" % num)
+            self.applied.append(line)
+        return futils.CommandOutput("", "")
+
+    def test_success(self):
+        frules.ipset_restore("IPv4", ["create felix-a hash:net",
+                                      "add felix-a 10.0.0.0/8",
+                                      "destroy felix-b"])
+        self.assertEqual(self.inputs, ["create felix-a hash:net\n"
+                                       "add felix-a 10.0.0.0/8\n"
+                                       "destroy felix-b\n"])
+        self.assertEqual(frules._ipsets, set(["felix-a"]))
+
+    def test_bad_entries(self):
+        lines = ["create felix-a hash:net"]
+        for ii in range(10):
+            lines.append("add felix-a 10.0.%d.0/24" % ii)
+            lines.append("add felix-a bad%d" % ii)
+        lines.append("create felix-b hash:net")
+
+        frules.ipset_restore("IPv4", lines)
+
+        # Each run starts after the entry that failed last time, so every
+        # good line is applied exactly once.
+        self.assertEqual(len(self.inputs), 11)
+        self.assertEqual(self.inputs[1], "\n".join(lines[3:]) + "\n")
+        self.assertEqual(self.applied,
+                         [line for line in lines if "bad" not in line])
+        self.assertEqual(frules._ipsets, set(["felix-a", "felix-b"]))
+
+    def test_other_failure(self):
+        lines = ["create felix-a hash:net",
+                 "add felix-a bad",
+                 "create felix-bad hash:net",
+                 "create felix-c hash:net"]
+
+        self.assertRaises(FailedSystemCall,
+                          frules.ipset_restore, "IPv4", lines)
+
+        # The lines before the failure were applied, and no more.
+        self.assertEqual(len(self.inputs), 2)
+        self.assertEqual(self.applied, ["create felix-a hash:net"])
+        self.assertEqual(frules._ipsets, set(["felix-a"]))
+
+    def test_session(self):
+        # With sessions, each line is a separate command in the ipset
+        # session, so the lines after a failure are still run.
+        batches = []
+        def ipset_batch(commands):
+            batches.append(commands)
+            return dict((index, "ipset v6.20.1: Syntax error\n")
+                        for index, command in enumerate(commands)
+                        if "bad" in " ".join(command))
+
+        real_ipset_batch = futils.ipset_batch
+        futils.ipset_batch = ipset_batch
+        futils.set_use_sessions(True)
+        try:
+            frules.ipset_restore("IPv4", ["create felix-a hash:net",
+                                          "add felix-a bad0",
+                                          "destroy felix-b"])
+            self.assertRaises(FailedSystemCall,
+                              frules.ipset_restore, "IPv4",
+                              ["create felix-bad hash:net",
+                               "create felix-c hash:net"])
+        finally:
+            futils.ipset_batch = real_ipset_batch
+            futils.set_use_sessions(False)
+
+        self.assertEqual(self.inputs, [])
+        self.assertEqual(batches[0],
+                         [["create", "felix-a", "hash:net", "-exist"],
+                          ["add", "felix-a", "bad0", "-exist"],
+                          ["destroy", "felix-b", "-exist"]])
+        self.assertEqual(frules._ipsets, set(["felix-a", "felix-c"]))
+
+
+class TestRuleBatch(unittest.TestCase):
+    def setUp(self):
+        self.restores = []
+        self.fail = set()
+        self.real_check_call = futils.check_call
+        self.real_restore = fiptables.restore
+        futils.check_call = self.check_call
+        fiptables.restore = self.restore
+        frules._ipsets.clear()
+        fiptables._state.clear()
+
+        for type in (IPV4, IPV6):
+            state = fiptables.get_state(type, "filter")
+            state.apply(":felix-INPUT - [0:0]")
+            state.apply(":felix-FORWARD - [0:0]")
+
+    def tearDown(self):
+        futils.check_call = self.real_check_call
+        fiptables.restore = self.real_restore
+        frules._ipsets.clear()
+        fiptables._state.clear()
+
+    def check_call(self, args, input_data=None):
+        return futils.CommandOutput("", "")
+
+    def restore(self, type, table_name, lines):
+        """
+        Records each restore, and applies it to the model as restore would,
+        unless it is for a type in self.fail. As restore, does nothing if
+        there are no lines.
+        """
+        if not lines:
+            return
+        self.restores.append((type, table_name, lines))
+        if type in self.fail:
+            raise FailedSystemCall("Failed system call", [], 1, "", "")
+        state = fiptables.get_state(type, table_name)
+        for line in lines:
+            state.apply(line)
+
+    def add(self, batch, id):
+        for type, ip in ((IPV4, "10.0.0.%s" % id), (IPV6, "2001::%s" % id)):
+            batch.set_ep_specific_rules("uuid" + id, id, "tap" + id, type,
+                                        set([ip]), "aa:bb:cc:dd:ee:ff")
+
+    def test_single_restore(self):
+        batch = frules.RuleBatch()
+        for id in ("1", "2", "3"):
+            self.add(batch, id)
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(self.restores, [])
+
+        self.assertEqual(batch.apply(), set())
+        self.assertEqual([(type, table_name)
+                          for type, table_name, lines in self.restores],
+                         [(IPV4, "filter"), (IPV6, "filter")])
+        self.assertEqual(len(batch), 0)
+
+        for type in (IPV4, IPV6):
+            state = fiptables.get_state(type, "filter")
+            for id in ("1", "2", "3"):
+                self.assertTrue(state.has_chain("felix-to-" + id))
+                self.assertTrue(state.has_chain("felix-from-" + id))
+                self.assertTrue(state.jumps_to("felix-to-" + id))
+
+        # The ipsets were created as the endpoints were added.
+        self.assertIn("felix-to-addr-1", frules._ipsets)
+        self.assertIn("felix-6-from-port-3", frules._ipsets)
+
+        # Nothing has changed, so applying the same rules again does not
+        # need a restore.
+        for id in ("1", "2", "3"):
+            self.add(batch, id)
+        batch.apply()
+        self.assertEqual(len(self.restores), 2)
+
+    def test_repeat_and_discard(self):
+        batch = frules.RuleBatch()
+        self.add(batch, "1")
+        self.add(batch, "1")
+        self.add(batch, "2")
+        batch.discard("2")
+        self.assertEqual(len(batch), 2)
+
+        batch.apply()
+        lines = self.restores[0][2]
+        self.assertEqual(lines.count(":felix-to-1 - [0:0]"), 1)
+        self.assertFalse([line for line in lines if "felix-to-2" in line])
+
+    def test_failure(self):
+        batch = frules.RuleBatch()
+        self.add(batch, "1")
+        self.add(batch, "2")
+        self.fail.add(IPV6)
+
+        self.assertEqual(batch.apply(), set(["uuid1", "uuid2"]))
+        self.assertTrue(fiptables.get_state(IPV4, "filter").has_chain(
+                        "felix-to-1"))
+        self.assertFalse(fiptables.get_state(IPV6, "filter").has_chain(
+                         "felix-to-1"))
+
+
+class TestDispatchTree(unittest.TestCase):
+    def setUp(self):
+        self.max_rules = frules.DISPATCH_MAX_RULES
+        frules.DISPATCH_MAX_RULES = 2
+        frules.set_dispatch_mode(frules.DISPATCH_TREE)
+        fiptables._state.clear()
+
+        # set_global_rules creates the top level chains at start of day.
+        state = fiptables.get_state(IPV4, "filter")
+        state.apply(":felix-INPUT - [0:0]")
+        state.apply(":felix-FORWARD - [0:0]")
+
+    def tearDown(self):
+        frules.DISPATCH_MAX_RULES = self.max_rules
+        frules.set_dispatch_mode(frules.DISPATCH_FLAT)
+        fiptables._state.clear()
+
+    def update(self, add=None, remove=()):
+        """
+        Get the dispatch changes and apply them to the model, as restore
+        would.
+        """
+        lines = frules._dispatch_updates(IPV4, add, remove)
+        state = fiptables.get_state(IPV4, "filter")
+        for line in lines:
+            state.apply(line)
+        return lines
+
+    def test_flat(self):
+        frules.set_dispatch_mode(frules.DISPATCH_FLAT)
+        chains = frules._dispatch_chains({"tap2": "2", "tap1": "1"})
+        self.assertEqual(chains,
+                         {"felix-INPUT": ["-i tap1 -j felix-from-1",
+                                          "-i tap2 -j felix-from-2"],
+                          "felix-FORWARD": ["-i tap1 -j felix-from-1",
+                                            "-o tap1 -j felix-to-1",
+                                            "-i tap2 -j felix-from-2",
+                                            "-o tap2 -j felix-to-2"]})
+
+    def test_small_tree(self):
+        # Up to DISPATCH_MAX_RULES endpoints need no dispatch chains.
+        chains = frules._dispatch_chains({"tap1": "1", "tap2": "2"})
+        self.assertEqual(sorted(chains), ["felix-FORWARD", "felix-INPUT"])
+        self.assertEqual(chains["felix-INPUT"], ["-i tap1 -j felix-from-1",
+                                                 "-i tap2 -j felix-from-2"])
+
+    def test_shared_prefixes(self):
+        ifaces = {"tapa1": "a1", "tapa2": "a2", "tapb1": "b1",
+                  "tapc11": "c11", "tapc12": "c12", "tapc2": "c2"}
+        chains = frules._dispatch_chains(ifaces)
+
+        # Names sharing a prefix get a chain; a prefix with a single name
+        # under it is collapsed into a rule for that name.
+        self.assertEqual(chains["felix-INPUT"],
+                         ["-i tapa+ -j felix-FROM-tapa",
+                          "-i tapb1 -j felix-from-b1",
+                          "-i tapc+ -j felix-FROM-tapc"])
+        self.assertEqual(chains["felix-FROM-tapa"],
+                         ["-i tapa1 -j felix-from-a1",
+                          "-i tapa2 -j felix-from-a2"])
+        self.assertEqual(chains["felix-FROM-tapc"],
+                         ["-i tapc1+ -j felix-FROM-tapc1",
+                          "-i tapc2 -j felix-from-c2"])
+        self.assertEqual(chains["felix-FROM-tapc1"],
+                         ["-i tapc11 -j felix-from-c11",
+                          "-i tapc12 -j felix-from-c12"])
+        self.assertEqual(chains["felix-TO-tapc1"],
+                         ["-o tapc11 -j felix-to-c11",
+                          "-o tapc12 -j felix-to-c12"])
+        self.assertEqual(chains["felix-FORWARD"],
+                         chains["felix-INPUT"] +
+                         ["-o tapa+ -j felix-TO-tapa",
+                          "-o tapb1 -j felix-to-b1",
+                          "-o tapc+ -j felix-TO-tapc"])
+        self.assertEqual(len(chains), 8)
+
+    def test_updates(self):
+        lines = self.update(add={"tapa1": "a1", "tapa2": "a2", "tapb1": "b1"})
+
+        # Chains are declared before the rules that refer to them.
+        self.assertEqual(lines[:2], [":felix-FROM-tapa - [0:0]",
+                                     ":felix-TO-tapa - [0:0]"])
+        state = fiptables.get_state(IPV4, "filter")
+        self.assertEqual(state.rules("felix-INPUT"),
+                         ["-i tapa+ -j felix-FROM-tapa",
+                          "-i tapb1 -j felix-from-b1"])
+
+        # The endpoints are found again from the model, so nothing changes.
+        self.assertEqual(self.update(), [])
+
+        # Removing an endpoint leaves a single name under tapa, so its chains
+        # are collapsed. They are removed after the rules that refer to them
+        # have gone.
+        lines = self.update(remove=["a2"])
+        self.assertEqual(lines[-4:], ["-F felix-FROM-tapa",
+                                      "-X felix-FROM-tapa",
+                                      "-F felix-TO-tapa",
+                                      "-X felix-TO-tapa"])
+        self.assertFalse(state.has_chain("felix-FROM-tapa"))
+        self.assertEqual(state.rules("felix-INPUT"),
+                         ["-i tapa1 -j felix-from-a1",
+                          "-i tapb1 -j felix-from-b1"])
+
+    def test_remove_last(self):
+        self.update(add={"tapa1": "a1", "tapa2": "a2", "tapb1": "b1"})
+
+        # Removing the last interfaces under a node removes its chains, and
+        # removing the rest empties the top level chains.
+        lines = self.update(remove=["a1", "a2"])
+        state = fiptables.get_state(IPV4, "filter")
+        self.assertIn("-X felix-FROM-tapa", lines)
+        self.assertIn("-X felix-TO-tapa", lines)
+        self.assertEqual(state.rules("felix-INPUT"),
+                         ["-i tapb1 -j felix-from-b1"])
+
+        self.update(remove=["b1"])
+        self.assertEqual(state.rules("felix-INPUT"), [])
+        self.assertEqual(state.rules("felix-FORWARD"), [])
+        self.assertEqual(sorted(state.chains), ["felix-FORWARD",
+                                                "felix-INPUT"])
+
+
+class TestSharedIpsets(unittest.TestCase):
+    def setUp(self):
+        self.restores = []
+        self.destroyed = []
+        self.in_use = set()
+        self.ipset_names = ""
+        self.real_check_call = futils.check_call
+        self.real_call_silent = futils.call_silent
+        futils.check_call = self.check_call
+        futils.call_silent = self.call_silent
+        frules.set_shared_ipsets(True)
+        self.clear()
+
+    def tearDown(self):
+        futils.check_call = self.real_check_call
+        futils.call_silent = self.real_call_silent
+        frules.set_shared_ipsets(False)
+        self.clear()
+
+    def clear(self):
+        frules._shared_ipset_refs.clear()
+        frules._ep_shared_ipsets.clear()
+        frules._ipsets.clear()
+        fiptables._state.clear()
+
+    def check_call(self, args, input_data=None):
+        if args[:2] == ["ipset", "restore"]:
+            self.restores.append(input_data)
+        elif args[:2] == ["ipset", "list"]:
+            return futils.CommandOutput(self.ipset_names, "")
+        elif args[:2] == ["ipset", "destroy"]:
+            self.destroyed.append(args[2])
+        return futils.CommandOutput("", "")
+
+    def call_silent(self, args):
+        if args[2] in self.in_use:
+            return 1
+        self.destroyed.append(args[2])
+        return 0
+
+    def set_acls(self, id, inbound):
+        frules.set_acls(id, IPV4, inbound, "deny", [], "deny")
+
+    def created(self):
+        return [line.split()[1] for line in self.restores[-1].splitlines()
+                if line.startswith("create felix-net")]
+
+    def test_sharing(self):
+        inbound = [{'cidr': "10.0.0.0/8"}]
+        net_a = frules._shared_ipset_name("felix-net-", ["10.0.0.0/8"])
+        net_e = frules._shared_ipset_name("felix-net-", [])
+        port_e = frules._shared_ipset_name("felix-netport-", [])
+
+        # The first endpoint creates each distinct shared ipset once, even
+        # though the empty ones are used several times.
+        self.set_acls("a", inbound)
+        self.assertEqual(sorted(self.created()),
+                         sorted([net_a, net_e, port_e]))
+        lines = self.restores[-1].splitlines()
+        index = lines.index("create felix-l-to-addr-a list:set")
+        self.assertEqual(lines[index + 1:index + 3],
+                         ["add felix-tmp-list %s" % net_a,
+                          "swap felix-tmp-list felix-l-to-addr-a"])
+        self.assertEqual(frules._shared_ipset_refs,
+                         {net_a: 1, net_e: 3, port_e: 2})
+
+        # An endpoint with the same ACLs shares them.
+        self.set_acls("b", inbound)
+        self.assertEqual(self.created(), [])
+        self.assertEqual(frules._shared_ipset_refs,
+                         {net_a: 2, net_e: 6, port_e: 4})
+
+        # Setting the same ACLs again changes no reference counts.
+        self.set_acls("b", inbound)
+        self.assertEqual(frules._shared_ipset_refs,
+                         {net_a: 2, net_e: 6, port_e: 4})
+        self.assertEqual(self.destroyed, [])
+
+    def test_release(self):
+        inbound = [{'cidr': "10.0.0.0/8"}]
+        net_a = frules._shared_ipset_name("felix-net-", ["10.0.0.0/8"])
+        net_e = frules._shared_ipset_name("felix-net-", [])
+
+        self.set_acls("a", inbound)
+        self.set_acls("b", inbound)
+
+        # A shared ipset that is still referenced is not destroyed.
+        self.set_acls("a", [])
+        self.assertEqual(frules._shared_ipset_refs[net_a], 1)
+        self.assertEqual(frules._shared_ipset_refs[net_e], 7)
+        self.assertEqual(self.destroyed, [])
+
+        # Releasing the last reference destroys it.
+        self.set_acls("b", [])
+        self.assertNotIn(net_a, frules._shared_ipset_refs)
+        self.assertEqual(self.destroyed, [net_a])
+
+        # Deleting the endpoints destroys their list:set ipsets, then the
+        # shared ipsets they referenced.
+        self.destroyed = []
+        frules.del_rules_batch(["a", "b"], IPV4)
+        self.assertEqual(frules._shared_ipset_refs, {})
+        self.assertEqual(frules._ep_shared_ipsets, {})
+        self.assertIn("felix-l-to-addr-a", self.destroyed)
+        self.assertIn("felix-l-from-icmp-b", self.destroyed)
+        self.assertEqual(self.destroyed[-2:],
+                         [frules._shared_ipset_name("felix-netport-", []),
+                          net_e])
+
+    def test_missing(self):
+        # A shared ipset destroyed from under us is noticed when the inventory
+        # is reloaded, and is created again for the next endpoint to use it.
+        inbound = [{'cidr': "10.0.0.0/8"}]
+        net_a = frules._shared_ipset_name("felix-net-", ["10.0.0.0/8"])
+
+        self.set_acls("a", inbound)
+        self.assertTrue(frules.ep_acl_ipsets_exist("a", IPV4))
+
+        frules._ipsets.discard(net_a)
+        self.assertTrue(frules.ep_ipsets_exist("a", IPV4))
+        self.assertFalse(frules.ep_acl_ipsets_exist("a", IPV4))
+
+        self.set_acls("a", inbound)
+        self.assertEqual(self.created(), [net_a])
+        self.assertTrue(frules.ep_acl_ipsets_exist("a", IPV4))
+        self.assertEqual(frules._shared_ipset_refs[net_a], 1)
+
+    def test_collect(self):
+        # Shared ipsets left from a previous run have no references. Those
+        # that are not in use are destroyed when the inventory is loaded.
+        frules._shared_ipset_refs["felix-net-used"] = 1
+        self.in_use.add("felix-net-busy")
+        self.ipset_names = "\n".join(["felix-to-addr-1234",
+                                      "felix-net-old",
+                                      "felix-net-busy",
+                                      "felix-net-used",
+                                      "felix-6-netport-old",
+                                      "other"])
+
+        frules.load_inventory()
+
+        self.assertEqual(self.destroyed, ["felix-6-netport-old",
+                                          "felix-net-old"])
+        self.assertEqual(frules._ipsets, set(["felix-to-addr-1234",
+                                              "felix-net-busy",
+                                              "felix-net-used"]))
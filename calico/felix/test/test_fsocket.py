@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fsocket
+~~~~~~~~~~~
+
+Tests for pipelining requests on the ACL request socket.
+"""
+import json
+import sys
+import unittest
+
+# Replace zmq with a stub, so that no real sockets are connected.
+import calico.felix.test.stub_zmq as stub_zmq
+sys.modules['zmq'] = stub_zmq
+
+from calico.felix.fsocket import Message, Socket
+
+class Config(object):
+    PLUGIN_ADDR    = "localhost"
+    ACL_ADDR       = "localhost"
+    ACL_REQ_WINDOW = 3
+
+
+class TestPipelining(unittest.TestCase):
+    def setUp(self):
+        self.context = stub_zmq.Context()
+        self.sock = Socket(Socket.TYPE_ACL_REQ, Config())
+        self.sock.communicate("felix1", self.context)
+
+    def send(self, endpoint_id):
+        """
+        Send a GETACLSTATE request, and return the request ID it was sent
+        with.
+        """
+        self.sock.send(Message(Message.TYPE_GET_ACL,
+                               {'endpoint_id': endpoint_id}))
+        empty, data = self.sock._zmq.sent[-1]
+        self.assertEqual(empty, "")
+        return json.loads(data)['request_id']
+
+    def respond(self, request_id, endpoint_id):
+        """
+        Queue a response from the ACL manager, with the delimiter frame that
+        a DEALER socket receives, and receive it.
+        """
+        fields = {'type': Message.TYPE_GET_ACL,
+                  'endpoint_id': endpoint_id,
+                  'rc': "SUCCESS",
+                  'message': ""}
+        if request_id is not None:
+            fields['request_id'] = request_id
+        self.sock._zmq.queue("", json.dumps(fields))
+        return self.sock.receive()
+
+    def test_match(self):
+        # Responses are matched to requests by ID, in whatever order they
+        # arrive.
+        id1 = self.send("ep1")
+        id2 = self.send("ep2")
+        self.assertNotEqual(id1, id2)
+        self.assertEqual(sorted(self.sock.in_flight), sorted([id1, id2]))
+
+        message = self.respond(id2, "ep2")
+        self.assertEqual(message.fields['endpoint_id'], "ep2")
+        self.assertEqual(self.sock.in_flight.keys(), [id1])
+
+        message = self.respond(id1, "ep1")
+        self.assertEqual(message.fields['endpoint_id'], "ep1")
+        self.assertEqual(self.sock.in_flight, {})
+
+    def test_window(self):
+        # Up to the window of requests can be outstanding.
+        ids = [self.send("ep%d" % ii) for ii in range(Config.ACL_REQ_WINDOW)]
+        self.assertTrue(self.sock.request_outstanding)
+
+        self.respond(ids[1], "ep1")
+        self.assertFalse(self.sock.request_outstanding)
+
+        self.send("ep3")
+        self.assertTrue(self.sock.request_outstanding)
+
+    def test_unknown(self):
+        # A response with an unknown request ID is dropped.
+        id1 = self.send("ep1")
+        self.assertIsNone(self.respond(str(int(id1) + 100), "ep9"))
+        self.assertEqual(self.sock.in_flight.keys(), [id1])
+
+    def test_stale(self):
+        # Requests sent on a previous connection are forgotten, so their
+        # responses are dropped.
+        for ii in range(Config.ACL_REQ_WINDOW):
+            id1 = self.send("ep%d" % ii)
+        self.sock.communicate("felix1", self.context)
+        self.assertEqual(self.sock.in_flight, {})
+        self.assertFalse(self.sock.request_outstanding)
+
+        self.assertIsNone(self.respond(id1, "ep1"))
+
+        # New requests carry on from the old request IDs, so that they cannot
+        # be confused with the old ones.
+        self.assertNotEqual(self.send("ep1"), id1)
+
+    def test_no_request_id(self):
+        # An ACL manager that does not echo request IDs answers requests in
+        # order, so a response without one answers the oldest (in numeric
+        # order, not string order).
+        self.sock.next_request_id = 9
+        id1 = self.send("ep1")
+        id2 = self.send("ep2")
+        self.assertEqual((id1, id2), ("9", "10"))
+
+        self.respond(None, "ep1")
+        self.assertEqual(self.sock.in_flight.keys(), [id2])
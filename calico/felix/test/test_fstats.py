@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fstats
+~~~~~~~~~~~
+
+Tests for the statistics on external calls.
+"""
+import unittest
+from calico.felix import fstats
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        fstats.reset()
+
+    def tearDown(self):
+        fstats.reset()
+
+    def test_record(self):
+        for elapsed in (0.0005, 0.0015, 0.003, 0.003, 100.0):
+            fstats.record("ipset add", elapsed)
+
+        stats = fstats.stats["ipset add"]
+        self.assertEqual(stats.count, 5)
+        self.assertAlmostEqual(stats.total, 100.008)
+        self.assertEqual(stats.max, 100.0)
+        self.assertEqual(stats.histogram[:3], [1, 1, 2])
+        self.assertEqual(stats.histogram[-1], 1)
+        self.assertEqual(sum(stats.histogram), 5)
+
+        self.assertEqual(str(stats),
+                         "ipset add : count 5, total 100.008s, mean 20001.6ms, "
+                         "max 100000.0ms, <1ms:1 <2ms:1 <4ms:2 <32768ms:1")
+
+    def test_command_name(self):
+        self.assertEqual(fstats.command_name(["ip", "-6", "route", "add"]),
+                         "ip route")
+        self.assertEqual(fstats.command_name(["/sbin/ipset", "add", "x", "y"]),
+                         "ipset add")
+        self.assertEqual(fstats.command_name(["iptables-restore", "--noflush"]),
+                         "iptables-restore")
+
+    def test_values(self):
+        fstats.set_value("Endpoints awaiting retry", 3)
+        fstats.set_value("Endpoints awaiting retry", 2)
+        self.assertEqual(fstats.values, {"Endpoints awaiting retry": 2})
+        fstats.log_stats()
+
+        fstats.reset()
+        self.assertEqual(fstats.values, {})
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_ftimers
+~~~~~~~~~~~
+
+Tests for the timer heap.
+"""
+import unittest
+from calico.felix import ftimers
+
+class TestTimerHeap(unittest.TestCase):
+    def test_timers(self):
+        timers = ftimers.TimerHeap()
+        self.assertEqual(timers.timeout(now=100), None)
+        self.assertEqual(timers.pop_due(now=100), set())
+
+        timers.schedule("resync", 30, now=100)
+        timers.schedule(("socket", "EP_REQ"), 10, now=100)
+        timers.schedule("retry", 0.5, now=100)
+        self.assertEqual(timers.timeout(now=100), 0.5)
+        self.assertEqual(timers.pop_due(now=100.2), set())
+
+        # Moving a timer replaces its old deadline.
+        timers.schedule("retry", 20, now=100)
+        self.assertEqual(timers.timeout(now=100), 10)
+        self.assertEqual(timers.pop_due(now=111), set([("socket", "EP_REQ")]))
+        self.assertFalse(timers.is_scheduled(("socket", "EP_REQ")))
+
+        timers.cancel("retry")
+        self.assertEqual(timers.timeout(now=111), 19)
+        self.assertEqual(timers.pop_due(now=200), set(["resync"]))
+        self.assertEqual(timers.timeout(now=200), None)
+
+    def test_overdue(self):
+        timers = ftimers.TimerHeap()
+        timers.schedule_at("stats", 50)
+        timers.schedule_at("stats", 50)
+        self.assertEqual(timers.timeout(now=100), 0)
+        self.assertEqual(timers.pop_due(now=100), set(["stats"]))
+        self.assertEqual(timers.pop_due(now=100), set())
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_futils
+~~~~~~~~~~~
+
+Tests for running batches of ip and ipset commands. The ip tests use only
+commands that read state, or that fail without changing anything, so need an
+"ip" binary but no special privileges. The ipset tests run a fake "ipset -"
+process.
+"""
+import distutils.spawn
+import sys
+import time
+import unittest
+from calico.felix import futils
+
+HAVE_IP = distutils.spawn.find_executable("ip") is not None
+
+@unittest.skipUnless(HAVE_IP, "No ip command")
+class TestIpBatchSession(unittest.TestCase):
+    def setUp(self):
+        self.session = futils.IpBatchSession()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_errors(self):
+        lines = ["link show dev lo",
+                 "link show dev nosuchdev0",
+                 "link show dev lo",
+                 "link show dev nosuchdev1"]
+        errors = self.session.run(lines)
+
+        # Errors are matched to the commands that caused them.
+        self.assertEqual(sorted(errors), [1, 3])
+        self.assertIn("nosuchdev0", errors[1])
+        self.assertIn("nosuchdev1", errors[3])
+
+        # The session carries on, counting lines from where it left off.
+        proc = self.session._proc
+        errors = self.session.run(["link show dev nosuchdev2",
+                                   "link show dev lo"])
+        self.assertEqual(errors.keys(), [0])
+        self.assertIn("nosuchdev2", errors[0])
+        self.assertIs(self.session._proc, proc)
+
+    def test_chunks(self):
+        lines = ["link show dev lo"] * (futils.IpBatchSession.CHUNK_SIZE * 2)
+        lines.append("link show dev nosuchdev0")
+        errors = self.session.run(lines)
+        self.assertEqual(errors.keys(), [len(lines) - 1])
+
+    def test_restart(self):
+        # A failed "neigh del" makes ip exit, even with -force. The command
+        # is reported as failed, and the rest run in a new process.
+        lines = ["link show dev lo",
+                 "neigh del 192.0.2.1 dev lo",
+                 "link show dev nosuchdev0",
+                 "link show dev lo"]
+        errors = self.session.run(lines)
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertIn("nosuchdev0", errors[2])
+        self.assertIsNone(self.session._proc.poll())
+
+    def test_timeout(self):
+        # If ip writes nothing (here, because the sentinel succeeds), the
+        # command is reported as failed rather than waiting forever.
+        self.session.SENTINEL = "link show dev lo"
+        self.session.READ_TIMEOUT = 0.2
+
+        start = time.time()
+        errors = self.session.run(["link show dev lo"])
+        self.assertEqual(errors.keys(), [0])
+        self.assertIn("timed out", errors[0])
+        self.assertLess(time.time() - start, 5)
+
+
+@unittest.skipUnless(HAVE_IP, "No ip command")
+class TestIpBatch(unittest.TestCase):
+    def tearDown(self):
+        futils.set_use_sessions(False)
+        if futils._ip_session is not None:
+            futils._ip_session.close()
+            futils._ip_session = None
+
+    def test_check_ip_batch(self):
+        for use_sessions in (False, True):
+            futils.set_use_sessions(use_sessions)
+
+            futils.check_ip_batch([["link", "show", "dev", "lo"]])
+
+            try:
+                futils.check_ip_batch([["link", "show", "dev", "lo"],
+                                       ["link", "show", "dev", "nosuchdev0"],
+                                       ["link", "show", "dev", "nosuchdev1"]])
+            except futils.FailedSystemCall as e:
+                # The first command that failed is reported.
+                self.assertEqual(list(e.args),
+                                 ["ip", "link", "show", "dev", "nosuchdev0"])
+                self.assertIn("nosuchdev0", e.stderr)
+            else:
+                self.fail("No exception for failed commands")
+
+        # The session is kept for next time.
+        self.assertIsNotNone(futils._ip_session)
+
+    def test_empty(self):
+        self.assertEqual(futils.ip_batch([]), {})
+
+
+# A fake "ipset -", which reports errors like the real one: for the sentinel,
+# for any command containing "bad", and for any command containing "exit"
+# before exiting.
+FAKE_IPSET = """
+import sys
+for line in iter(sys.stdin.readline, ""):
+    words = line.split()
+    if "%s" in line:
+        sys.stderr.write("ipset v6.20.1: Syntax error: setname '%%s' is "
+                         "longer than 31 characters\\n" %% words[1])
+    elif "bad" in line:
+        sys.stderr.write("ipset v6.20.1: Syntax error: '%%s' is invalid\\n"
+                         "Try `ipset help' for more information.\\n" %%
+                         words[-1])
+    elif "exit" in line:
+        sys.stderr.write("ipset v6.20.1: Kernel error\\n")
+        sys.exit(1)
+""" % futils.IpsetSession.SENTINEL_NAME
+
+
+class TestIpsetSession(unittest.TestCase):
+    def setUp(self):
+        self.session = futils.IpsetSession()
+        self.session.COMMAND = [sys.executable, "-c", FAKE_IPSET]
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_errors(self):
+        lines = ["create felix-a hash:net",
+                 "add felix-a bad0",
+                 "add felix-a 10.0.0.0/8",
+                 "add felix-a bad1"]
+        errors = self.session.run(lines)
+
+        # Errors are matched to the commands that caused them, without the
+        # hint to run "ipset help".
+        self.assertEqual(sorted(errors), [1, 3])
+        self.assertEqual(errors[1],
+                         "ipset v6.20.1: Syntax error: 'bad0' is invalid\n")
+        self.assertIn("bad1", errors[3])
+
+        # The session carries on.
+        proc = self.session._proc
+        errors = self.session.run(["add felix-a bad2", "list felix-a"])
+        self.assertEqual(errors.keys(), [0])
+        self.assertIs(self.session._proc, proc)
+
+    def test_chunks(self):
+        lines = ["add felix-a 10.0.0.1"] * (futils.IpsetSession.CHUNK_SIZE * 2)
+        lines.append("add felix-a bad0")
+        errors = self.session.run(lines)
+        self.assertEqual(errors.keys(), [len(lines) - 1])
+
+    def test_restart(self):
+        # The command that was running when ipset exited is reported as
+        # failed, and the rest run in a new process.
+        lines = ["create felix-a hash:net",
+                 "exit",
+                 "add felix-a bad0",
+                 "add felix-a 10.0.0.1"]
+        errors = self.session.run(lines)
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertIn("Kernel error", errors[1])
+        self.assertIn("bad0", errors[2])
+        self.assertIsNone(self.session._proc.poll())
+
+
+class TestIpsetCommands(unittest.TestCase):
+    def setUp(self):
+        self.real_command = futils.IpsetSession.COMMAND
+        futils.IpsetSession.COMMAND = [sys.executable, "-c", FAKE_IPSET]
+
+    def tearDown(self):
+        futils.IpsetSession.COMMAND = self.real_command
+        futils.set_use_sessions(False)
+        if futils._ipset_session is not None:
+            futils._ipset_session.close()
+            futils._ipset_session = None
+
+    def test_sessions(self):
+        futils.set_use_sessions(True)
+
+        futils.check_ipset(["create", "felix-a", "hash:net"])
+        self.assertEqual(futils.call_ipset_silent(["add", "felix-a", "bad0"]),
+                         1)
+        try:
+            futils.check_ipset(["add", "felix-a", "bad1"])
+        except futils.FailedSystemCall as e:
+            self.assertEqual(list(e.args), ["ipset", "add", "felix-a", "bad1"])
+            self.assertIn("bad1", e.stderr)
+        else:
+            self.fail("No exception for failed command")
+
+        # All the commands went to the same process, which is kept.
+        proc = futils._ipset_session._proc
+        self.assertEqual(futils.ipset_batch([["list", "felix-a"]]), {})
+        self.assertIs(futils._ipset_session._proc, proc)
+
+    def test_no_session(self):
+        errors = futils.ipset_batch([["add", "felix-a", "bad0"],
+                                     ["add", "felix-a", "10.0.0.1"]])
+        self.assertEqual(errors.keys(), [0])
+        self.assertIsNone(futils._ipset_session)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_fworker
+~~~~~~~~~~~
+
+Tests for the worker thread.
+"""
+import select
+import threading
+import unittest
+from calico.felix import fworker
+
+class TestWorker(unittest.TestCase):
+    def wait(self, worker):
+        ready, _, _ = select.select([worker], [], [], 5)
+        self.assertEqual(ready, [worker])
+        return worker.results()
+
+    def test_jobs(self):
+        done = []
+
+        def idle():
+            if done:
+                result = list(done)
+                del done[:]
+                return result
+
+        worker = fworker.Worker(idle)
+        self.assertEqual(worker.results(), [])
+
+        for index in range(5):
+            worker.queue(done.append, index)
+
+        results = []
+        while sum(len(result) for result in results) < 5:
+            results.extend(self.wait(worker))
+
+        # The jobs ran in order.
+        self.assertEqual(sum(results, []), range(5))
+
+    def test_idle_every(self):
+        done = []
+        idle_at = []
+
+        def idle():
+            idle_at.append(len(done))
+            if len(done) == 10:
+                return idle_at
+
+        # Hold up the worker until all the jobs are queued, so that it never
+        # runs out of them.
+        started = threading.Event()
+        worker = fworker.Worker(idle, idle_every=3)
+        worker.queue(started.wait)
+        for index in range(10):
+            worker.queue(done.append, index)
+        started.set()
+
+        self.assertEqual(self.wait(worker), [[2, 5, 8, 10]])
+
+    def test_exception(self):
+        worker = fworker.Worker(lambda: None)
+        worker.queue(int, "not a number")
+        self.assertRaises(ValueError, self.wait, worker)
@@ -34,6 +34,7 @@ from neutron.plugins.ml2 import driver_api as api
 from neutron.plugins.ml2.drivers import mech_agent
 import eventlet
 from eventlet.green import zmq
+import hashlib
 import json
 import time
 from neutron import context as ctx
@@ -248,11 +249,29 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
                             self._port_is_endpoint_port(port)):
                             ports.append(port)
 
+                    #*********************************************************#
+                    #* If Felix has sent the revisions of the endpoints it   *#
+                    #* holds, this is an incremental resync: only send the   *#
+                    #* ports that are new or have changed, and list the      *#
+                    #* endpoints that no longer exist.  Otherwise send all   *#
+                    #* the ports.                                            *#
+                    #*********************************************************#
+                    known = rq.get('endpoints')
+                    deleted = []
+                    if known is not None:
+                        ports, deleted = self._resync_ports(ports,
+                                                            known,
+                                                            db_context)
+
                     resync_rsp = {'type': 'RESYNCSTATE',
                                   'endpoint_count': len(ports),
                                   'rc': 'SUCCESS',
                                   'message': 'Здра́вствуйте!'}
 
+                    if known is not None:
+                        resync_rsp.update({'incremental': True,
+                                           'deleted': deleted})
+
                     #*********************************************************#
                     #* Send the prepared response.                           *#
                     #*********************************************************#
@@ -367,18 +386,12 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
 
         #*********************************************************************#
         #* Add the fields that are common to ENDPOINTCREATED and             *#
-        #* ENDPOINTUPDATED.                                                  *#
+        #* ENDPOINTUPDATED, and the revision of those fields.                *#
         #*********************************************************************#
         if op == 'CREATED' or op == 'UPDATED':
-            rq.update(
-                {'addrs': [{'addr': ip['ip_address'],
-                            'gateway': self._get_subnet_gw(ip['subnet_id'],
-                                                           db_context),
-                            'properties': {'gr': False}}
-                           for ip in port['fixed_ips']],
-                 'mac': port['mac_address'],
-                 'state': 'enabled' if port['admin_state_up'] else 'disabled'}
-            )
+            fields = self._endpoint_fields(port, db_context)
+            rq.update(fields)
+            rq['revision'] = self._endpoint_revision(fields)
 
         #*********************************************************************#
         #* For ENDPOINTCREATED, add in the resync_id.  For ENDPOINTUPDATED   *#
@@ -425,6 +438,46 @@ class CalicoMechanismDriver(mech_agent.SimpleAgentMechanismDriverBase):
             self._clear_socket_to_felix_peer(hostname)
             return
 
+    def _resync_ports(self, ports, known, db_context):
+
+        #*********************************************************************#
+        #* For an incremental resync, given the ports on a Felix host and    *#
+        #* the revisions of the endpoints that Felix holds, return the list  *#
+        #* of ports that are new or have changed and the list of IDs of the  *#
+        #* endpoints that no longer exist.                                   *#
+        #*********************************************************************#
+        port_ids = set(port['id'] for port in ports)
+        deleted = [id for id in known if id not in port_ids]
+        changed = [port for port in ports
+                   if known.get(port['id']) !=
+                   self._endpoint_revision(self._endpoint_fields(port,
+                                                                 db_context))]
+        return changed, deleted
+
+    def _endpoint_fields(self, port, db_context):
+
+        #*********************************************************************#
+        #* Return the endpoint data for a port, as sent in ENDPOINTCREATED   *#
+        #* and ENDPOINTUPDATED.                                              *#
+        #*********************************************************************#
+        return {'addrs': [{'addr': ip['ip_address'],
+                           'gateway': self._get_subnet_gw(ip['subnet_id'],
+                                                          db_context),
+                           'properties': {'gr': False}}
+                          for ip in port['fixed_ips']],
+                'mac': port['mac_address'],
+                'state': 'enabled' if port['admin_state_up'] else 'disabled'}
+
+    def _endpoint_revision(self, fields):
+
+        #*********************************************************************#
+        #* Return the revision of an endpoint's data.  Neutron does not keep *#
+        #* a revision number for each port, so this is a hash of the data,   *#
+        #* which changes whenever the data does.  Felix only ever compares   *#
+        #* revisions for equality.                                           *#
+        #*********************************************************************#
+        return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()
+
     def _get_subnet_gw(self, subnet_id, db_context):
         assert self.db
         subnet = self.db.get_subnet(db_context, subnet_id)
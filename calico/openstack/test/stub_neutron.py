@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+openstack.test.stub_neutron
+~~~~~~~~~~~~
+
+Stub of the parts of Neutron that the Calico mechanism driver uses, so that it
+can be tested without Neutron. This one module stands in for each of the
+Neutron modules that the driver imports.
+"""
+import logging
+
+# neutron.common.constants
+AGENT_TYPE_DHCP    = 'DHCP agent'
+L2_AGENT_TOPIC     = 'N/A'
+PORT_STATUS_ACTIVE = 'ACTIVE'
+
+# neutron.extensions.portbindings
+CAP_PORT_FILTER = 'port_filter'
+VIF_TYPE_ROUTED = 'routed'
+
+# neutron.plugins.ml2.driver_api
+NETWORK_TYPE = 'network_type'
+
+# neutron.openstack.common.log
+getLogger = logging.getLogger
+
+
+# neutron.plugins.ml2.drivers.mech_agent
+class SimpleAgentMechanismDriverBase(object):
+    def __init__(self, agent_type, vif_type, vif_details):
+        self.agent_type  = agent_type
+        self.vif_type    = vif_type
+        self.vif_details = vif_details
+
+
+# neutron.context
+def get_admin_context():
+    return None
+
+
+# neutron.manager
+class NeutronManager(object):
+    @classmethod
+    def get_plugin(cls):
+        raise NotImplementedError("No Neutron plugin in tests")
+
+# The names of the modules that this stub stands in for.
+MODULES = ('neutron',
+           'neutron.common',
+           'neutron.common.constants',
+           'neutron.context',
+           'neutron.extensions',
+           'neutron.extensions.portbindings',
+           'neutron.manager',
+           'neutron.openstack',
+           'neutron.openstack.common',
+           'neutron.openstack.common.log',
+           'neutron.plugins',
+           'neutron.plugins.ml2',
+           'neutron.plugins.ml2.driver_api',
+           'neutron.plugins.ml2.drivers',
+           'neutron.plugins.ml2.drivers.mech_agent')
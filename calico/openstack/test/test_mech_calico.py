@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+openstack.test.test_mech_calico
+~~~~~~~~~~~
+
+Tests for endpoint revisions and the incremental resyncs that use them.
+"""
+import json
+import sys
+import unittest
+
+# Replace Neutron and eventlet with stubs, since we do not have them.
+import calico.felix.test.stub_zmq as stub_zmq
+import calico.openstack.test.stub_eventlet as stub_eventlet
+import calico.openstack.test.stub_neutron as stub_neutron
+for name in stub_neutron.MODULES:
+    sys.modules[name] = stub_neutron
+    setattr(stub_neutron, name.split('.')[-1], stub_neutron)
+sys.modules['eventlet'] = stub_eventlet
+sys.modules['eventlet.green'] = stub_eventlet
+sys.modules['eventlet.green.zmq'] = stub_zmq
+stub_eventlet.green = stub_eventlet
+stub_eventlet.zmq   = stub_zmq
+
+from calico.openstack import mech_calico
+
+class FakeDb(object):
+    def __init__(self):
+        self.ports  = []
+        self.agents = []
+
+    def get_subnet(self, db_context, subnet_id):
+        return {'gateway_ip': "10.65.0.1"}
+
+    def get_ports(self, db_context):
+        return self.ports
+
+    def create_or_update_agent(self, db_context, agent):
+        self.agents.append(agent)
+
+class ThreadLog(object):
+    """
+    Log for threads that log and carry on after any exception, which raises
+    the exception again so that the test sees it (and the thread stops).
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+    def exception(self, *args):
+        raise
+
+def port(id, ip, admin_state_up=True, host="felix1"):
+    return {'id': id,
+            'mac_address': "aa:bb:cc:dd:ee:ff",
+            'admin_state_up': admin_state_up,
+            'binding:host_id': host,
+            'device_owner': "compute:nova",
+            'fixed_ips': [{'ip_address': ip, 'subnet_id': "subnet"}]}
+
+class TestRevision(unittest.TestCase):
+    def setUp(self):
+        self.driver = mech_calico.CalicoMechanismDriver()
+        self.driver.db = FakeDb()
+
+    def revision(self, port):
+        return self.driver._endpoint_revision(
+            self.driver._endpoint_fields(port, None))
+
+    def test_endpoint_revision(self):
+        # The revision depends only on the endpoint data, not its order.
+        fields = self.driver._endpoint_fields(port("a", "10.65.0.2"), None)
+        revision = self.driver._endpoint_revision(fields)
+        self.assertEqual(revision,
+                         self.driver._endpoint_revision(dict(fields)))
+        self.assertEqual(revision, self.revision(port("a", "10.65.0.2")))
+
+        # Any change to the data changes it.
+        self.assertNotEqual(revision, self.revision(port("a", "10.65.0.3")))
+        self.assertNotEqual(revision,
+                            self.revision(port("a", "10.65.0.2", False)))
+
+    def test_resync_ports(self):
+        unchanged = port("a", "10.65.0.2")
+        changed   = port("b", "10.65.0.3")
+        new       = port("c", "10.65.0.4")
+        known = {"a": self.revision(unchanged),
+                 "b": self.revision(port("b", "10.65.0.5")),
+                 "d": self.revision(port("d", "10.65.0.6")),
+                 "e": None}
+
+        ports, deleted = self.driver._resync_ports([unchanged, changed, new],
+                                                   known,
+                                                   None)
+        self.assertEqual(ports, [changed, new])
+        self.assertEqual(sorted(deleted), ["d", "e"])
+
+        # An endpoint without a revision (not programmed) is sent again.
+        known["a"] = None
+        ports, deleted = self.driver._resync_ports([unchanged], known, None)
+        self.assertEqual(ports, [unchanged])
+        self.assertEqual(sorted(deleted), ["b", "d", "e"])
+
+
+class TestResync(unittest.TestCase):
+    def setUp(self):
+        self.real_log = mech_calico.LOG
+        mech_calico.LOG = ThreadLog(self.real_log)
+
+        self.driver = mech_calico.CalicoMechanismDriver()
+        self.driver.db = FakeDb()
+        self.driver.zmq_context = stub_zmq.Context()
+        self.driver.felix_router_socket = stub_zmq.Socket(stub_zmq.ROUTER)
+
+        self.sent = []
+        self.driver.send_endpoint = (
+            lambda hostname, resync_id, port, op, db_context:
+            self.sent.append((hostname, resync_id, port['id'], op)))
+
+    def tearDown(self):
+        mech_calico.LOG = self.real_log
+
+    def resync(self, endpoints=None):
+        """
+        Pass the router thread a RESYNCSTATE request, returning its response.
+        """
+        rq = {'type': 'RESYNCSTATE',
+              'resync_id': "resync",
+              'issued': 0,
+              'hostname': "felix1"}
+        if endpoints is not None:
+            rq['endpoints'] = endpoints
+
+        sock = self.driver.felix_router_socket
+        sock.queue("peer", "", json.dumps(rq))
+
+        # The thread runs until there are no more requests to receive.
+        self.assertRaises(stub_zmq.Again, self.driver.felix_router_thread)
+
+        peer, delimiter, data = sock.sent.pop()
+        self.assertEqual(peer, "peer")
+        return json.loads(data)
+
+    def test_full_resync(self):
+        ports = [port("a", "10.65.0.2"), port("b", "10.65.0.3")]
+        self.driver.db.ports = ports + [port("c", "10.65.0.4", host="other")]
+
+        rsp = self.resync()
+        self.assertEqual(rsp['endpoint_count'], 2)
+        self.assertNotIn('incremental', rsp)
+        self.assertEqual(self.sent, [("felix1", "resync", "a", 'CREATED'),
+                                     ("felix1", "resync", "b", 'CREATED')])
+
+    def test_incremental_resync(self):
+        unchanged = port("a", "10.65.0.2")
+        changed   = port("b", "10.65.0.3")
+        self.driver.db.ports = [unchanged, changed]
+
+        revision = self.driver._endpoint_revision(
+            self.driver._endpoint_fields(unchanged, None))
+        rsp = self.resync({"a": revision, "b": "old", "d": "gone"})
+        self.assertEqual(rsp['endpoint_count'], 1)
+        self.assertTrue(rsp['incremental'])
+        self.assertEqual(rsp['deleted'], ["d"])
+        self.assertEqual(self.sent, [("felix1", "resync", "b", 'CREATED')])
+
+        # Nothing changed: no endpoints are sent.
+        self.sent = []
+        rsp = self.resync({"a": revision,
+                           "b": self.driver._endpoint_revision(
+                               self.driver._endpoint_fields(changed, None))})
+        self.assertEqual(rsp['endpoint_count'], 0)
+        self.assertEqual(rsp['deleted'], [])
+        self.assertEqual(self.sent, [])